@@ -8,7 +8,7 @@ from aops.applications.common.utils import get_app_mode
 from aops.applications.handlers.v1 import api as apiv1
 from aops.applications.database import db
 from aops.applications.common.log import init_logger
-from aops.applications import register_polling_tasks
+from aops.applications import register_polling_tasks, register_worker_tasks
 from aops.conf.server_config import configs
 from flask_migrate import Migrate
 
@@ -25,6 +25,8 @@ def create_app():
     #     db.create_all()
         # import aops.applications.pre_request
     apiv1.init_app(app)
+    # started by the first request of each worker, after the fork of gunicorn and never by manage.py
+    app.before_first_request(lambda: register_worker_tasks(app))
     return app
 
 
@@ -2,9 +2,14 @@
 # -*- coding:utf-8 -*-
 import gevent
 import datetime
+import random
 from aops.applications.database.apis.job.job_record import get_execution_record_list
 from aops.applications.database.apis import process_execution_record
 from aops.applications.database.apis.system.message.message import get_unsent_messages
+from aops.applications.database.apis.audit.audit_archive import archive_audits
+from aops.applications.database.apis.resource.host.group import publish_inventory_deltas
+from aops.applications.database.apis.resource.host.cmdb_sync import sync_hosts_with_cmdb_by_interval
+from aops.applications.database.apis.resource.host.host_search import build_host_index
 
 from aops.applications.database import check_application_update_by_job_records,\
     check_application_update_by_process_records, check_manual_process
@@ -21,6 +26,7 @@ def register_polling_tasks(app):
     # gevent.spawn(fetch_job_records, app).start()
     # gevent.spawn(fetch_process_records, app).start()
     gevent.spawn(send_message, app).start()
+    gevent.spawn(build_host_search_index, app).start()
 
 
 def fetch_job_records(app):
@@ -103,3 +109,62 @@ def send_message(app):
         finally:
             app.logger.info('do something after send message')
 
+
+def register_worker_tasks(app):
+    """ Start the tasks of every worker, they run on all the workers of the cluster under their locks """
+    gevent.spawn(archive_audits_by_interval, app).start()
+    gevent.spawn(publish_inventory_deltas_by_interval, app).start()
+    gevent.spawn(sync_cmdb_by_interval, app).start()
+
+
+def archive_audits_by_interval(app):
+    """ Roll the audits out of the hot months into archive chunks """
+
+    while True:
+        try:
+            with app.app_context():
+                archived = archive_audits()
+                app.logger.info('Archive the audits of {} months'.format(len(archived)))
+        except Exception as e:
+            app.logger.error('Archive audits ERROR {}'.format(e))
+        gevent.sleep(app.config.get('AUDIT_ARCHIVE_INTERVAL', 3600))
+
+
+def publish_inventory_deltas_by_interval(app):
+    """ Publish the debounced inventory deltas to Scheduler, the failed ones are kept to retry """
+
+    while True:
+        try:
+            with app.app_context():
+                published = publish_inventory_deltas()
+                if published:
+                    app.logger.info('Publish {} inventory deltas'.format(published))
+        except Exception as e:
+            app.logger.error('Publish inventory deltas ERROR {}'.format(e))
+        gevent.sleep(app.config.get('INVENTORY_PUBLISH_INTERVAL', 1))
+
+
+def sync_cmdb_by_interval(app):
+    """ Sync the business groups with CMDB, one worker of the cluster syncs a business per interval """
+
+    while True:
+        jitter = random.uniform(0, app.config.get('CMDB_SYNC_JITTER', 30))
+        gevent.sleep(app.config.get('CMDB_SYNC_INTERVAL', 300) + jitter)
+        try:
+            with app.app_context():
+                for run in sync_hosts_with_cmdb_by_interval():
+                    app.logger.info('Sync hosts of {} with CMDB {} in {:.1f}s, added: {}, updated: {}, deleted: {}'.
+                                    format(run.business, run.status, run.duration, run.added, run.updated,
+                                           run.deleted))
+        except Exception as e:
+            app.logger.error('Sync hosts with CMDB ERROR {}'.format(e))
+
+
+def build_host_search_index(app):
+    """ Build the host search index at startup, so the first search doesn't wait for it """
+
+    try:
+        with app.app_context():
+            build_host_index()
+    except Exception as e:
+        app.logger.error('Build host search index ERROR {}'.format(e))
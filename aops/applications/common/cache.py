@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Cache helpers shared by the per-worker caches of AOPS.
+
+Without redis, the caches kept in the workers are tagged with version rows in db, see
+read_version and bump_version. A version is read and bumped in its own connection, so the
+helpers may be called after the commit of the session, e.g. from its after_commit hook.
+"""
+import time
+from collections import OrderedDict
+
+from flask import current_app as app
+from gevent.event import AsyncResult
+from redis import StrictRedis
+from sqlalchemy import and_, or_, select
+
+from aops.applications.database import db
+
+_redis_clients = {}
+_MISSING = object()
+
+
+class LRUCache(object):
+    """ A small in-process LRU cache, entries may expire after ttl seconds
+
+    Args:
+        capacity: the max number of entries kept in the cache
+        ttl: seconds an entry keeps valid, None means never expired
+    """
+
+    def __init__(self, capacity=1024, ttl=None):
+        self._capacity = capacity
+        self._ttl = ttl
+        self._items = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            expired_at, value = self._items.pop(key)
+        except KeyError:
+            return default
+        if expired_at is not None and expired_at < time.time():
+            return default
+        self._items[key] = (expired_at, value)
+        return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self._ttl
+        expired_at = time.time() + ttl if ttl is not None else None
+        self._items.pop(key, None)
+        self._items[key] = (expired_at, value)
+        while len(self._items) > self._capacity:
+            self._items.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._items.pop(key, None)
+        return item[1] if item else default
+
+    def clear(self):
+        self._items.clear()
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def __len__(self):
+        return len(self._items)
+
+
+class ReadThroughCache(object):
+    """ An in-process read-through cache, concurrent loads of a key share one in-flight call
+
+    Args:
+        capacity: the max number of entries kept in the cache
+    """
+
+    def __init__(self, capacity=1024):
+        self._cache = LRUCache(capacity)
+        self._loading = {}
+        self.stats = {}
+
+    def get(self, key, load, ttl, group=None):
+        """
+        Get the value of key, load it on a miss
+        Args:
+            key: the cache key
+            load: the function loading the value
+            ttl: seconds the loaded value keeps valid
+            group: the name counting the hits, misses and coalesced calls
+        """
+        counters = self.stats.setdefault(group, {'hits': 0, 'misses': 0, 'coalesced': 0})
+        value = self._cache.get(key, _MISSING)
+        if value is not _MISSING:
+            counters['hits'] += 1
+            return value
+
+        loading = self._loading.get(key)
+        if loading is not None:
+            counters['coalesced'] += 1
+            return loading.get()
+
+        counters['misses'] += 1
+        loading = self._loading[key] = AsyncResult()
+        try:
+            value = load()
+        except Exception as e:
+            loading.set_exception(e)
+            raise
+        else:
+            self._cache.set(key, value, ttl)
+            loading.set(value)
+            return value
+        finally:
+            self._loading.pop(key, None)
+
+    def clear(self):
+        self._cache.clear()
+
+
+def get_redis():
+    """ Get the redis client of current worker
+
+    Returns:
+        a StrictRedis client shared by the worker, or None if redis isn't configured
+    """
+    host = app.config.get("REDIS_HOST")
+    if not host:
+        return None
+    port = app.config.get("REDIS_PORT")
+    db = app.config.get("REDIS_DB")
+    key = (host, port, db)
+    if key not in _redis_clients:
+        _redis_clients[key] = StrictRedis(host=host, port=port, db=db,
+                                          socket_timeout=app.config.get("REDIS_SOCKET_TIMEOUT", 1))
+    return _redis_clients[key]
+
+
+def _version_row(table, key):
+    return and_(*[table.c[column] == value for column, value in sorted(key.items())])
+
+
+def read_version(table, key, connection=None):
+    """ Read a version row
+
+    Args:
+        table: the table of the versions, with an integer version column
+        key: the {column: value} of the row, or a list of them read at once
+        connection: the connection reading the rows, its own connection by default
+    Returns:
+        the version, 0 if the row is missing; a tuple of the versions for a list of keys
+    """
+    keys = key if isinstance(key, list) else [key]
+    columns = sorted(keys[0])
+    query = select([table.c[column] for column in columns] + [table.c.version]).where(
+        or_(*[_version_row(table, item) for item in keys]))
+    if connection is None:
+        with db.engine.connect() as connection:
+            rows = connection.execute(query).fetchall()
+    else:
+        rows = connection.execute(query).fetchall()
+    versions = dict((tuple(row[:-1]), row[-1]) for row in rows)
+    found = tuple(versions.get(tuple(item[column] for column in columns), 0) for item in keys)
+    return found if isinstance(key, list) else found[0]
+
+
+def bump_version(table, key, connection=None):
+    """ Bump a version row, the row is inserted with the version 1 if it's missing
+
+    Args:
+        table: the table of the versions, with an integer version column
+        key: the {column: value} of the row
+        connection: the connection of the transaction bumping the row, its own transaction by default
+    Returns:
+        the bumped version
+    """
+    if connection is None:
+        with db.engine.begin() as connection:
+            return bump_version(table, key, connection)
+    row = _version_row(table, key)
+    if not connection.execute(table.update().where(row).values(version=table.c.version + 1)).rowcount:
+        connection.execute(table.insert(), dict(key, version=1))
+    return connection.execute(select([table.c.version]).where(row)).scalar()
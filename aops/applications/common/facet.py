@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Cached distinct values of a column, e.g. the creators listed by the dropdowns.
+
+The distinct values of each scope (e.g. a business group) are cached in a redis hash, or in
+the worker when redis isn't configured. Writes are checked after the session commits: an
+inserted value already cached changes nothing, a new value, an update or a delete of the
+column invalidates the scope, so the values are only reloaded when they changed. Without
+redis, the values kept in the worker are tagged with the version of their scope, a row of
+facet_version bumped by the invalidation, so the writes of a worker reach the others.
+"""
+import json
+
+from flask import current_app as app, has_app_context
+from redis.exceptions import RedisError
+from sqlalchemy import event
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy.orm.session import Session
+
+from aops.applications.common.cache import LRUCache, get_redis, read_version, bump_version
+from aops.applications.database import db
+from aops.applications.database.models.common import FacetVersion
+
+FACET_KEY = 'aops:facet:{}'
+ALL_SCOPES = '*'
+
+_facets = {}
+
+
+def _to_unicode(value):
+    return value if isinstance(value, unicode) else str(value).decode('utf-8')
+
+
+def _pending_changes(session):
+    return session.info.setdefault('facet_changes', set())
+
+
+class Facet(object):
+    """ The distinct values of a column per scope
+
+    Args:
+        name: the unique name of the facet
+        model: the model class
+        column: the name of the column
+        scope: the names of the columns scoping the values, e.g. ('business_group',)
+        filters: the column values of the counted rows, e.g. is_deleted=False
+    """
+
+    def __init__(self, name, model, column, scope=(), **filters):
+        self.name = name
+        self.model = model
+        self.column = column
+        self.scope = tuple(scope)
+        self.filters = filters
+        self._key = FACET_KEY.format(name)
+        self._values = LRUCache(capacity=256)    # {field: (version, values)}, used when redis isn't configured
+        self._known = LRUCache(capacity=4096, ttl=60)    # values known to be cached
+        _facets[name] = self
+        event.listen(model, 'after_insert', self._after_insert)
+        event.listen(model, 'after_update', self._after_update)
+        event.listen(model, 'after_delete', self._after_delete)
+
+    def get(self, *scope):
+        """
+        Get the distinct values of the scope
+        Args:
+            scope: the values of the scope columns
+        Returns:
+            set of the values
+        """
+        field = json.dumps(scope)
+        timeout = app.config.get('FACET_CACHE_TIMEOUT', 600)
+        if get_redis() is None:
+            try:
+                version = self._db_version(field)
+            except SQLAlchemyError as e:
+                app.logger.warning(u'Read facet {} version failed: {}'.format(self.name, e))
+                return set(self._load(scope))
+            cached = self._values.get(field)
+            if cached is not None and cached[0] == version:
+                return set(cached[1])
+            values = self._load(scope)
+            self._values.set(field, (version, values), ttl=timeout)
+            return set(values)
+
+        cached = self._cached(field)
+        if cached is not None:
+            return cached
+        values = self._load(scope)
+        redis = get_redis()
+        try:
+            pipe = redis.pipeline(transaction=False)
+            pipe.hset(self._key, field, json.dumps(values))
+            pipe.expire(self._key, timeout)
+            pipe.execute()
+        except RedisError as e:
+            app.logger.warning(u'Save facet {} failed: {}'.format(self.name, e))
+        return set(values)
+
+    def _db_version(self, field):
+        return '{}.{}'.format(*read_version(FacetVersion.__table__, [{'name': self.name, 'scope': ALL_SCOPES},
+                                                                     {'name': self.name, 'scope': field}]))
+
+    def _bump_db_version(self, field):
+        bump_version(FacetVersion.__table__, {'name': self.name, 'scope': field})
+
+    def _cached(self, field):
+        """ the cached values of the scope, None if they aren't cached or are stale """
+        if not has_app_context():
+            return None
+        redis = get_redis()
+        if redis is None:
+            cached = self._values.get(field)
+            if cached is None:
+                return None
+            try:
+                return set(cached[1]) if cached[0] == self._db_version(field) else None
+            except SQLAlchemyError as e:
+                app.logger.warning(u'Read facet {} version failed: {}'.format(self.name, e))
+                return None
+        try:
+            cached = redis.hget(self._key, field)
+        except RedisError as e:
+            app.logger.warning(u'Read facet {} failed: {}'.format(self.name, e))
+            return None
+        return set(json.loads(cached)) if cached is not None else None
+
+    def _load(self, scope):
+        q = db.session.query(getattr(self.model, self.column)).distinct().filter_by(**self.filters)
+        for key, value in zip(self.scope, scope):
+            q = q.filter(getattr(self.model, key) == value)
+        return [_to_unicode(value) for value, in q if value is not None]
+
+    def _invalidate(self, field):
+        if field == ALL_SCOPES:
+            self._values.clear()
+        else:
+            self._values.pop(field)
+        if not has_app_context():
+            return
+        redis = get_redis()
+        if redis is None:
+            try:
+                self._bump_db_version(field)
+            except SQLAlchemyError as e:
+                app.logger.error(u'Invalidate facet {} failed: {}'.format(self.name, e))
+            return
+        try:
+            if field == ALL_SCOPES:
+                redis.delete(self._key)
+            else:
+                redis.hdel(self._key, field)
+        except RedisError as e:
+            app.logger.error(u'Invalidate facet {} failed: {}'.format(self.name, e))
+
+    def apply(self, field, value):
+        """ apply a committed change, a value None invalidates the scope """
+        if value is not None and field != ALL_SCOPES:
+            if self._known.get((field, value)):
+                return
+            cached = self._cached(field)
+            if cached is None and has_app_context() and get_redis() is not None:
+                return    # not cached by any worker, without redis the other workers may keep it
+            if cached is not None and value in cached:
+                self._known.set((field, value), True)
+                return
+        self._invalidate(field)
+
+    def _scope_of(self, target):
+        return json.dumps(tuple(getattr(target, key) for key in self.scope))
+
+    def _after_insert(self, mapper, connection, target):
+        value = getattr(target, self.column)
+        if value is None or any(getattr(target, key) != expected for key, expected in self.filters.items()):
+            return
+        _pending_changes(object_session(target)).add((self.name, self._scope_of(target), _to_unicode(value)))
+
+    def _after_update(self, mapper, connection, target):
+        keys = (self.column,) + self.scope + tuple(self.filters)
+        if not any(get_history(target, key).has_changes() for key in keys):
+            return
+        changes = _pending_changes(object_session(target))
+        changes.add((self.name, self._scope_of(target), None))
+        old_scope = tuple((get_history(target, key).deleted or [getattr(target, key)])[0] for key in self.scope)
+        changes.add((self.name, json.dumps(old_scope), None))
+
+    def _after_delete(self, mapper, connection, target):
+        _pending_changes(object_session(target)).add((self.name, self._scope_of(target), None))
+
+
+def _after_bulk(context):
+    """ bulk updates and deletes, e.g. soft_delete_by, invalidate all scopes of the model """
+    for facet in _facets.values():
+        if issubclass(context.mapper.class_, facet.model):
+            _pending_changes(context.session).add((facet.name, ALL_SCOPES, None))
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_changes(session):
+    for name, field, value in session.info.pop('facet_changes', ()):
+        _facets[name].apply(field, value)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('facet_changes', None)
+
+
+event.listen(Session, 'after_bulk_update', _after_bulk)
+event.listen(Session, 'after_bulk_delete', _after_bulk)
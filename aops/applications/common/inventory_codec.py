@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Compact encoding of the inventory payloads posted to Scheduler.
+
+A payload, e.g. {'tree-group': [...]} or {'added': [...], 'updated': [...]}, maps names to
+lists of node dicts. Each list is laid out by columns: the tree is flattened in pre-order
+with the row index of each node's parent. A column repeating its values, e.g. business, os
+or the accounts, holds indexes into one table of interned values shared by the payload,
+the other columns, e.g. id and ip, keep their json values. The document is json compressed
+by gzip and tagged by the schema version, see CONTENT_TYPE. The rows lacking a key are
+listed by its column, so the decoded payload equals the encoded one.
+"""
+import gzip
+import json
+from io import BytesIO
+
+SCHEMA_VERSION = 1
+CONTENT_TYPE = 'application/vnd.aops.inventory.v{}+json'.format(SCHEMA_VERSION)
+CONTENT_ENCODING = 'gzip'
+INTERNED, VALUE = 'i', 'j'
+NO_PARENT = -1
+
+
+class _Values(object):
+    """ the interned values, keyed by their type and value """
+
+    def __init__(self):
+        self.values = []
+        self._indexes = {}
+
+    def index(self, value, key):
+        if key not in self._indexes:
+            self._indexes[key] = len(self.values)
+            self.values.append(value)
+        return self._indexes[key]
+
+
+def _intern_column(values, interned):
+    """ the indexes of the interned values, None if the values hardly repeat """
+    limit = len(values) // 2
+    positions, distinct, seen = [], [], {}
+    for value in values:
+        key = value.__class__, repr(value) if isinstance(value, (dict, list)) else value
+        position = seen.get(key)
+        if position is None:
+            if len(distinct) >= limit:
+                return None
+            position = seen[key] = len(distinct)
+            distinct.append((value, key))
+        positions.append(position)
+    indexes = [interned.index(value, key) for value, key in distinct]
+    return [indexes[position] for position in positions]
+
+
+def _flatten(nodes, rows, parents, parent=NO_PARENT):
+    for node in nodes:
+        index = len(rows)
+        rows.append(node)
+        parents.append(parent)
+        _flatten(node.get('children') or [], rows, parents, index)
+
+
+def _encode_table(nodes, interned):
+    rows, parents = [], []
+    _flatten(nodes, rows, parents)
+    keys = sorted(set(key for row in rows for key in row if key != 'children'))
+    columns = []
+    for key in keys:
+        values = [row.get(key) for row in rows]
+        indexes = _intern_column(values, interned)
+        column = [key, VALUE, values] if indexes is None else [key, INTERNED, indexes]
+        missing = [index for index, row in enumerate(rows) if key not in row]
+        if missing:
+            column.append(missing)
+        columns.append(column)
+    table = {'rows': len(rows), 'columns': columns}
+    if any(parent != NO_PARENT for parent in parents):
+        table['parents'] = parents
+    return table
+
+
+def encode_inventory(payload, compresslevel=6):
+    """
+    Encode the inventory payload into the compact format
+    Args:
+        payload: {name: [node dict with optional children]}
+        compresslevel: the gzip compression level
+    Returns:
+        the encoded bytes
+    """
+    interned = _Values()
+    tables = dict((name, _encode_table(nodes, interned)) for name, nodes in payload.items())
+    document = json.dumps({'version': SCHEMA_VERSION, 'values': interned.values, 'tables': tables},
+                          separators=(',', ':'))
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=compresslevel) as f:
+        f.write(document)
+    return buf.getvalue()
+
+
+def decode_inventory(data):
+    """
+    Decode the compact format into the inventory payload, used by the Scheduler side
+    Args:
+        data: the encoded bytes
+    Returns:
+        {name: [node dict]}, the same as the encoded payload, the rows share the interned dicts and lists
+    """
+    with gzip.GzipFile(fileobj=BytesIO(data), mode='rb') as f:
+        document = json.loads(f.read())
+    if document.get('version') != SCHEMA_VERSION:
+        raise ValueError('Unsupported inventory schema version {}'.format(document.get('version')))
+
+    interned = document['values']
+    payload = {}
+    for name, table in document['tables'].items():
+        rows = [{} for _ in range(table['rows'])]
+        for column in table['columns']:
+            key, kind, values = column[:3]
+            missing = set(column[3]) if len(column) > 3 else ()
+            if kind == INTERNED:
+                values = [interned[index] for index in values]
+            for index, (row, value) in enumerate(zip(rows, values)):
+                if index not in missing:
+                    row[key] = value
+        roots = []
+        for row, parent in zip(rows, table.get('parents') or [NO_PARENT] * len(rows)):
+            if parent == NO_PARENT:
+                roots.append(row)
+            else:
+                rows[parent].setdefault('children', []).append(row)
+        payload[name] = roots
+    return payload
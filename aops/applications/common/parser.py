@@ -5,49 +5,65 @@
 
 """
 Parse csv/txt files uploaded by user.
+
+The files are read as streams of rows, so a large file is parsed in bounded memory. The lines
+may end with \r\n, \n or \r. offset tells the bytes read so far, e.g. for the progress of an
+import.
 """
 import csv
+import os
 
 
 class Parser(object):
 
     def __init__(self, path):
         self.path = path
+        self.size = os.path.getsize(path)
+        self.offset = 0
 
-    def parse(self):
-        raise Exception('Please define your parse in children class!!')
+    def rows(self):
+        """ yield each row as a dict """
+        raise Exception('Please define your rows in children class!!')
 
-    def _to_dict(self, items, header):
+    def parse(self):
         """ return a list that each item is a dict"""
-        results = []
-        for item in items:
-            results.append(dict(zip(header, item)))
-        return results
+        return list(self.rows())
+
+    def _lines(self, f):
+        """ the lines of f opened in universal newlines mode, keeping the offset """
+        for line in iter(f.readline, ''):
+            self.offset = f.tell()
+            yield line
 
 
 class TextParser(Parser):
-    def parse(self):
-        results = []
-        with open(self.path, 'r') as f:
-            data = f.read()
-        for line in data.split('\r\n'):
-            results.append(line.split())
-        return self._to_dict(results[1:], results[0])
+    def rows(self):
+        header = None
+        with open(self.path, 'rU') as f:
+            for line in self._lines(f):
+                items = line.split()
+                if not items:
+                    continue
+                if header is None:
+                    header = items
+                    continue
+                yield dict(zip(header, items))
 
 
 class CsvParser(Parser):
+    def rows(self, has_annotation=True):
+        with open(self.path, 'rU') as csv_file:
+            csv_reader = csv.reader(self._lines(csv_file), delimiter=',', quotechar='|')
+            if has_annotation:
+                next(csv_reader, None)    # chinese key names
+                next(csv_reader, None)    # chinese type explain
+            header = next(csv_reader, None)    # english key names
+            for item in csv_reader:
+                if item:
+                    yield dict(zip(header, item))
+
     def parse(self, has_annotation=True):
-        lines = []
-        with open(self.path, 'r') as csv_file:
-            csv_reader = csv.reader(csv_file, delimiter=',', quotechar='|')
-            lines = list(csv_reader)
-        if has_annotation:
-            cn_keys = lines.pop(0)   # chinese key names
-            cn_types = lines.pop(0)    # chinese type explain
-        header = lines[0]              # english key names
-        content = lines[1:]
-
-        return self._to_dict(content, header)
+        return list(self.rows(has_annotation))
 
 
 if __name__ == '__main__':
@@ -1,29 +1,57 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
+
+"""
+Transport of the Scheduler apis.
+
+All calls of a worker share one requests session with a sized connection pool. Idempotent
+calls are retried with jittered exponential backoff, a circuit breaker fails fast while the
+Scheduler keeps failing, and the latency and errors are counted per endpoint. The GETs of
+the endpoints configured in SCHEDULER_CACHE_TTLS are cached, and identical concurrent GETs
+share one in-flight call.
+"""
+import copy
+import json
+import random
+import re
+import time
 from functools import wraps
 
+import gevent
 import requests
 from flask import current_app as app
+from requests.adapters import HTTPAdapter
 
+from aops.applications.common.cache import ReadThroughCache
 from aops.applications.exceptions.exception import SchedulerError
 
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+RETRY_STATUS = (502, 503, 504)
+ID_PATTERN = re.compile(r'/(\d+|[0-9a-fA-F]{8}-[0-9a-fA-F-]{27})(?=/|$)')
+
+_session = None
+_breaker = None
+_stats = {}
+_responses = ReadThroughCache(capacity=1024)
+
 
 def sche_error(func):
     @wraps(func)
     def warpper(self, data=None, headers=None, params=None, json=None, timeout=10):
         try:
-            if func.func_name == "get":
+            if func.func_name in ("get", "_get"):
                 response = func(self, headers=headers, params=params, timeout=timeout)
             elif func.func_name == "delete":
                 response = func(self, headers=headers, timeout=timeout)
             else:
-                response = func(self, data=data, headers=headers, json=json, timeout=timeout)
+                response = func(self, data=data, headers=headers, params=params, json=json, timeout=timeout)
 
         except Exception as e:
             raise SchedulerError(e.message)
         if not response.ok:\
             raise SchedulerError(
-                "Scheduler's response code is {}, and reason is {}".format(response.status_code, response.reason))
+                "Scheduler's response code is {}, and reason is {}".format(response.status_code, response.reason),
+                response.status_code)
         try:
             import json
             return json.loads(response.text)
@@ -35,22 +63,163 @@ def sche_error(func):
     return warpper
 
 
+class CircuitBreaker(object):
+    """ Fail fast after continuous failures, a trial call is allowed after the reset timeout
+
+    Args:
+        failure_threshold: the number of continuous failures opening the circuit
+        reset_timeout: seconds the circuit keeps open before a trial call
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return self.CLOSED
+        if time.time() - self._opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        state = self.state
+        if state == self.HALF_OPEN and not self._trial:
+            self._trial = True
+            return True
+        return state == self.CLOSED
+
+    def success(self):
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def failure(self):
+        self.failures += 1
+        self._trial = False
+        if self.failures >= self.failure_threshold or self._opened_at is not None:
+            self._opened_at = time.time()
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        pool_size = app.config.get('SCHEDULER_POOL_SIZE', 20)
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
+
+def _get_breaker():
+    global _breaker
+    if _breaker is None:
+        _breaker = CircuitBreaker(app.config.get('SCHEDULER_BREAKER_THRESHOLD', 5),
+                                  app.config.get('SCHEDULER_BREAKER_RESET', 30))
+    return _breaker
+
+
+def _record(method, endpoint, elapsed, failed):
+    key = '{} {}'.format(method, ID_PATTERN.sub('/{id}', endpoint.split('?')[0]))
+    stats = _stats.setdefault(key, {'count': 0, 'errors': 0, 'total_time': 0.0, 'max_time': 0.0})
+    stats['count'] += 1
+    stats['errors'] += int(failed)
+    stats['total_time'] += elapsed
+    stats['max_time'] = max(stats['max_time'], elapsed)
+
+
+def get_scheduler_stats():
+    """
+    Get the Scheduler transport stats of current worker
+    Returns:
+        the circuit state and the latency and error counters of each endpoint
+    """
+    breaker = _get_breaker()
+    endpoints = [{
+        'endpoint': key,
+        'count': stats['count'],
+        'errors': stats['errors'],
+        'avg_ms': stats['total_time'] * 1000 / stats['count'] if stats['count'] else 0,
+        'max_ms': stats['max_time'] * 1000,
+    } for key, stats in sorted(_stats.items())]
+    cache = [dict(endpoint=endpoint, **counters) for endpoint, counters in sorted(_responses.stats.items())]
+    return {'circuit': breaker.state, 'failures': breaker.failures, 'endpoints': endpoints, 'cache': cache}
+
+
 class SchedulerApi(object):
     def __init__(self, endpoint):
         self.sche_schema = app.config["SCHEDULER_HTTP_SCHEMA"]
         self.sche_host = app.config["SCHEDULER_HOST"]
         self.sche_port = app.config["SCHEDULER_PORT"]
         self.base_url = "{}://{}:{}".format(self.sche_schema, self.sche_host, self.sche_port)
-        self.url = "{}/{}".format(self.base_url, endpoint.lstrip("/"))
+        self.endpoint = "/{}".format(endpoint.lstrip("/"))
+        self.url = "{}{}".format(self.base_url, self.endpoint)
+
+    def _request(self, method, **kwargs):
+        """ send the request by the shared session, retry the idempotent one on failures """
+        breaker = _get_breaker()
+        if not breaker.allow():
+            _record(method, self.endpoint, 0, True)
+            raise SchedulerError("Scheduler is unavailable, the circuit is open after {} failures".
+                                 format(breaker.failures))
+
+        retries = app.config.get('SCHEDULER_RETRIES', 2) if method in IDEMPOTENT_METHODS else 0
+        backoff = app.config.get('SCHEDULER_RETRY_BACKOFF', 0.2)
+        for attempt in range(retries + 1):
+            started = time.time()
+            error, response = None, None
+            try:
+                response = _get_session().request(method, self.url, **kwargs)
+            except requests.RequestException as e:
+                error = e
+            except BaseException:
+                # e.g. a gevent timeout, the failure ends the trial call of a half open circuit
+                _record(method, self.endpoint, time.time() - started, True)
+                breaker.failure()
+                raise
+            failed = response is None or response.status_code >= 500
+            _record(method, self.endpoint, time.time() - started, failed or not response.ok)
+            if not failed:
+                breaker.success()
+                return response
+
+            breaker.failure()
+            retryable = isinstance(error, (requests.ConnectionError, requests.Timeout)) or \
+                response is not None and response.status_code in RETRY_STATUS
+            if attempt == retries or not retryable or not breaker.allow():
+                break
+            app.logger.warning('{} {} failed, retry it: {}'.format(method, self.url, error or response.status_code))
+            gevent.sleep(random.uniform(0, backoff * 2 ** attempt))
+
+        if error is not None:
+            raise error
+        return response
 
-    @sche_error
     def get(self, headers=None, params=None, timeout=10):
-        return requests.get(self.url, headers=headers, params=params, timeout=timeout)
+        ttl = app.config.get('SCHEDULER_CACHE_TTLS', {}).get(self.endpoint)
+        if not ttl:
+            return self._get(headers=headers, params=params, timeout=timeout)
+        key = (self.url, json.dumps(params, sort_keys=True, default=str), json.dumps(headers, sort_keys=True))
+        result = _responses.get(key, lambda: self._get(headers=headers, params=params, timeout=timeout), ttl,
+                                group=self.endpoint)
+        return copy.deepcopy(result)
+
+    @sche_error
+    def _get(self, headers=None, params=None, timeout=10):
+        return self._request('GET', headers=headers, params=params, timeout=timeout)
 
     @sche_error
     def post(self, data=None, headers=None, params=None, json=None, timeout=10):
-        return requests.post(self.url, data=data, headers=headers, params=params, json=json, timeout=timeout)
+        return self._request('POST', data=data, headers=headers, params=params, json=json, timeout=timeout)
 
     @sche_error
     def delete(self, headers=None, timeout=10):
-        return requests.delete(self.url, headers=headers, timeout=timeout)
\ No newline at end of file
+        return self._request('DELETE', headers=headers, timeout=timeout)
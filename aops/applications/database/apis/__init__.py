@@ -6,7 +6,8 @@ from .system.user import user
 from .system.message import message
 
 from .resource.application import application
-from .resource.host import host, group, account, parameter
+from .resource.host import host, group, account, parameter, group_tree, cmdb_sync, host_search, \
+    host_attribute, host_import
 
 from .job import job
 from .ops_job.process import process, process_execution, process_execution_record
@@ -2,12 +2,24 @@
 # -*- coding:utf-8 -*-
 
 import sys
+import zlib
 reload(sys)
 sys.setdefaultencoding('utf-8')
 from datetime import datetime
 from flask import current_app as app
+from flask_sqlalchemy import Pagination
+from sqlalchemy import or_
+from aops.applications.database import db
 from aops.applications.database.models.audit.audit import Audit
+from aops.applications.database.apis.audit.audit_index import index_audits, token_match
+from aops.applications.database.apis.audit.audit_archive import get_overlapped_archives, match_archived_audit, \
+    count_archived, slice_archived, iter_archived_desc
+from aops.applications.database.apis.audit.audit_writer import audit_writer
 from aops.applications.exceptions.exception import ResourcesNotFoundError
+from aops.applications.common.facet import Facet
+
+audit_users = Facet('audit_user', Audit, 'user', is_deleted=False)
+audit_resources = Facet('audit_resource', Audit, 'resource', is_deleted=False)
 
 
 def get_audit_list():
@@ -19,184 +31,201 @@ def get_audit_list():
 
 
 def add_audit_item(**args):
-    audit_item = Audit.create(**args)
-    return audit_item.to_dict()
-
-
-def get_audit_list(page, per_page, args):
-    start_time = args.start_time
-    end_time = args.end_time
-    creator = args.user
-    source_ip = args.source_ip
-    resource_type = args.resource_type
-    resource_id = args.resource_id
-    operation = args.operation
-    status = args.status
-    message = args.message
-    fq = args.fuzzy_query
-
-    q = Audit.query.filter_by(is_deleted=False).order_by(Audit.updated_at.desc())
-
-    if creator:
-        q = q.filter(Audit.user.like("%{}%".format(creator)))
+    """
+    Add an audit item, it's written by the audit writer in batches if AUDIT_ASYNC is enabled
+    Returns:
+        the audit item
+    """
+    if not app.config.get('AUDIT_ASYNC', False):
+        audit_item = Audit.create(**args)
+        index_audits([audit_item])
+        db.session.commit()
+        return audit_item.to_dict()
+
+    if not audit_writer.running:
+        audit_writer.start(app._get_current_object())
+    now = datetime.now()
+    audit_item = dict(user=None, source_ip=None, resource=None, resource_id=None, operation=None, status=None,
+                      message=None, created_at=now, updated_at=now, deleted_at=None, is_deleted=False)
+    audit_item.update(args)
+    audit_writer.put(audit_item)
+    return audit_item
+
+
+def _filter_audits(args):
+    """
+    Build the audit query with filters. Time, user, resource and status are exact or range filters
+    served by the composite indexes of audit, operation, message and fuzzy query are served by the
+    audit token index.
+    Args:
+        args: the parsed filter arguments
+    """
+    q = Audit.query.filter_by(is_deleted=False).order_by(Audit.created_at.desc(), Audit.id.desc())
 
     date_format = app.config.get("DATE_FORMAT")
-    if start_time:
-        start_time = datetime.strptime(start_time, date_format)
-        q = q.filter(Audit.created_at >= ("{}".format(start_time)))
-
-    if end_time:
-        end_time = datetime.strptime(end_time, date_format)
-        q = q.filter(Audit.updated_at <= ("{}".format(end_time)))
+    if args.get('start_time'):
+        q = q.filter(Audit.created_at >= datetime.strptime(args.get('start_time'), date_format))
 
-    if source_ip:
-        q = q.filter(Audit.source_ip.like("%{}%".format(source_ip)))
+    if args.get('end_time'):
+        q = q.filter(Audit.created_at <= datetime.strptime(args.get('end_time'), date_format))
 
-    if resource_type:
-        q = q.filter(Audit.resource.like("%{}%".format(resource_type)))
+    if args.get('user'):
+        q = q.filter(Audit.user == args.get('user'))
 
-    if resource_id:
-        q = q.filter(Audit.resource_id.like("%{}%".format(resource_id)))
+    if args.get('resource_type'):
+        q = q.filter(Audit.resource == args.get('resource_type'))
 
-    if operation:
-        q = q.filter(Audit.operation.like("%{}%".format(operation)))
+    if args.get('resource_id'):
+        q = q.filter(Audit.resource_id == args.get('resource_id'))
 
+    status = args.get('status') or args.get('result')
     if status:
-        q = q.filter(Audit.status.like("%{}%".format(result)))
+        q = q.filter(Audit.status == status)
+
+    if args.get('source_ip'):
+        q = q.filter(Audit.source_ip.like("{}%".format(args.get('source_ip'))))
+
+    if args.get('operation'):
+        q = q.filter(token_match('operation', args.get('operation')))
 
-    if message:
-        q = q.filter(Audit.message.like("%{}%".format(message)))
+    if args.get('message'):
+        q = q.filter(token_match('message', args.get('message')))
 
+    fq = args.get('fuzzy_query')
     if fq:
-        q = q.filter(Audit.name.concat(Audit.comment).like("%{}%".format(fq)))
+        q = q.filter(or_(token_match('operation', fq), token_match('message', fq)))
+    return q
 
+
+def _filter_archives(args):
+    """ the archives overlapping the time range of the filter arguments """
+    date_format = app.config.get("DATE_FORMAT")
+    return get_overlapped_archives(
+        datetime.strptime(args.get('start_time'), date_format) if args.get('start_time') else None,
+        datetime.strptime(args.get('end_time'), date_format) if args.get('end_time') else None)
+
+
+def get_audit_list(page, per_page, args):
+    """
+    Get the audit list, the archived months are only read when the time range overlaps them.
+    Archived audits are older than the audits in the audit table, so they follow the hot ones.
+    """
+    q = _filter_audits(args)
+    archives = _filter_archives(args)
     try:
-        return q.paginate(page=page, per_page=per_page)
+        if not archives:
+            return q.paginate(page=page, per_page=per_page)
+
+        total = q.order_by(None).count()
+        offset = (page - 1) * per_page
+        items = q.offset(offset).limit(per_page).all() if offset < total else []
+        offset = max(offset - total, 0)
+        match = match_archived_audit(args)
+        for archive in archives:
+            matched = count_archived(archive, match)
+            if len(items) < per_page and offset < matched:
+                items.extend(slice_archived(archive, match, matched, offset, per_page - len(items)))
+            offset = max(offset - matched, 0)
+            total += matched
+        return Pagination(None, page, per_page, total, items)
     except Exception as e:
         app.logger.error("Audit list failed: " + str(e))
         raise ResourcesNotFoundError("Audits")
 
 
 def audit_list_search(args):
-    source_ip = args.source_ip
-    resource_type = args.resource_type
-    resource_id = args.resource_id
-    operation = args.operation
-    status = args.status
-    message = args.message
-
-    q = Audit.query.filter_by(is_deleted=False).order_by(Audit.updated_at.desc())
-
-    if source_ip:
-        q = q.filter(Audit.source_ip.like("%{}%".format(source_ip)))
-
-    if resource_type:
-        q = q.filter(Audit.resource.like("%{}%".format(resource_type)))
-
-    if resource_id:
-        q = q.filter(Audit.resource_id.like("%{}%".format(resource_id)))
-
-    if operation:
-        q = q.filter(Audit.operation.like("%{}%".format(operation)))
-
-    if status:
-        q = q.filter(Audit.status.like("%{}%".format(result)))
-
-    if message:
-        q = q.filter(Audit.message.like("%{}%".format(message)))
-
+    """ Search the audits, the archived months overlapping the time range follow the hot ones """
+    q = _filter_audits(args)
     try:
-        return q.all()
+        audits = q.all()
+        match = match_archived_audit(args)
+        for archive in _filter_archives(args):
+            for records in iter_archived_desc(archive, match):
+                audits.extend(records)
+        return audits
     except Exception as e:
         app.logger.error("Audit list failed: " + str(e))
         raise ResourcesNotFoundError("Audits")
 
 
 def get_audit_user_list():
-    q = Audit.query.filter_by(is_deleted=False).order_by(Audit.updated_at.desc())
     try:
-        q_data = q.all()
+        return {'creator': audit_users.get()}
     except Exception as e:
         app.logger.error("Audit list failed: " + str(e))
         raise ResourcesNotFoundError("Audits")
-    return {'creator': set([obj.user for obj in q_data])}
 
 
 def get_audit_resource_list():
-    q = Audit.query.filter_by(is_deleted=False).order_by(Audit.updated_at.desc())
     try:
-        q_data = q.all()
+        return {'resource': audit_resources.get()}
     except Exception as e:
         app.logger.error("Audit list failed: " + str(e))
         raise ResourcesNotFoundError("Audits")
-    return {'resource': set([obj.resource for obj in q_data])}
 
 
 def get_audits_csv(args):
+    q = _filter_audits(args)
+    archives = _filter_archives(args)
+    return _stream_audits_csv(q, after_id=args.after_id, compress=args.gzip, archives=archives,
+                              match=match_archived_audit(args))
 
-    start_time = args.start_time
-    end_time = args.end_time
-    user = args.user
-    source_ip = args.source_ip
-    resource_type = args.resource_type
-    resource_id = args.resource_id
-    operation = args.operation
-    result = args.result
-    message = args.message
-
-    q = Audit.query.filter_by(is_deleted=False).order_by(Audit.updated_at.desc())
-
-    if user:
-        q = q.filter(Audit.user.like("%{}%".format(user)))
-
-    date_format = app.config.get("DATE_FORMAT")
-    if start_time:
-        start_time = datetime.strptime(start_time, date_format)
-        q = q.filter(Audit.created_at >= ("{}".format(start_time)))
-
-    if end_time:
-        end_time = datetime.strptime(end_time, date_format)
-        q = q.filter(Audit.updated_at <= ("{}".format(end_time)))
-
-    if source_ip:
-        q = q.filter(Audit.source_ip.like("%{}%".format(source_ip)))
 
-    if resource_type:
-        q = q.filter(Audit.resource.like("%{}%".format(resource_type)))
-
-    if resource_id:
-        q = q.filter(Audit.resource_id.like("%{}%".format(resource_id)))
-
-    if operation:
-        q = q.filter(Audit.operation.like("%{}%".format(operation)))
-
-    if result:
-        q = q.filter(Audit.operation_status.like("%{}%".format(result)))
-
-    if message:
-        q = q.filter(Audit.message.like("%{}%".format(message)))
-    try:
-        q_set = map(lambda item: item.to_dict(), q.all())
-        print 'q_set length is here --->>>', len(q_set)
-        keys = None
-        audit_list = list()
-        for audit in q_set:
-            if keys is None:
-                keys = audit.keys()
-            value_list = list()
-            for key in keys:
-                value = str(audit[key])
-                if ',' in value:
-                    value = value.replace(',', '，')
-                value_list.append(value.encode("GB18030", 'ignore'))
-            audit_list.append(",".join(value_list))
-        audit_list.insert(0, ",".join(keys))
-        for audit in audit_list:
-            yield audit + "\n"
-        # audit_csv = "\n".join(audit_list)
-        # return audit_csv
-    except Exception as e:
-        app.logger.error("Audit list failed: " + str(e))
-        raise ResourcesNotFoundError("Audits")
+def _to_csv_line(values):
+    value_list = list()
+    for value in values:
+        value = str(value)
+        if ',' in value:
+            value = value.replace(',', '，')
+        value_list.append(value.encode("GB18030", 'ignore'))
+    return ",".join(value_list) + "\n"
 
 
+def _stream_audits_csv(q, after_id=None, compress=False, archives=(), match=None):
+    """
+    Stream the queried audits as csv in constant memory. Audits are fetched in chunks
+    ordered by id desc, each chunk continues after the last id of previous chunk. The
+    archived audits follow, an archive chunk at a time.
+    Args:
+        q: the filtered audit query
+        after_id: resume the export after this audit id
+        compress: gzip the csv on the fly
+        archives: the archives overlapping the time range, ordered by month desc
+        match: the filter of archived audits
+    """
+    chunk_size = app.config.get('AUDIT_CSV_CHUNK_SIZE', 1000)
+    keys = Audit.__table__.columns.keys()
+    q = q.order_by(None).order_by(Audit.id.desc()). \
+        with_entities(*[getattr(Audit, key) for key in keys])
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+
+    def _output(data):
+        return compressor.compress(data) if compressor else data
+
+    yield _output(",".join(keys) + "\n")
+    resume_id = after_id
+    count = 0
+    while True:
+        chunk_q = q.filter(Audit.id < after_id) if after_id else q
+        try:
+            rows = chunk_q.limit(chunk_size).all()
+        except Exception as e:
+            # abort the response, a complete looking csv must not be truncated
+            app.logger.error("Audit list failed after audit {}: {}".format(after_id, e))
+            raise
+        if not rows:
+            break
+        count += len(rows)
+        after_id = rows[-1].id
+        yield _output("".join(_to_csv_line(row) for row in rows))
+    for archive in archives:
+        for records in iter_archived_desc(archive, match):
+            rows = [[record[key] for key in keys] for record in records if not resume_id or record['id'] < resume_id]
+            if not rows:
+                continue
+            count += len(rows)
+            after_id = rows[-1][keys.index('id')]
+            yield _output("".join(_to_csv_line(row) for row in rows))
+    if compressor:
+        yield compressor.flush()
+    app.logger.info("Download {} audits, the last audit id is {}".format(count, after_id))
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Monthly archival rollover of audits.
+
+The audit table only keeps the hot months. Each older month is written as compressed
+json-lines chunks ordered by audit id into audit_archive_chunk, then purged from the audit
+table, so every node reads the same archives. The audit_archive row of the month is the
+lock of its rollover: the run inserting it owns the month, renews it per chunk and releases
+it once the month is purged. The row of a dead run expires after AUDIT_ARCHIVE_LOCK_TIMEOUT
+and the next run takes the month over, writing it again or resuming its purge. Archived
+months are only read by the audit list, search and download whose time range overlaps them,
+a range without a start time overlaps all of them. The chunks of a readable month never
+change, so the audits matching a filter are counted per chunk once and kept in the worker,
+and a page of the list only decompresses the chunks it returns.
+"""
+import os
+import socket
+import uuid
+import zlib
+from datetime import datetime, timedelta
+
+from flask import current_app as app
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+from aops.applications.common.cache import LRUCache
+from aops.applications.database import db
+from aops.applications.database.apis.audit.audit_writer import _encode, _decode
+from aops.applications.database.models.audit.audit import Audit, AuditArchive, AuditArchiveChunk, audit_tokens
+
+WORKER = '{}:{}'.format(socket.gethostname(), os.getpid())
+READABLE = ('purging', 'archived')    # the chunks of the month are complete
+MATCH_KEYS = ('start_time', 'end_time', 'status', 'result', 'user', 'resource_type', 'resource_id', 'source_ip',
+              'operation', 'message', 'fuzzy_query')
+
+_chunk_counts = LRUCache(capacity=1024)    # {(archive id, month, last id, filter): [(seq, matched)]}
+
+
+def _month_start(time):
+    return datetime(time.year, time.month, 1)
+
+
+def _next_month(month):
+    return datetime(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def _previous_month(month):
+    return datetime(month.year - (month.month == 1), (month.month - 2) % 12 + 1, 1)
+
+
+def get_hot_start(now=None):
+    """ the first day of the oldest month kept in the audit table """
+    month = _month_start(now or datetime.now())
+    for _ in range(app.config.get('AUDIT_HOT_MONTHS', 3) - 1):
+        month = _previous_month(month)
+    return month
+
+
+def _iter_month_chunks(month, last_id=None):
+    """ iterate the audits of the month in chunks ordered by id """
+    chunk_size = app.config.get('AUDIT_CSV_CHUNK_SIZE', 1000)
+    keys = Audit.__table__.columns.keys()
+    q = Audit.query.with_entities(*[getattr(Audit, key) for key in keys]). \
+        filter(Audit.created_at >= month, Audit.created_at < _next_month(month)).order_by(Audit.id)
+    if last_id is not None:
+        q = q.filter(Audit.id <= last_id)
+    after_id = 0
+    while True:
+        rows = q.filter(Audit.id > after_id).limit(chunk_size).all()
+        if not rows:
+            break
+        after_id = rows[-1].id
+        yield [dict(zip(keys, row)) for row in rows]
+
+
+def _claim_month(month, token):
+    """ lock the rollover of the month, returns its archive, None if another run holds it """
+    now = datetime.now()
+    try:
+        # a core insert, the archive of another run may be loaded in the session already
+        db.session.execute(AuditArchive.__table__.insert(), {'month': month, 'status': 'writing', 'owner': token})
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        expires_at = now - timedelta(seconds=app.config.get('AUDIT_ARCHIVE_LOCK_TIMEOUT', 600))
+        taken = AuditArchive.query.filter(AuditArchive.month == month, AuditArchive.status != 'archived',
+                                          AuditArchive.updated_at < expires_at). \
+            update({'owner': token, 'updated_at': now}, synchronize_session=False)
+        db.session.commit()
+        if not taken:
+            return None
+    return AuditArchive.query.filter_by(month=month, owner=token).first()
+
+
+def _renew(archive, token, **values):
+    """ renew the lock of the archive in current transaction, False if it was taken over """
+    values['updated_at'] = datetime.now()
+    renewed = AuditArchive.query.filter_by(id=archive.id, owner=token).update(values, synchronize_session=False)
+    if not renewed:
+        db.session.rollback()
+        app.logger.warning('Archive of {:%Y-%m} was taken over by another run'.format(archive.month))
+    return bool(renewed)
+
+
+def _write_chunks(archive, token):
+    """ write the audits of the month into the chunks, returns (count, last_id), None if the lock is lost """
+    if not _renew(archive, token):
+        return None
+    # the chunks written by a dead run
+    AuditArchiveChunk.query.filter_by(archive_id=archive.id).delete(synchronize_session=False)
+    db.session.commit()
+    count, last_id = 0, 0
+    for seq, records in enumerate(_iter_month_chunks(archive.month)):
+        if not _renew(archive, token):
+            return None
+        db.session.execute(AuditArchiveChunk.__table__.insert(), {
+            'archive_id': archive.id, 'seq': seq,
+            'data': zlib.compress(''.join(_encode(record) + '\n' for record in records))})
+        db.session.commit()
+        count += len(records)
+        last_id = records[-1]['id']
+    return count, last_id
+
+
+def _purge_month(archive, token):
+    """ delete the archived audits of the month from the audit table, None if the lock is lost """
+    purged = 0
+    for records in _iter_month_chunks(archive.month, last_id=archive.last_id):
+        if not _renew(archive, token):
+            return None
+        ids = [record['id'] for record in records]
+        db.session.execute(audit_tokens.delete().where(audit_tokens.c.audit_id.in_(ids)))
+        Audit.query.filter(Audit.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        purged += len(ids)
+    return purged
+
+
+def _archive_month(month, token):
+    """ roll the month over under its lock, returns whether the month is archived by this run """
+    archive = _claim_month(month, token)
+    if archive is None:
+        return False
+    if archive.status == 'writing':
+        written = _write_chunks(archive, token)
+        if written is None:
+            return False
+        count, last_id = written
+        if not count:
+            AuditArchive.query.filter_by(id=archive.id, owner=token).delete(synchronize_session=False)
+            db.session.commit()
+            return False
+        if not _renew(archive, token, status='purging', count=count, last_id=last_id):
+            return False
+        db.session.commit()
+
+    purged = _purge_month(archive, token)
+    if purged is None or not _renew(archive, token, status='archived', owner=None):
+        return False
+    db.session.commit()
+    app.logger.info('Archive {} audits of {:%Y-%m}, purged {}'.format(archive.count, month, purged))
+    return True
+
+
+def archive_audits(now=None):
+    """
+    Roll the months before the hot window into archive chunks, a month left by a dead run is
+    taken over once its lock expired
+    Returns:
+        the archived months
+    """
+    hot_start = get_hot_start(now)
+    token = '{}:{}'.format(WORKER, uuid.uuid4().hex)
+    months = set(month for month, in db.session.query(AuditArchive.month).filter(
+        AuditArchive.month < hot_start, AuditArchive.status != 'archived'))
+    oldest = db.session.query(func.min(Audit.created_at)).filter(Audit.created_at < hot_start).scalar()
+    month = _month_start(oldest) if oldest else hot_start
+    while month < hot_start:
+        months.add(month)
+        month = _next_month(month)
+
+    archived = []
+    for month in sorted(months):
+        archive = AuditArchive.query.filter_by(month=month).first()
+        if archive is not None and archive.status == 'archived':
+            continue
+        if archive is None and not db.session.query(Audit.id).filter(
+                Audit.created_at >= month, Audit.created_at < _next_month(month)).first():
+            continue
+        if _archive_month(month, token):
+            archived.append(month)
+    return archived
+
+
+def get_overlapped_archives(start_time=None, end_time=None):
+    """ Get the archives overlapping the time range, ordered by month desc """
+    q = AuditArchive.query.filter(AuditArchive.status.in_(READABLE))
+    if start_time is not None:
+        q = q.filter(AuditArchive.month >= _month_start(start_time))
+    if end_time is not None:
+        q = q.filter(AuditArchive.month <= end_time)
+    return q.order_by(AuditArchive.month.desc()).all()
+
+
+def _load_chunk(archive, seq):
+    data, = db.session.query(AuditArchiveChunk.data).filter_by(archive_id=archive.id, seq=seq).one()
+    return [_decode(line) for line in zlib.decompress(data).splitlines() if line.strip()]
+
+
+def _iter_chunks(archive, reverse=False):
+    """ iterate (seq, archived audits) by chunk ordered by id, or by id desc if reverse """
+    seqs = db.session.query(AuditArchiveChunk.seq).filter_by(archive_id=archive.id). \
+        order_by(AuditArchiveChunk.seq.desc() if reverse else AuditArchiveChunk.seq)
+    for seq, in seqs.all():
+        records = _load_chunk(archive, seq)
+        yield seq, records[::-1] if reverse else records
+
+
+def _count_chunks(archive, match):
+    """ the number of matching audits of each chunk ordered by seq, counted once per filter """
+    key = (archive.id, archive.month, archive.last_id, match.key)
+    counts = _chunk_counts.get(key)
+    if counts is None:
+        counts = [(seq, sum(1 for record in records if match(record))) for seq, records in _iter_chunks(archive)]
+        _chunk_counts.set(key, counts)
+    return counts
+
+
+def iter_archived_desc(archive, match):
+    """ iterate the matching archived audits in chunks ordered by id desc, a chunk is never empty """
+    for _, records in _iter_chunks(archive, reverse=True):
+        records = [record for record in records if match(record)]
+        if records:
+            yield records
+
+
+def count_archived(archive, match):
+    """ the number of archived audits matching the filter """
+    return sum(count for _, count in _count_chunks(archive, match))
+
+
+def slice_archived(archive, match, matched, offset, limit):
+    """
+    Get the matching audits of the archive ordered by id desc, only the chunks holding them are
+    decompressed
+    Args:
+        archive: the audit archive
+        match: the filter of archived audits
+        matched: the number of matching audits counted by count_archived
+        offset: skip the newest audits
+        limit: the max number of audits returned
+    """
+    end = matched - offset
+    start = max(end - limit, 0)
+    records, index = [], 0
+    for seq, count in _count_chunks(archive, match):
+        if index < end and index + count > start:
+            chunk = [record for record in _load_chunk(archive, seq) if match(record)]
+            records.extend(chunk[max(start - index, 0):end - index])
+        index += count
+    return records[::-1]
+
+
+def match_archived_audit(args):
+    """ the filter of archived audits with the same arguments and semantics of the audit list """
+    date_format = app.config.get("DATE_FORMAT")
+    start_time = datetime.strptime(args.get('start_time'), date_format) if args.get('start_time') else None
+    end_time = datetime.strptime(args.get('end_time'), date_format) if args.get('end_time') else None
+    status = args.get('status') or args.get('result')
+
+    def _contains(value, text):
+        return text.lower() in (value or u'').lower()
+
+    def match(record):
+        if record['is_deleted']:
+            return False
+        if start_time and record['created_at'] < start_time or end_time and record['created_at'] > end_time:
+            return False
+        for key, field in [('user', 'user'), ('resource_type', 'resource'), ('resource_id', 'resource_id')]:
+            if args.get(key) and unicode(record[field]) != unicode(args.get(key)):
+                return False
+        if status and unicode(record['status']) != unicode(status):
+            return False
+        if args.get('source_ip') and not (record['source_ip'] or u'').startswith(args.get('source_ip')):
+            return False
+        for key in ('operation', 'message'):
+            if args.get(key) and not _contains(record[key], args.get(key)):
+                return False
+        fq = args.get('fuzzy_query')
+        return not fq or _contains(record['operation'], fq) or _contains(record['message'], fq)
+
+    match.key = tuple((key, unicode(args.get(key))) for key in MATCH_KEYS if args.get(key))
+    return match
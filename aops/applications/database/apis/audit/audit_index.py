@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Trigram token index over audit operation and message.
+
+Every word of the indexed fields is split into trigrams stored in audit_token. A substring
+search first narrows the candidate audits to those holding all selective trigrams of the
+searched words, then LIKE checks the candidates only. Trigrams held by too many audits
+don't narrow the search, they are skipped by their capped posting counts.
+"""
+import re
+
+from flask import current_app as app
+from sqlalchemy import and_, func
+
+from aops.applications.common.cache import LRUCache
+from aops.applications.database import db
+from aops.applications.database.models.audit.audit import Audit, audit_tokens
+
+TOKEN_FIELDS = ('operation', 'message')
+GRAM_SIZE = 3
+WORD_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+_token_counts = LRUCache(capacity=4096, ttl=600)
+
+
+def _to_unicode(value):
+    return value if isinstance(value, unicode) else str(value).decode('utf-8', 'ignore')
+
+
+def generate_grams(text):
+    """ the trigrams of every word in text """
+    grams = set()
+    for word in WORD_PATTERN.findall(_to_unicode(text).lower()):
+        for i in range(len(word) - GRAM_SIZE + 1):
+            grams.add(word[i:i + GRAM_SIZE])
+    return grams
+
+
+def index_audits(audits):
+    """
+    Add the tokens of audits into the index, the caller commits the session
+    Args:
+        audits: audit items with id
+    """
+    rows = []
+    for audit in audits:
+        for field in TOKEN_FIELDS:
+            value = getattr(audit, field)
+            if value:
+                rows.extend({'audit_id': audit.id, 'field': field, 'token': token} for token in generate_grams(value))
+    if rows:
+        db.session.execute(audit_tokens.insert(), rows)
+
+
+def _token_count(field, token, limit):
+    """ the number of audits holding the token, counted up to limit """
+    count = _token_counts.get((field, token))
+    if count is None:
+        postings = db.session.query(audit_tokens.c.audit_id). \
+            filter(audit_tokens.c.field == field, audit_tokens.c.token == token).limit(limit).subquery()
+        count = db.session.query(func.count()).select_from(postings).scalar()
+        _token_counts.set((field, token), count)
+    return count
+
+
+def token_match(field, text):
+    """
+    Criterion of audits whose field contains the text
+    Args:
+        field: operation or message
+        text: the searched text
+    """
+    like = getattr(Audit, field).like(u"%{}%".format(text))
+    limit = app.config.get('AUDIT_TOKEN_CANDIDATE_LIMIT', 20000)
+    grams = [gram for gram in generate_grams(text) if _token_count(field, gram, limit) < limit]
+    if not grams:    # words shorter than a trigram or too common can't be served by the index
+        return like
+    candidates = db.session.query(audit_tokens.c.audit_id). \
+        filter(audit_tokens.c.field == field, audit_tokens.c.token.in_(grams)). \
+        group_by(audit_tokens.c.audit_id). \
+        having(func.count(audit_tokens.c.token) == len(grams))
+    return and_(Audit.id.in_(candidates), like)
+
+
+def rebuild_audit_index(batch_size=1000):
+    """ Rebuild the token index of all audits, used for the audits created before the index """
+    db.session.execute(audit_tokens.delete())
+    last_id, count = 0, 0
+    while True:
+        audits = Audit.query.with_entities(Audit.id, Audit.operation, Audit.message). \
+            filter(Audit.id > last_id).order_by(Audit.id).limit(batch_size).all()
+        if not audits:
+            break
+        index_audits(audits)
+        db.session.commit()
+        last_id = audits[-1].id
+        count += len(audits)
+    return count
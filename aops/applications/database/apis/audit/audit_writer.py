@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Asynchronous batched writer for audit records.
+
+Audit records are put onto an in-process queue and drained by a background greenlet,
+which bulk-inserts them when the batch size or the flush interval is reached. When the
+db is unavailable, records are appended to a local spill file and replayed later.
+"""
+import atexit
+import glob
+import json
+import os
+import time
+from datetime import datetime
+
+import gevent
+from gevent.queue import Queue, Empty, Full
+
+from aops.applications.database import db
+from aops.applications.database.apis.audit.audit_index import index_audits
+from aops.applications.database.models.audit.audit import Audit
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+TIME_KEYS = ('created_at', 'updated_at')
+
+
+def _encode(record):
+    record = dict(record)
+    for key in TIME_KEYS:
+        record[key] = record[key].strftime(TIME_FORMAT)
+    return json.dumps(record)
+
+
+def _decode(line):
+    record = json.loads(line)
+    for key in TIME_KEYS:
+        record[key] = datetime.strptime(record[key], TIME_FORMAT)
+    return record
+
+
+class AuditWriter(object):
+    """ Drain audit records from the queue by a background greenlet of current worker """
+
+    def __init__(self):
+        self._app = None
+        self._queue = None
+        self._greenlet = None
+        self._last_replay = 0
+
+    @property
+    def running(self):
+        return self._greenlet is not None and not self._greenlet.dead
+
+    def start(self, app):
+        self._app = app
+        self._queue = Queue(maxsize=app.config.get('AUDIT_QUEUE_SIZE', 10000))
+        self._greenlet = gevent.spawn(self._run)
+        atexit.register(self.stop)
+        app.logger.info('Audit writer started in worker {}'.format(os.getpid()))
+
+    def stop(self):
+        """ Flush all queued records, called when the worker exits gracefully """
+        if not self.running:
+            return
+        timeout = self._app.config.get('AUDIT_STOP_TIMEOUT', 10)
+        try:
+            self._queue.put(None, timeout=timeout)
+            self._greenlet.join(timeout=timeout)
+        except Full:
+            self._greenlet.kill()
+        batch = []
+        while not self._queue.empty():
+            record = self._queue.get_nowait()
+            if record is not None:
+                batch.append(record)
+        if batch:
+            self._flush(batch)
+
+    def put(self, record):
+        try:
+            self._queue.put_nowait(record)
+        except Full:
+            self._app.logger.warning('Audit queue is full, spill the audit record')
+            self._spill([record])
+
+    def _run(self):
+        batch_size = self._app.config.get('AUDIT_BATCH_SIZE', 200)
+        flush_interval = self._app.config.get('AUDIT_FLUSH_INTERVAL', 1)
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = time.time() + flush_interval
+            while len(batch) < batch_size:
+                try:
+                    record = self._queue.get(timeout=max(deadline - time.time(), 0))
+                except Empty:
+                    break
+                if record is None:    # stopped by the worker
+                    stopping = True
+                    break
+                batch.append(record)
+            try:
+                if batch:
+                    self._flush(batch)
+                self._replay_spilled()
+            except Exception as e:
+                self._app.logger.error('Audit writer failed: {}'.format(e))
+
+    def _insert(self, records):
+        with self._app.app_context():
+            try:
+                audits = [Audit(**record) for record in records]
+                db.session.add_all(audits)
+                db.session.flush()    # assign ids for the token index
+                index_audits(audits)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+            finally:
+                db.session.remove()
+
+    def _flush(self, batch):
+        try:
+            self._insert(batch)
+            self._app.logger.debug('Flush {} audit records'.format(len(batch)))
+        except Exception as e:
+            self._app.logger.error('Flush {} audit records failed, spill them: {}'.format(len(batch), e))
+            self._spill(batch)
+
+    def _spill(self, records):
+        with open(self._app.config.get('AUDIT_SPILL_FILE'), 'a') as f:
+            f.write(''.join(_encode(record) + '\n' for record in records))
+
+    def _claim_spilled_files(self):
+        """ Rename the spill file and orphaned replay files of dead workers for current worker """
+        spill_file = self._app.config.get('AUDIT_SPILL_FILE')
+        orphan_age = self._app.config.get('AUDIT_SPILL_ORPHAN_AGE', 600)
+        prefix = '{}.{}.'.format(spill_file, os.getpid())
+        claimed = []
+        for path in [spill_file] + sorted(glob.glob(spill_file + '.*.replay')):
+            if path.startswith(prefix):
+                claimed.append(path)
+                continue
+            try:
+                if path != spill_file and time.time() - os.path.getmtime(path) < orphan_age:
+                    continue
+                target = '{}{}.replay'.format(prefix, int(time.time() * 1000000))
+                os.rename(path, target)
+                os.utime(target, None)
+                claimed.append(target)
+            except OSError:
+                continue    # not exist or claimed by another worker
+        return claimed
+
+    def _replay_spilled(self):
+        if time.time() - self._last_replay < self._app.config.get('AUDIT_REPLAY_INTERVAL', 30):
+            return
+        self._last_replay = time.time()
+        for path in self._claim_spilled_files():
+            with open(path, 'r') as f:
+                records = [_decode(line) for line in f if line.strip()]
+            if records:
+                self._insert(records)
+            os.remove(path)
+            self._app.logger.info('Replay {} spilled audit records from {}'.format(len(records), path))
+
+
+audit_writer = AuditWriter()
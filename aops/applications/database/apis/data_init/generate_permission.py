@@ -3,25 +3,49 @@
 from aops.applications.database.apis.user_permission.permission import create_permission
 
 
-def generate_permissions(api):
+def _iter_permissions(api):
     """
-    generate permissions based on Namespaces
+    iterate permissions based on Namespaces
 
     namespace_Method_resource
     eg: 'repository_get_projects'
 
+    Yields:
+        (namespace, resource, method, permission)
     """
-    namespaces = api.namespaces
-    permission_data = []
-    for namespace in namespaces:
+    for namespace in api.namespaces:
         namespace_name = namespace.name.split('/')[-1]
-        namespace_desc = namespace.description
         for res in namespace.resources:
             res_name = res[0].__name__
-            permission_list = [{"resource": namespace_name, "operation": m.lower() + '_' + res_name,
-                                "permission": namespace_name + '_' + m.lower() + '_' + res_name,
-                                "description": namespace_desc} for m in res[0].methods]
-            permission_data += permission_list
+            for m in res[0].methods:
+                yield namespace, res[0], m.lower(), namespace_name + '_' + m.lower() + '_' + res_name
+
+
+def generate_permissions(api):
+    """
+    generate permissions based on Namespaces
+
+    namespace_Method_resource
+    eg: 'repository_get_projects'
+
+    """
+    permission_data = [{"resource": namespace.name.split('/')[-1], "operation": method + '_' + resource.__name__,
+                        "permission": permission, "description": namespace.description}
+                       for namespace, resource, method, permission in _iter_permissions(api)]
 
     # app.logger.debug(permission_data)
     [create_permission(**permission) for permission in permission_data]
+
+
+def generate_permission_index(api):
+    """
+    generate the index from endpoint and function name to the required permission,
+    the resources' endpoints are bound when api.init_app runs
+
+    Returns:
+        {(endpoint, function_name): permission}, eg: {('/v1/repositories_projects', 'get'): 'repositories_get_projects'}
+    """
+    permission_index = {}
+    for namespace, resource, method, permission in _iter_permissions(api):
+        permission_index.setdefault((resource.endpoint, method), permission)
+    return permission_index
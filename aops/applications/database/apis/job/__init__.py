@@ -6,7 +6,15 @@ import time
 import json
 from datetime import date, datetime
 from flask import current_app
+from aops.applications.common.facet import Facet
 from aops.applications.database.apis.system.sysconfig.exchange_config import get_exchange_configs
+from aops.applications.database.models.job.job import Job, JobExecution
+
+creator_facets = {
+    Job: Facet('job_creator', Job, 'creator', scope=('business_group',)),
+    JobExecution: Facet('job_execution_creator', JobExecution, 'creator',
+                        scope=('business_group', 'execution_type')),
+}
 
 
 def get_creator_list(object, business_group, execution_type=None):
@@ -16,6 +24,11 @@ def get_creator_list(object, business_group, execution_type=None):
         all task creator
     """
 
+    facet = creator_facets.get(object)
+    scope = (business_group, execution_type) if execution_type else (business_group,)
+    if facet is not None and len(facet.scope) == len(scope):
+        return {'creator': facet.get(*scope)}
+
     if execution_type:
         q = object.query.filter_by(business_group=business_group, execution_type=execution_type).all()
     else:
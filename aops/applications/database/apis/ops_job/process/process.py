@@ -8,10 +8,12 @@ import datetime
 from flask import session, request
 from sqlalchemy.orm.exc import NoResultFound
 
+from aops.applications.common.facet import Facet
 from aops.applications.database.models import Process
 from aops.applications.database.apis import job as job_api
 from aops.applications.exceptions.exception import ResourcesNotFoundError, ResourceAlreadyExistError
 
+process_creators = Facet('process_creator', Process, 'creator', scope=('business_group',), is_deleted=False)
 
 
 def get_process_list(page, per_page, process_name=None, creator=None, start_time=None, end_time=None, job_id=None):
@@ -248,8 +250,6 @@ def copy_process(identifier, updated_info):
 def get_creator_list():
     business_group = request.cookies.get('BussinessGroup')
 
-    q = Process.query.filter_by(is_deleted=False, business_group=business_group)
-
-    creator_list = {'creator': set([obj.creator for obj in q])}
+    creator_list = {'creator': process_creators.get(business_group)}
     return creator_list
 
@@ -8,7 +8,7 @@ from flask import request, session
 from sqlalchemy.orm.exc import NoResultFound
 
 from aops.applications.common.scheduler_request import SchedulerApi
-from aops.applications.database.apis.resource.host.host import get_host_ips_with_ids
+from aops.applications.database.apis.resource.host.host import resolve_host_ips
 
 from aops.applications.database.models import ProcessExecution
 from aops.applications.database.apis.ops_job.process import process as process_api
@@ -228,12 +228,10 @@ def get_filter_list(execution_type):
     return process_names
 
 def _get_target_ip(process_info):
-    scheduling = []
-    for job in json.loads(process_info['scheduling']):
-        if 'target_ip' in job.keys():
-            target_ip = get_host_ips_with_ids(job['target_ip'].split(','))
-            job.update(target_ip=target_ip)
-        scheduling.append(job)
+    scheduling = json.loads(process_info['scheduling'])
+    jobs = [job for job in scheduling if 'target_ip' in job.keys()]
+    for job, target_ip in zip(jobs, resolve_host_ips([job['target_ip'].split(',') for job in jobs])):
+        job.update(target_ip=target_ip)
     return scheduling
 
 def execute_process(execution_type, process_info):
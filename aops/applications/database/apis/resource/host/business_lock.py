@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Cluster-wide locks of the business groups.
+
+A lock is a redis key set with NX, or a row of cmdb_sync_lock when redis isn't configured,
+taken and released in its own transaction so the session of the caller is left untouched.
+It expires after its timeout so a dead worker doesn't keep it. The lock of a business is
+held by the writes reconciling all its hosts, i.e. the CMDB syncs and the host imports; the
+inventory publish of a business has its own lock, named by INVENTORY_LOCK.
+"""
+import datetime
+import os
+import socket
+import uuid
+
+from flask import current_app as app
+from redis.exceptions import RedisError
+from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
+
+from aops.applications.common.cache import get_redis
+from aops.applications.database import db
+from aops.applications.database.models import CmdbSyncLock
+
+LOCK_KEY = 'aops:lock:{}'
+INVENTORY_LOCK = 'inventory:{}'
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+WORKER = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+def acquire_lock(name, timeout):
+    """
+    Acquire the lock without waiting
+    Args:
+        name: the business, or the name of another lock of the business
+        timeout: seconds the lock is held at most
+    Returns:
+        the token of the lock, None if the lock is held by others
+    """
+    token = '{}:{}'.format(WORKER, uuid.uuid4().hex)
+    redis = get_redis()
+    if redis is not None:
+        try:
+            return token if redis.set(LOCK_KEY.format(name), token, nx=True, ex=timeout) else None
+        except RedisError as e:
+            app.logger.warning(u'Lock {} failed: {}'.format(name, e))
+            return None
+
+    now = datetime.datetime.now()
+    expires_at = now + datetime.timedelta(seconds=timeout)
+    table = CmdbSyncLock.__table__
+    try:
+        with db.engine.begin() as connection:
+            taken = connection.execute(table.update().where(and_(table.c.business == name, table.c.expires_at < now)).
+                                       values(owner=token, expires_at=expires_at)).rowcount
+            if not taken:
+                connection.execute(table.insert(), {'business': name, 'owner': token, 'expires_at': expires_at})
+    except IntegrityError:
+        return None
+    return token
+
+
+def release_lock(name, token):
+    """ release the lock if it's still held by the token """
+    redis = get_redis()
+    if redis is not None:
+        try:
+            redis.eval(RELEASE_SCRIPT, 1, LOCK_KEY.format(name), token)
+        except RedisError as e:
+            app.logger.warning(u'Unlock {} failed: {}'.format(name, e))
+        return
+    table = CmdbSyncLock.__table__
+    with db.engine.begin() as connection:
+        connection.execute(table.delete().where(and_(table.c.business == name, table.c.owner == token)))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Periodic CMDB sync of the business groups.
+
+Every worker wakes each CMDB_SYNC_INTERVAL plus a random jitter and tries the businesses of
+CMDB_SYNC_BUSINESSES. A business is synced under its lock, see business_lock, which expires
+after CMDB_SYNC_LOCK_TIMEOUT so a dead worker doesn't keep it. The holder skips the business
+when its last run started within the interval, so the cluster syncs a business once per
+interval whatever the number of nodes and workers. Each sync records a CmdbSyncRun with its
+status, duration and counts.
+"""
+import datetime
+import time
+
+from flask import current_app as app
+from sqlalchemy import func
+
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host.business_lock import acquire_lock, release_lock, WORKER
+from aops.applications.database.apis.resource.host.host import sync_host_with_cmdb
+from aops.applications.database.models import CmdbSyncRun
+
+
+def _run_cmdb_sync(business, full=False, interval=None, login_name=None):
+    """ returns (run, synced hosts), see run_cmdb_sync """
+    token = acquire_lock(business, app.config.get('CMDB_SYNC_LOCK_TIMEOUT', 1800))
+    if token is None:
+        return None, None
+    try:
+        last = CmdbSyncRun.query.filter_by(business=business).order_by(CmdbSyncRun.id.desc()).first()
+        if interval and last and datetime.datetime.now() - last.created_at < datetime.timedelta(seconds=interval):
+            return None, None
+
+        run = CmdbSyncRun.create(business=business, full=full, status='running', worker=WORKER)
+        started = time.time()
+        try:
+            results = sync_host_with_cmdb(business, login_name or app.config.get('CMDB_SYNC_USER', 'aops'), full=full)
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(u'Sync hosts of {} with CMDB failed: {}'.format(business, e))
+            return run.update(status='failed', error=u'{}'.format(e), duration=time.time() - started), None
+        return run.update(status='success', duration=time.time() - started, added=len(results['added']),
+                          updated=len(results['updated']), deleted=len(results['deleted'])), results
+    finally:
+        release_lock(business, token)
+
+
+def run_cmdb_sync(business, full=False, interval=None, login_name=None):
+    """
+    Sync the business with CMDB under its lock and record the run
+    Args:
+        business: the business group
+        full: whether all instances are fetched, see sync_host_with_cmdb
+        interval: seconds, skip the business if its last run started within it
+        login_name: the user syncing the hosts, CMDB_SYNC_USER for the periodic sync
+    Returns:
+        the CmdbSyncRun, None if another worker holds the lock or the last run is recent
+    """
+    return _run_cmdb_sync(business, full=full, interval=interval, login_name=login_name)[0]
+
+
+def run_manual_cmdb_sync(business, login_name):
+    """
+    Sync all the instances of the business with CMDB for a user, under the lock of the periodic sync
+    Returns:
+        (the CmdbSyncRun, the synced hosts by sync_host_with_cmdb), (None, None) if another worker
+        holds the lock, the synced hosts are None if the sync failed
+    """
+    return _run_cmdb_sync(business, full=True, login_name=login_name)
+
+
+def sync_hosts_with_cmdb_by_interval():
+    """ sync the configured business groups with cmdb if they are due, returns the runs """
+    interval = app.config.get('CMDB_SYNC_INTERVAL', 300)
+    runs = []
+    for business in app.config.get('CMDB_SYNC_BUSINESSES', []):
+        run = run_cmdb_sync(business, interval=interval)
+        if run is not None:
+            runs.append(run)
+    return runs
+
+
+def get_last_cmdb_sync_runs():
+    """ Get the last run of each business, ordered by business """
+    last_ids = db.session.query(func.max(CmdbSyncRun.id)).group_by(CmdbSyncRun.business)
+    return CmdbSyncRun.query.filter(CmdbSyncRun.id.in_(last_ids)).order_by(CmdbSyncRun.business).all()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Dynamic host groups.
+
+A dynamic group has a rule instead of picked hosts, a json predicate over the host columns
+and the CMDB attributes, e.g. {"site": ["IDC1"], "qs": ["QS1", "QS2"]}: a host is a member
+when it holds one of the values of every key. The derived keys host_type, Virtual or Physical
+by the machine column, and os, Linux or Windows by the os column, are matched the same way.
+
+The members are computed by set operations. The ids of the live hosts holding each value of
+the rules are read by one indexed query per key and shared by the rules of the business; the
+sets of the values of a key are united and the unions of the keys intersected. The group_host
+links are then diffed with the members, so an unchanged group costs no write.
+
+After a sync, only the groups whose rules read one of the changed columns or attribute keys
+are recomputed. The members are group_host links like the picked hosts, so they are posted
+to the Scheduler inventory with the tree of the business.
+"""
+import datetime
+import json
+
+from flask import current_app as app
+from sqlalchemy import and_, func, not_, or_, select
+
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host.host_attribute import HOST_COLUMNS
+from aops.applications.database.models.resource.host import Group, Host, groupHost, host_attributes
+from aops.applications.exceptions.exception import ValidationError
+
+DERIVED_FIELDS = {'host_type': 'machine', 'os': 'os'}    # the derived keys and the columns they are derived from
+DERIVED_VALUES = {'host_type': ('Virtual', 'Physical'), 'os': ('Linux', 'Windows')}
+BATCH_SIZE = 500
+
+
+def _chunks(items, size=BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _derived_criteria(key, value):
+    """ the criteria of the hosts holding a value of a derived key """
+    if key == 'host_type':
+        return and_(Host.machine.isnot(None), Host.machine != '') if value == 'Virtual' else \
+            or_(Host.machine.is_(None), Host.machine == '')
+    windows = func.lower(Host.os).like('%windows%')
+    return windows if value == 'Windows' else and_(Host.os.isnot(None), not_(windows))
+
+
+def parse_rule(rule):
+    """
+    Validate the rule of a dynamic group
+    Args:
+        rule: {key: value or [values]} or its json, the keys are host columns, derived keys or attribute keys
+    Returns:
+        {key: [values]}, the values as the text stored by host_attribute
+    Raises:
+        ValidationError: the rule is malformed
+    """
+    if isinstance(rule, basestring):
+        try:
+            rule = json.loads(rule)
+        except ValueError:
+            raise ValidationError(u'the rule is not json: {}'.format(rule))
+    if not isinstance(rule, dict) or not rule:
+        raise ValidationError(u'the rule shall be an object of keys and values: {}'.format(rule))
+
+    parsed = {}
+    for key, value in rule.items():
+        values = value if isinstance(value, (list, tuple)) else [value]
+        if not key or not values or any(item is None or isinstance(item, (dict, list)) for item in values):
+            raise ValidationError(u'the values of {} shall be texts or numbers: {}'.format(key, value))
+        texts = sorted(set(item if isinstance(item, basestring) else json.dumps(item) for item in values))
+        if key in DERIVED_VALUES and not set(texts) <= set(DERIVED_VALUES[key]):
+            raise ValidationError(u'the values of {} shall be in {}'.format(key, DERIVED_VALUES[key]))
+        parsed[key] = texts
+    return parsed
+
+
+def rule_fields(rule):
+    """ the host columns and attribute keys read by a parsed rule """
+    return set(DERIVED_FIELDS.get(key, key) for key in rule)
+
+
+class HostSets(object):
+    """ The ids of the live hosts of a business holding each value of the rules, loaded by one query per key
+
+    Args:
+        business: the business of the hosts
+        rules: the parsed rules matched against the sets
+    """
+
+    def __init__(self, business, rules):
+        self.business = business
+        wanted = {}
+        for rule in rules:
+            for key, values in rule.items():
+                wanted.setdefault(key, set()).update(values)
+        self.sets = dict((key, self._load(key, values)) for key, values in wanted.items())
+
+    def _load(self, key, values):
+        live = and_(Host.business == self.business, Host.is_deleted.is_(False))
+        if key in DERIVED_FIELDS:
+            sets = {}
+            for value in values:
+                rows = db.session.execute(select([Host.id]).where(and_(live, _derived_criteria(key, value))))
+                sets[value] = set(id for id, in rows)
+            return sets
+        if key in HOST_COLUMNS:
+            column = getattr(Host, key)
+            query = select([Host.id, column]).where(and_(live, column.in_(sorted(values))))
+        else:
+            query = select([host_attributes.c.host_id, host_attributes.c.value]). \
+                select_from(host_attributes.join(Host, Host.id == host_attributes.c.host_id)). \
+                where(and_(live, host_attributes.c.key == key, host_attributes.c.value.in_(sorted(values))))
+        sets = {}
+        for id, value in db.session.execute(query):
+            sets.setdefault(value, set()).add(id)
+        return sets
+
+    def match(self, rule):
+        """ the ids of the hosts matching a parsed rule """
+        unions = sorted((set().union(*[self.sets[key].get(value, ()) for value in values])
+                         for key, values in rule.items()), key=len)
+        members = unions[0]
+        for ids in unions[1:]:
+            members &= ids
+        return members
+
+
+def _load_links(group_ids):
+    """ the linked host ids of each group, {group id: set of host ids} """
+    links = dict((group_id, set()) for group_id in group_ids)
+    for chunk in _chunks(list(group_ids)):
+        query = select([groupHost.c.group_id, groupHost.c.host_id]).where(groupHost.c.group_id.in_(chunk))
+        for group_id, host_id in db.session.execute(query):
+            links[group_id].add(host_id)
+    return links
+
+
+def _link_members(group_id, linked, members):
+    """ diff the group_host links of the group with its members, returns whether they changed """
+    removed = sorted(linked - members)
+    added = [{'host_id': id, 'group_id': group_id} for id in sorted(members - linked)]
+    for chunk in _chunks(removed):
+        db.session.execute(groupHost.delete().where(
+            and_(groupHost.c.group_id == group_id, groupHost.c.host_id.in_(chunk))))
+    for chunk in _chunks(added):
+        db.session.execute(groupHost.insert(), chunk)
+    return bool(removed or added)
+
+
+def _update_members(business, rules):
+    if not rules:
+        return []
+    host_sets = HostSets(business, [rule for _, rule in rules])
+    links = _load_links([group.id for group, _ in rules])
+    now = datetime.datetime.now()
+    changed = []
+    for group, rule in rules:
+        if _link_members(group.id, links[group.id], host_sets.match(rule)):
+            group.updated_at = now    # the tree of the business is invalidated by the update
+            changed.append(group)
+    db.session.commit()
+    app.logger.info('Recompute {} dynamic groups of {}, changed: {}'.format(
+        len(rules), business, [group.name for group in changed]))
+    return changed
+
+
+def update_group_members(group):
+    """ compute the members of a dynamic group, e.g. after its rule is set. Returns whether they changed """
+    return bool(_update_members(group.business, [(group, parse_rule(group.rule))]))
+
+
+def recompute_dynamic_groups(business, fields=None):
+    """
+    Recompute the members of the dynamic groups of the business whose rules read the changed fields
+    Args:
+        business: the business of the groups
+        fields: the changed host columns and attribute keys, None recomputes all the dynamic groups
+    Returns:
+        the groups whose members changed, published to scheduler by the caller
+    """
+    if fields is not None and not fields:
+        return []
+    groups = Group.query.filter(Group.business == business, Group.rule.isnot(None), Group.is_deleted.is_(False))
+    rules = [(group, parse_rule(group.rule)) for group in groups]
+    if fields is not None:
+        rules = [(group, rule) for group, rule in rules if rule_fields(rule) & set(fields)]
+    return _update_members(business, rules)
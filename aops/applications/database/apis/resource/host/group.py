@@ -6,12 +6,21 @@ import datetime
 import json
 
 from flask import current_app as app, request, session
-from sqlalchemy import desc
+from sqlalchemy import desc, func
+from sqlalchemy.orm import selectinload
 from sqlalchemy.orm.exc import NoResultFound
 
-from aops.applications.database.models.resource.host import Group, Host, GroupParameter as Parameter
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host.business_lock import acquire_lock, release_lock, INVENTORY_LOCK
+from aops.applications.database.apis.resource.host.dynamic_group import parse_rule, update_group_members, \
+    DERIVED_VALUES
+from aops.applications.database.apis.resource.host.group_path import get_ancestors
+from aops.applications.database.apis.resource.host.host_attribute import get_attribute_values
+from aops.applications.database.apis.resource.host.inventory import hash_inventory_tree, diff_inventory_tree, \
+    load_inventory_snapshot, save_inventory_snapshot, post_inventory
+from aops.applications.database.models.resource.host import Group, Host, GroupParameter as Parameter, \
+    InventoryDelta, GROUP_LIST, GROUP_INVENTORY
 from aops.applications.exceptions.exception import ResourceNotFoundError, ResourceAlreadyExistError
-from aops.applications.common.scheduler_request import SchedulerApi
 
 
 def _format_time(obj, key):
@@ -23,14 +32,16 @@ def _format_time(obj, key):
     return obj
 
 
-def get_group_list(group_name=None, business=None, fuzzy_query=None):
+def get_group_list(group_name=None, business=None, fuzzy_query=None, profile=GROUP_LIST):
     """
     Get all groups with filtered query
+    Args:
+        profile: the loader options of the relationships read from the groups
     Returns:
         group item list
     """
     results = []
-    groups = Group.query.filter_by(is_deleted=False). \
+    groups = Group.query.options(*profile).filter_by(is_deleted=False). \
         order_by(desc(Group.updated_at))
 
     # Precise query
@@ -64,7 +75,8 @@ def create_group(args):
     """
     Create a group with args
     Args:
-        args:dict which contain (pid, name, type, modified_by, host_ips, description, others)
+        args:dict which contain (pid, name, type, modified_by, host_ips, description, others, rule),
+            the hosts of a group with a rule are computed, see dynamic_group
 
     Returns:
         the created group
@@ -88,12 +100,16 @@ def create_group(args):
         'modified_by': login_name,
         'description': args.description
     }
-    if args.host_ids:    # args.host_ips shall be a list
+    if args.get('rule'):
+        data.update({'rule': json.dumps(parse_rule(args.rule))})
+    elif args.host_ids:    # args.host_ips shall be a list
         hosts = Host.query.filter(Host.id.in_(args.host_ids), Host.is_deleted.is_(False)).all()
         data.update({'hosts': hosts})
     if args.params:
         data.update({'params': [Parameter(**param) for param in args.params]})
     created_group = Group.create(**data)
+    if created_group.rule:
+        update_group_members(created_group)
 
     # sync hosts with scheduler to generate inventory.
     sync_updated_groups_with_scheduler({'updated': [created_group]})
@@ -131,7 +147,7 @@ def get_groups_with_pid(parent_identifier):
 
     """
     try:
-        children_groups = Group.query.filter_by(pid=parent_identifier, is_deleted=False).all()
+        children_groups = Group.query.options(*GROUP_LIST).filter_by(pid=parent_identifier, is_deleted=False).all()
         for group in children_groups:
             group.host_ips = [host.identity_ip for host in group.hosts]
     except NoResultFound:
@@ -144,7 +160,7 @@ def get_tree_groups(tree_pid, business):
     """ get tree groups"""
 
     app.logger.info('business Group in request cookies : {}'.format(business))
-    nodes = get_group_list(business=business)
+    nodes = get_group_list(business=business, profile=GROUP_INVENTORY)
     if not nodes:
         return []
     host_nodes = traverse_nodes_host(nodes)
@@ -207,10 +223,10 @@ def traverse_nodes_host(nodes):
             for host in node['hosts']:
                 if host.is_deleted:
                     break
-                host = _format_time(host.to_dict(), 'updated_at')
-                host['accounts'] = [account.to_dict() for account in host['accounts']]
-                host['params'] = [param.to_dict() for param in host['params']]
-                # del host['groups']
+                host_obj, host = host, _format_time(host.to_dict(), 'updated_at')
+                host['accounts'] = [account.to_dict() for account in host_obj.accounts]
+                host['params'] = [param.to_dict() for param in host_obj.params]
+                host.pop('groups', None)    # backref loaded by the session
                 host.update({'id': str(node['id']) + '_' + str(host['id']), 'pid': str(node['id'])})
                 traverse_nodes.append(host)
             del node['hosts']
@@ -250,7 +266,7 @@ def update_group_with_id(identifier, args):
     Update a group with identifier
     Args:
         identifier: ID for group item
-        args: update group with this info
+        args: update group with this info, an empty rule turns a dynamic group into a static one
 
     Returns:
         Just the group item with this ID.
@@ -266,13 +282,17 @@ def update_group_with_id(identifier, args):
         'description': args.description,
         'modified_by': login_name
     }
-    if args.host_ids:
+    if args.get('rule') is not None:
+        data.update({'rule': json.dumps(parse_rule(args.rule)) if args.rule else None})
+    if args.host_ids and not data.get('rule', group.rule):
         hosts = Host.query.filter(Host.id.in_(args.host_ids), Host.is_deleted.is_(False)).all()
         data.update({'hosts': hosts})
     if args.params:
         data.update({'params': [Parameter(**param) for param in args.params]})
 
     updated_group = group.update(**data)
+    if updated_group.rule:
+        update_group_members(updated_group)
 
     # sync hosts with scheduler to generate inventory.
     sync_updated_groups_with_scheduler({'updated': [updated_group]})
@@ -324,9 +344,9 @@ def delete_business_groups(businesses):
     return deleted_bs_groups
 
 
-def init_aops_all_host_group(business):
+def init_aops_all_host_group(business, login_name=None):
     """ create a ALL_HOST group for Aops"""
-    login_name = session.get('user_info').get('user')
+    login_name = login_name or session.get('user_info').get('user')
     ALL_HOST = 'ALL_HOST'
     data = {
         'type': 'group',
@@ -368,120 +388,14 @@ def init_cmdb_default_groups():
     return Group.create(**data)
 
 
-def _init_all_host_group(hosts, host_types, OSs, sites, cabinets):
-    basic = {
-        'type': 'group',
-        'business': '-',
-        'is_read_only': 1,
-        'modified_by': 'Admin',
-        'description': 'This is DEFAULT group'
-    }
-    data = basic.update({      # All host
-        'pid': 0,
-        'name': 'ALL HOST'
-    })
-    level_1 = Group.create(**data)
-
-    level_2 = []
-    for type in host_types:
-        data = basic.update({
-            'pid': level_1.id,
-            'name': type,
-            'description': 'This is DEFAULT group'
-        })
-        level_2.append(Group.create(**data))
-
-    level_3 = []
-    for group in level_2:
-        for os in OSs:
-            data = basic.update({
-                'pid': group.id,
-                'name': os
-            })
-            level_3.append(Group.create(**data))
-
-    level_4 = []
-    for group in level_3:
-        for site in sites:
-            data = basic.update({
-                'pid': group.id,
-                'name': site
-            })
-            level_4.append(Group.create(**data))
-
-    level_5 = []
-    for group in level_4:
-        for cabinet in cabinets:
-            data = basic.update({
-                'pid': group.id,
-                ''
-                'name': cabinet
-            })
-            level_5.append(Group.create(**data))
-
-    # map hosts for level_5 (host group)
-
-
-def add_host_into_group(tree_root_id, hosts):
-    pass
-
-
-def update_all_host_group():
-    """ update all host group after sync host again"""
-    pass
-
-
 def _get_group_classify(hosts):
-    results = {
-        'site': [],
-        'cabinet': [],
-        'xxs': [],
-        'qs': [],
-        'host_type': ['Virtual', 'Physical'],
-        'os': ['Linux', 'Windows']
-    }
-
-    for host in hosts:
-        if host.site:
-            results['site'].append(host.site)
-        if host.cabinet:
-            results['cabinet'].append(host.cabinet)
-        others = json.loads(host.others)
-        for item in others:
-            if item['key_en'] == 'xxs':
-                results['xxs'].append(item['value'])
-            elif item['key_en'] == 'qs':
-                results['qs'].append(item['value'])
-    for key, value in results.items():
-        results[key] = list(set(value))
+    values = get_attribute_values([host.id for host in hosts], ('site', 'cabinet', 'xxs', 'qs'))
+    results = dict((key, list(value)) for key, value in values.items())
+    results.update((key, list(values)) for key, values in DERIVED_VALUES.items())
 
     return results
 
 
-def _is_target_type(host, type):
-    return type == 'Virtual' and host.machine
-
-
-def _is_target_os(host, os_type):
-    return 'windows' in host.os.lower()
-
-
-def _is_target_site(host, site):
-    pass
-
-
-def _is_target_cabinet(host, site):
-    pass
-
-
-def _is_target_qs(host, site):
-    pass
-
-
-def _is_target_xxs(host, site):
-    pass
-
-
 #############################################
 #
 # ########################################
@@ -491,83 +405,174 @@ def _is_target_xxs(host, site):
 # ########################################
 #
 #############################################
-def sync_all_groups_with_scheduler(business):
-
+def sync_all_groups_with_scheduler(business, force=False):
+    """
+    Sync the inventory tree of the business with scheduler, only the subtrees changed since
+    the tree last acknowledged by scheduler are posted
+    Args:
+        business: the business of the tree
+        force: post the whole tree even if scheduler has acknowledged it
+    Returns:
+        the whole inventory tree
+    """
     tree_pid = '0'
-    nodes = get_group_list(business=business)
+    nodes = get_group_list(business=business, profile=GROUP_INVENTORY)
     host_nodes = traverse_nodes_host(nodes)
     inventory_nodes = _prepare_inventory_group(host_nodes)
     tree_group = create_tree_data(inventory_nodes, tree_pid)
 
-    data = {'tree-group': tree_group}
-    app.logger.info('Post all inventory hosts to scheduler, args: {}'.format(data))
-    headers = {'Content-Type': 'application/json;charset=utf-8'}
-    response = SchedulerApi('/v1/inventories/generate-hosts/').post(data=json.dumps(data), headers=headers)
-    app.logger.info('Post tree group hosts to scheduler, result: {}'.format(response))
+    hashes = hash_inventory_tree(tree_group)
+    snapshot = None if force else load_inventory_snapshot(business)
+    if snapshot is None:
+        response = post_inventory('/v1/inventories/generate-hosts/', {'tree-group': tree_group})
+        app.logger.info('Post tree group hosts to scheduler, result: {}'.format(response))
+    else:
+        changed = diff_inventory_tree(tree_group, hashes, snapshot)
+        if not changed:
+            app.logger.info('The inventory hosts of {} are not changed'.format(business))
+            return tree_group
+        response = post_inventory('/v1/inventories/update-hosts/', {'tree-group': changed})
+        app.logger.info('Post tree group hosts to scheduler, result: {}'.format(response))
+    save_inventory_snapshot(business, hashes)
 
     return tree_group
 
 
 def sync_updated_groups_with_scheduler(nodes):
-    """ sync updated tree groups when one group is updated/deleted/added
+    """ record the updated/deleted/added groups into the inventory outbox, they are published
+    to scheduler by the inventory publisher
     Args:
         nodes: {deleted:[0]/None, updated:[0]/None}
     """
-    tree_pid = '0'
-    if nodes.get('deleted'):
-        deleted_node = nodes.get('deleted')[0]
-        node = attach_state(deleted_node, is_deleted=1)
-        node.hosts = attach_states(node.hosts, is_deleted=1)
-    if nodes.get('updated'):
-        deleted_node = nodes.get('updated')[0]
-        node = attach_state(deleted_node, is_updated=1)
-        node.hosts = attach_states(node.hosts, is_updated=1)
-
-    if not node:
-        return []
-    tree_group = _generate_tree_group(tree_pid, [node])
+    record_inventory_deltas('group', nodes.get('updated'), 'update')
+    record_inventory_deltas('group', nodes.get('deleted'), 'delete')
 
-    data = {'tree-group': tree_group}
-    app.logger.info('Post updated inventory hosts to scheduler, args: {}'.format(data))
-    headers = {'Content-Type': 'application/json;charset=utf-8'}
-    response = SchedulerApi('/v1/inventories/update-hosts/').post(data=json.dumps(data), headers=headers)
-    app.logger.info('Post tree group hosts to scheduler, result: {}'.format(response))
 
-    return tree_group
+def sync_updated_hosts_with_scheduler(results):
+    """ record the updated hosts into the inventory outbox when import host accounts, host information,
+    sync cmdb or modify host, they are published to scheduler by the inventory publisher
+    Args:
+        results: {added: [...], updated: [...], deleted: [...]}
+    """
+    record_inventory_deltas('host', (results.get('added') or []) + (results.get('updated') or []), 'update')
+    record_inventory_deltas('host', results.get('deleted'), 'delete')
 
 
-def sync_updated_hosts_with_scheduler(results):
-    """sync updated tree hosts when import host accounts, host information, sync cmdb or modify host'"""
-    tree_groups = []
-    tree_pid = '0'
-    updated_hosts = []
-    deleted_hosts = []
-    if results.get('updated'):
-        updated_hosts.extend(results.get('updated'))
-    if results.get('added'):
-        updated_hosts.extend(results.get('added'))
-    if results.get('deleted'):
-        deleted_hosts.extend(results.get('deleted'))
-
-    if updated_hosts:
-        groups = get_related_groups_with_hosts(updated_hosts, is_updated=1)
-        # updated_hosts = attach_states(updated_hosts, is_updated=1)
-        updated_tree_group = _generate_tree_group(tree_pid, groups)
-        tree_groups.extend(updated_tree_group)
-
-    if deleted_hosts:
-        # deleted_hosts = attach_states(deleted_hosts, is_deleted=1)
-        groups = get_related_groups_with_hosts(updated_hosts, is_deleted=1)
-        deleted_tree_group = _generate_tree_group(tree_pid, groups)
-        tree_groups.extend(deleted_tree_group)
-
-    data = {'tree-group': tree_groups}
-    app.logger.info('Post updated inventory hosts to scheduler, args: {}'.format(data))
-    headers = {'Content-Type': 'application/json;charset=utf-8'}
-    response = SchedulerApi('/v1/inventories/update-hosts/').post(data=json.dumps(data), headers=headers)
-    app.logger.info('Post tree group hosts to scheduler, result: {}'.format(response))
-
-    return tree_groups
+def record_inventory_deltas(node_type, nodes, action):
+    """
+    Record the changed groups or hosts into the inventory outbox
+    Args:
+        node_type: group or host
+        nodes: the changed groups or hosts
+        action: update or delete
+    """
+    if not nodes:
+        return
+    for node in nodes:
+        db.session.add(InventoryDelta(business=node.business, node_type=node_type, node_id=node.id, action=action))
+    db.session.commit()
+
+
+def publish_inventory_deltas(now=None):
+    """
+    Publish the inventory deltas of each business which has been quiet for the debounce window,
+    or waited for the max delay, as one consolidated tree to scheduler. Each business is published
+    under its inventory lock, so the workers of the cluster don't post the same deltas.
+    Returns:
+        the number of published deltas
+    """
+    now = now or datetime.datetime.now()
+    debounce = datetime.timedelta(seconds=app.config.get('INVENTORY_DEBOUNCE', 2))
+    max_delay = datetime.timedelta(seconds=app.config.get('INVENTORY_MAX_DELAY', 10))
+    lock_timeout = app.config.get('INVENTORY_PUBLISH_LOCK_TIMEOUT', 300)
+    pending = db.session.query(InventoryDelta.business, func.min(InventoryDelta.created_at),
+                               func.max(InventoryDelta.created_at), func.max(InventoryDelta.id)). \
+        group_by(InventoryDelta.business).all()
+
+    published = 0
+    for business, first_at, last_at, last_id in pending:
+        if now - last_at < debounce and now - first_at < max_delay:
+            continue
+        token = acquire_lock(INVENTORY_LOCK.format(business), lock_timeout)
+        if token is None:
+            continue    # published by another worker
+        try:
+            deltas = InventoryDelta.query.filter(InventoryDelta.business == business,
+                                                 InventoryDelta.id <= last_id).order_by(InventoryDelta.id).all()
+            tree_group = _generate_delta_tree_group(deltas)
+            if tree_group:
+                app.logger.info('Post {} inventory deltas of {} to scheduler'.format(len(deltas), business))
+                response = post_inventory('/v1/inventories/update-hosts/', {'tree-group': tree_group})
+                app.logger.info('Post tree group hosts to scheduler, result: {}'.format(response))
+            # only the fetched ones, a delta of a lower id may be committed after the fetch
+            InventoryDelta.query.filter(InventoryDelta.id.in_([delta.id for delta in deltas])). \
+                delete(synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            # the deltas are kept for the next cycle, the other businesses are still published
+            db.session.rollback()
+            app.logger.error(u'Publish inventory deltas of {} failed: {}'.format(business, e))
+            continue
+        finally:
+            release_lock(INVENTORY_LOCK.format(business), token)
+        published += len(deltas)
+    return published
+
+
+def _state(action):
+    return {'is_update': 1, 'is_delete': 0} if action == 'update' else {'is_update': 0, 'is_delete': 1}
+
+
+def _generate_delta_tree_group(deltas):
+    """ generate one tree of the changed groups and hosts, the latest delta of a node wins """
+    group_actions, host_actions = {}, {}
+    for delta in deltas:
+        actions = group_actions if delta.node_type == 'group' else host_actions
+        actions[delta.node_id] = delta.action
+
+    groups = {}
+    if group_actions:
+        groups.update((group.id, group) for group in Group.query.filter(Group.id.in_(group_actions.keys())))
+    hosts = Host.query.options(selectinload('groups')).filter(Host.id.in_(host_actions.keys())).all() \
+        if host_actions else []
+    for host in hosts:
+        for group in host.groups:
+            if not group.is_deleted:
+                groups.setdefault(group.id, group)
+    missing = set(group_actions) - set(groups)
+    if missing:
+        app.logger.warning('Skip the inventory deltas of removed groups: {}'.format(list(missing)))
+    if not groups:
+        return []
+
+    host_nodes = []
+    nodes = get_parent_tree(groups.values())
+    for node in nodes:
+        group = Group.query.get(node['id'])    # loaded by get_parent_tree
+        action = group_actions.get(group.id)
+        if action:
+            node.update(_state(action))
+            changed_hosts = [(host, action) for host in group.hosts if action == 'delete' or not host.is_deleted]
+        elif group.id in groups:
+            changed_hosts = [(host, host_actions[host.id]) for host in group.hosts if host.id in host_actions]
+        else:
+            changed_hosts = []
+        for host, host_action in changed_hosts:
+            host_node = _format_time(host.to_dict(), 'updated_at')
+            host_node['accounts'] = [account.to_dict() for account in host.accounts]
+            host_node['params'] = [param.to_dict() for param in host.params]
+            host_node.update({'id': str(node['id']) + '_' + str(host.id), 'pid': str(node['id'])})
+            host_node.update(_state(host_action))
+            host_nodes.append(host_node)
+        node['id'] = str(node['id'])
+        node['pid'] = str(node['pid'])
+        node['params'] = [param.to_dict() for param in group.params]
+        node.pop('hosts', None)
+    inventory_nodes = _prepare_inventory_group(nodes + host_nodes)
+    if '0' not in [node['pid'] for node in inventory_nodes]:
+        app.logger.warning('Skip the inventory deltas without business root: {}'.format(deltas))
+        return []
+    return create_tree_data(inventory_nodes, '0')
 
 
 def _generate_tree_group(tree_pid, groups):
@@ -600,26 +605,19 @@ def get_parent_tree(nodes):
     """get all parent nodes tree by given nodes"""
     app.logger.debug('Get parent tree, args: {}'.format(nodes))
 
-    def get_parent_nodes(cur_node, result={}):
-        """ get a branch from current node to root node"""
-        if cur_node.pid == 0:
-            return
-        else:
-            parent_node = get_group_with_id(cur_node.pid)
-
-            if not result.get(parent_node.name):
-                result[parent_node.name] = parent_node
-            get_parent_nodes(parent_node, result)
-
-    result = {}
+    result = get_ancestors([node for node in nodes if node.path is not None], profile=GROUP_INVENTORY)
     for node in nodes:
-        get_parent_nodes(node, result)
-        if not result.get(node.name):
-            result[node.name] = node
-
-    parent_nodes = []
-    for key, value in result.items():
-        parent_nodes.append(value.to_dict())
+        # the groups created before their paths are built
+        cur_node = node
+        while cur_node.path is None and cur_node.id not in result:
+            result[cur_node.id] = cur_node
+            if cur_node.pid == 0:
+                break
+            cur_node = get_group_with_id(cur_node.pid)
+        if cur_node.path is not None and cur_node.id not in result:
+            result.update(get_ancestors([cur_node], profile=GROUP_INVENTORY))
+
+    parent_nodes = [dict(value.to_dict(), hosts=value.hosts, params=value.params) for value in result.values()]
 
     app.logger.debug('Get parent tree, results: {}'.format(parent_nodes))
     return parent_nodes
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Materialized path ancestry of groups.
+
+Each group keeps the ids from its business root down to itself in group.path, e.g.
+'/1/5/9/', which is indexed. The ancestors of a group are read by one primary key query,
+its descendants by one prefix query of the path. The path is written after a group is
+inserted, and rewritten for the whole subtree when a group moves to another parent.
+"""
+from flask import current_app as app
+from sqlalchemy import event, func, literal
+from sqlalchemy.orm.attributes import get_history, set_committed_value
+
+from aops.applications.database import db
+from aops.applications.database.models.resource.host import Group
+from aops.applications.exceptions.exception import ValidationError
+
+ROOT_PID = 0
+
+
+def _path_of(connection, group_id, pid):
+    if not pid or pid == ROOT_PID:
+        return '/{}/'.format(group_id)
+    table = Group.__table__
+    parent_path = connection.execute(db.select([table.c.path]).where(table.c.id == pid)).scalar()
+    if parent_path is None:
+        return None
+    return '{}{}/'.format(parent_path, group_id)
+
+
+@event.listens_for(Group, 'after_insert')
+def _after_insert(mapper, connection, target):
+    path = _path_of(connection, target.id, target.pid)
+    if path is None:
+        app.logger.warning('The path of group {} is unknown, run manage.py index_groups'.format(target.id))
+        return
+    table = Group.__table__
+    connection.execute(table.update().where(table.c.id == target.id).values(path=path))
+    set_committed_value(target, 'path', path)
+
+
+@event.listens_for(Group, 'after_update')
+def _after_update(mapper, connection, target):
+    if not get_history(target, 'pid').has_changes():
+        return
+    old_path = target.path
+    path = _path_of(connection, target.id, target.pid)
+    if path is None or old_path is None:
+        app.logger.warning('The path of group {} is unknown, run manage.py index_groups'.format(target.id))
+        return
+    if path.startswith(old_path):
+        raise ValidationError('Group {} can not be moved into its own subtree'.format(target.id))
+    table = Group.__table__
+    connection.execute(table.update().where(table.c.path.like(old_path + '%')).
+                       values(path=literal(path) + func.substr(table.c.path, len(old_path) + 1)))
+    set_committed_value(target, 'path', path)
+
+
+def get_ancestors(groups, profile=()):
+    """
+    Get the groups and all their ancestors by one query
+    Args:
+        groups: the group items
+        profile: the loader options of the relationships read from the groups
+    Returns:
+        {group id: group item}, including the given groups
+    """
+    ids = set()
+    for group in groups:
+        ids.add(group.id)
+        ids.update(group.ancestor_ids)
+    if not ids:
+        return {}
+    return dict((group.id, group) for group in Group.query.options(*profile).filter(Group.id.in_(ids)))
+
+
+def get_descendants(group, include_self=True, is_deleted=False):
+    """
+    Get the subtree of the group by one query
+    Args:
+        group: the root group item of the subtree
+        include_self: whether the root group is included
+        is_deleted: the is_deleted of the groups, None for all groups
+    Returns:
+        the group items of the subtree
+    """
+    q = Group.query.filter(Group.path.like(group.path + '%'))
+    if not include_self:
+        q = q.filter(Group.id != group.id)
+    if is_deleted is not None:
+        q = q.filter(Group.is_deleted.is_(is_deleted))
+    return q.all()
+
+
+def is_in_subtree(group, root):
+    """ whether the group is the root or one of its descendants """
+    return group.path is not None and root.path is not None and group.path.startswith(root.path)
+
+
+def rebuild_group_paths():
+    """ Rebuild the paths of all groups from their pids, used for the groups created before the path """
+    rows = db.session.query(Group.id, Group.pid).all()
+    pids = dict(rows)
+    paths = {}
+
+    def _path(group_id, visiting=()):
+        if group_id not in paths:
+            pid = pids.get(group_id)
+            if group_id in visiting:
+                raise ValidationError('The parents of group {} are a cycle'.format(group_id))
+            if not pid or pid not in pids:
+                paths[group_id] = '/{}/'.format(group_id)
+            else:
+                paths[group_id] = '{}{}/'.format(_path(pid, visiting + (group_id,)), group_id)
+        return paths[group_id]
+
+    for group_id, _ in rows:
+        Group.query.filter_by(id=group_id).update({'path': _path(group_id)}, synchronize_session=False)
+    db.session.commit()
+    return len(rows)
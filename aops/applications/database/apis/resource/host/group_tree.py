@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Materialized group trees of the host tree widgets.
+
+The tree of each business is serialized to json once and kept in redis and in the worker.
+Each business has a version in redis, bumped after a committed write of its groups, hosts,
+accounts or params; a bulk write bumps the version shared by all businesses. A tree kept in
+the worker is served as long as both versions are unchanged, so a hit costs one MGET and no
+serialization. Without redis, the versions are rows of group_tree_version instead, so a hit
+costs one indexed SELECT and the writes of a worker reach the trees kept by the others.
+"""
+from flask import current_app as app, has_app_context, json
+from redis.exceptions import RedisError
+from sqlalchemy import event
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.session import Session
+
+from aops.applications.common.cache import LRUCache, get_redis, read_version, bump_version
+from aops.applications.database.apis.resource.host.group import get_tree_groups, get_tree_ips
+from aops.applications.database.models.resource.host import Group, Host, GroupParameter, HostAccount, \
+    HostParameter, GroupTreeVersion
+
+TREE_KEY = 'aops:group-tree:{}'
+VERSION_KEY = 'aops:group-tree:version:{}'
+ALL_BUSINESSES = '*'
+TREE_MODELS = (Group, Host, GroupParameter, HostAccount, HostParameter)
+TREE_BUILDERS = {
+    'groups': get_tree_groups,
+    'ips': get_tree_ips,
+}
+
+_trees = LRUCache(capacity=64)    # {(kind, business): (version, tree_json)}
+
+
+def _version(redis, business):
+    values = redis.mget([VERSION_KEY.format(ALL_BUSINESSES), VERSION_KEY.format(business)])
+    return '{}.{}'.format(*[value or 0 for value in values])
+
+
+def _db_version(business):
+    return '{}.{}'.format(*read_version(GroupTreeVersion.__table__, [{'business': ALL_BUSINESSES},
+                                                                     {'business': business}]))
+
+
+def _bump_db_version(business):
+    bump_version(GroupTreeVersion.__table__, {'business': business})
+
+
+def get_tree_json(kind, business):
+    """
+    Get the serialized tree of the business
+    Args:
+        kind: groups, the tree of groups and hosts; ips, the tree of groups and host ips
+        business: the business of the tree
+    Returns:
+        the json of the tree
+    """
+    redis = get_redis()
+    if redis is None:
+        try:
+            version = _db_version(business)
+        except SQLAlchemyError as e:
+            app.logger.warning(u'Read {} tree version of {} failed: {}'.format(kind, business, e))
+            return json.dumps(TREE_BUILDERS[kind]('0', business))
+        cached = _trees.get((kind, business))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        tree_json = json.dumps(TREE_BUILDERS[kind]('0', business))
+        _trees.set((kind, business), (version, tree_json))
+        return tree_json
+
+    key = TREE_KEY.format(business)
+    try:
+        version = _version(redis, business)
+        cached = _trees.get((kind, business))
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        stored_version, tree_json = redis.hmget(key, [kind + ':version', kind])
+    except RedisError as e:
+        app.logger.warning(u'Read {} tree of {} failed: {}'.format(kind, business, e))
+        return json.dumps(TREE_BUILDERS[kind]('0', business))
+
+    if stored_version != version or tree_json is None:
+        tree_json = json.dumps(TREE_BUILDERS[kind]('0', business))
+        try:
+            redis.hmset(key, {kind + ':version': version, kind: tree_json})
+        except RedisError as e:
+            app.logger.warning(u'Save {} tree of {} failed: {}'.format(kind, business, e))
+    _trees.set((kind, business), (version, tree_json))
+    return tree_json
+
+
+def invalidate_tree(business):
+    """ drop the trees of the business, or of all businesses by ALL_BUSINESSES """
+    if business == ALL_BUSINESSES:
+        _trees.clear()
+    else:
+        for kind in TREE_BUILDERS:
+            _trees.pop((kind, business))
+    if not has_app_context():
+        return
+    redis = get_redis()
+    if redis is None:
+        try:
+            _bump_db_version(business)
+        except SQLAlchemyError as e:
+            app.logger.error(u'Invalidate tree of {} failed: {}'.format(business, e))
+        return
+    try:
+        redis.incr(VERSION_KEY.format(business))
+    except RedisError as e:
+        app.logger.error(u'Invalidate tree of {} failed: {}'.format(business, e))
+
+
+def _pending_changes(session):
+    return session.info.setdefault('group_tree_changes', set())
+
+
+def _business_of(target):
+    if isinstance(target, (Group, Host)):
+        return target.business
+    owner = target.__dict__.get('group' if isinstance(target, GroupParameter) else 'host')
+    return owner.business if owner is not None else ALL_BUSINESSES
+
+
+def _after_write(mapper, connection, target):
+    _pending_changes(object_session(target)).add(_business_of(target))
+
+
+def _after_bulk(context):
+    """ bulk updates and deletes, e.g. soft_delete_by, invalidate the trees of all businesses """
+    if issubclass(context.mapper.class_, TREE_MODELS):
+        _pending_changes(context.session).add(ALL_BUSINESSES)
+
+
+for model in TREE_MODELS:
+    for name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(model, name, _after_write)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_changes(session):
+    for business in session.info.pop('group_tree_changes', ()):
+        invalidate_tree(business)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('group_tree_changes', None)
+
+
+event.listen(Session, 'after_bulk_update', _after_bulk)
+event.listen(Session, 'after_bulk_delete', _after_bulk)
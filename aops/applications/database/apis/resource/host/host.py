@@ -5,44 +5,55 @@
 from flask import current_app as app, request, session
 import json
 import datetime
-from sqlalchemy import desc
+import time
+from sqlalchemy import desc, or_
 from sqlalchemy.orm.exc import NoResultFound
 
+from aops.applications.database import db
 from aops.applications.database.models import Host
 from aops.applications.database.models import Group
 from aops.applications.database.models import HostAccount, HostParameter
+from aops.applications.database.models.resource.host import groupHost, HOST_LIST, HOST_DETAIL
 from aops.applications.database.apis.resource.host.group import get_groups_with_pid,\
-    init_aops_all_host_group, sync_updated_hosts_with_scheduler, sync_all_groups_with_scheduler
+    init_aops_all_host_group, sync_updated_hosts_with_scheduler, sync_all_groups_with_scheduler, \
+    record_inventory_deltas
+from aops.applications.database.apis.resource.host.dynamic_group import recompute_dynamic_groups
+from aops.applications.database.apis.resource.host.group_path import get_descendants
+from aops.applications.database.apis.resource.host.host_attribute import load_host_others, changed_host_fields
+from aops.applications.database.apis.resource.host.host_sync import BulkHostSync, BulkAccountSync, \
+    load_cmdb_watermark, save_cmdb_watermark, is_full_sync_due, BATCH_SIZE
+from aops.applications.database.apis.resource.host.host_search import search_hosts
+from aops.applications.database.apis.resource.host.inventory import post_inventory
 from aops.applications.exceptions.exception import ResourceNotFoundError, ResourceAlreadyExistError
-from aops.conf.cmdb_config import BUSINESS_HOST_KEY_MAP, BUSINESS_HOST_KEYNAME_MAP, HOST_ACCOUNT_KEY_MAP
-from aops.applications.common.scheduler_request import SchedulerApi
-from aops.applications.lib.cmdb_api import get_host_list
+from aops.conf.cmdb_config import BUSINESS_HOST_KEY_MAP, BUSINESS_HOST_KEYNAME_MAP, HOST_ACCOUNT_KEY_MAP, \
+    CMDB_WATERMARK_FIELD
+from aops.applications.lib.cmdb_api import iter_host_pages
 
 
 def get_hosts_list(business=None, fuzzy_query=None):
     """
     Get all hosts items with query filter
+    Args:
+        business: the business of the hosts
+        fuzzy_query: the text searched in the name, ip, description and CMDB attributes by the host index
     Returns:
         host list
     """
-    """
-    Get all hosts items with query filter
-    Returns:
-        host list
-    """
-    hosts = Host.query.filter_by(is_deleted=False). \
+    hosts = Host.query.options(*HOST_LIST).filter_by(is_deleted=False). \
         order_by(desc(Host.updated_at))
 
     # Precise query
     if business:
         hosts = hosts.filter(Host.business.like("%{}%".format(business)))
 
-    # Fuzzy query example
-    if fuzzy_query:
-        fuzzy_str = ''.join([Host.name, Host.identity_ip, Host.description])
-        hosts = hosts.filter(fuzzy_str.like("%{}%".format(fuzzy_query)))
+    if not fuzzy_query:
+        return hosts.all()
 
-    return hosts.all()
+    ids = [host['id'] for host in search_hosts(fuzzy_query)]
+    found = []
+    for start in range(0, len(ids), BATCH_SIZE):
+        found.extend(hosts.filter(Host.id.in_(ids[start:start + BATCH_SIZE])))
+    return sorted(found, key=lambda host: host.updated_at, reverse=True)
 
 
 def create_host(args):
@@ -72,6 +83,8 @@ def create_host(args):
                        accounts=accounts,
                        params=params,
                        others=args.others)
+    record_inventory_deltas('group', recompute_dynamic_groups(host.business, changed_host_fields(None, host.to_dict())),
+                            'update')
 
     return host.to_dict()
 
@@ -89,11 +102,13 @@ def get_host_with_id(identifier):
           ResourceNotFoundError: host is not found
     """
     try:
-        host = Host.query.filter_by(id=identifier, is_deleted=False).one()
-        host.others = json.loads(host.others) if host.others else None
+        host = Host.query.options(*HOST_DETAIL).filter_by(id=identifier, is_deleted=False).one()
     except NoResultFound:
         raise ResourceNotFoundError('Host', identifier)
-    return host.to_dict()
+    others = load_host_others([host.id]).get(host.id)
+    if others is None and host.others:
+        others = json.loads(host.others)
+    return dict(host.to_dict(), others=others)
 
 
 def get_host_ips_with_business(business):
@@ -106,39 +121,107 @@ def get_host_ips_with_ids(ids):
     Args:
         ids: the list of group id ('1'), or host id ('1_1')
     """
-    host_ips = []
-    group_ids = []
-    host_ids = []
-    for id in ids:
-        if '_' not in str(id):  # query group
-            group_ids.append(int(id))
-        elif '_' in str(id):   # query host
-            host_ids.append(str(id).split('_')[1])
-
-    for id in group_ids:
-        group = Group.query.filter_by(id=int(id), is_deleted=False).first()
-        get_tree_host_ips(group, host_ips)
-
-    hosts = get_hosts_with_ids(host_ids)
-    for host in hosts:
-        if host.identity_ip:
-            host_ips.append(host.identity_ip)
+    return resolve_host_ips([ids])[0]
 
-    return list(set(host_ips))
 
+def resolve_host_ips(id_lists):
+    """
+    Resolve the lists of group ids and host ids into host ips, with a constant number of queries
+    for any number of lists, groups and subtree levels
+    Args:
+        id_lists: the lists of group id ('1'), or host id ('1_1')
+    Returns:
+        the deduplicated host ips of each list
+    """
+    parsed = []
+    for ids in id_lists:
+        group_ids, host_ids = [], []
+        for id in ids:
+            id = str(id).strip()
+            if not id:
+                continue
+            if '_' in id:   # query host
+                host_ids.append(int(id.split('_')[1]))
+            else:   # query group
+                group_ids.append(int(id))
+        parsed.append((group_ids, host_ids))
+
+    group_ips = _resolve_group_ips(set(id for group_ids, _ in parsed for id in group_ids))
+    all_host_ids = set(id for _, host_ids in parsed for id in host_ids)
+    host_ips = dict(db.session.query(Host.id, Host.identity_ip).
+                    filter(Host.id.in_(all_host_ids), Host.is_deleted.is_(False))) if all_host_ids else {}
+
+    results = []
+    for group_ids, host_ids in parsed:
+        ips = [ip for id in group_ids for ip in group_ips.get(id, [])]
+        ips.extend(host_ips[id] for id in host_ids if host_ips.get(id))
+        results.append(_unique(ips))
+    return results
 
-def get_tree_host_ips(node, ips=[]):
+
+def _unique(items):
+    seen = set()
+    return [item for item in items if not (item in seen or seen.add(item))]
+
+
+def _resolve_group_ips(group_ids):
+    """ the host ips of each group, the ones of its children if the group has no hosts """
+    if not group_ids:
+        return {}
+    groups = db.session.query(Group.id, Group.path). \
+        filter(Group.id.in_(group_ids), Group.is_deleted.is_(False)).all()
+    paths = [path for _, path in groups if path is not None]
+    children, group_hosts = {}, {}
+    if paths:
+        subtree = or_(*[Group.path.like(path + '%') for path in paths])
+        for id, pid in db.session.query(Group.id, Group.pid).filter(subtree, Group.is_deleted.is_(False)):
+            children.setdefault(pid, []).append(id)
+        q = db.session.query(groupHost.c.group_id, Host.identity_ip, Host.is_deleted). \
+            join(Host, Host.id == groupHost.c.host_id).join(Group, Group.id == groupHost.c.group_id).filter(subtree)
+        for id, ip, is_deleted in q:
+            group_hosts.setdefault(id, []).append(None if is_deleted else ip)
+
+    def _collect(id, ips):
+        if id in group_hosts:
+            ips.extend(ip for ip in group_hosts[id] if ip)
+        else:
+            for child in children.get(id, []):
+                _collect(child, ips)
+        return ips
+
+    results = {}
+    for id, path in groups:
+        if path is None:    # the groups created before their paths are built
+            results[id] = get_tree_host_ips(Group.query.get(id))
+        else:
+            results[id] = _collect(id, [])
+    return results
+
+
+def get_tree_host_ips(node, ips=None):
     """
+    Get the host ips of the group, the ones of its children if the group has no hosts
     Args:
      node: group node
-     host_ids: store the id list
+     ips: store the ip list
     """
-    if node.hosts:
-        ips.extend([host.identity_ip for host in node.hosts if not host.is_deleted])
-    else:
-        children = get_groups_with_pid(node.id)
-        for child in children:
-            get_tree_host_ips(child, ips)
+    ips = [] if ips is None else ips
+    children = {}
+    if node.path is not None:
+        for group in get_descendants(node, include_self=False):
+            children.setdefault(group.pid, []).append(group)
+
+    def _collect(group):
+        if group.hosts:
+            ips.extend([host.identity_ip for host in group.hosts if not host.is_deleted])
+        else:
+            if group.path is None:    # the groups created before their paths are built
+                children[group.id] = get_groups_with_pid(group.id)
+            for child in children.get(group.id, []):
+                _collect(child)
+
+    _collect(node)
+    return ips
 
 
 def get_host_with_ip(identity_ip):
@@ -180,7 +263,13 @@ def delete_host_with_id(identifier):
     Returns:
         Just the host item with this ID.
     """
-    return Host.soft_delete_by(id=identifier)
+    host = Host.query.get(identifier)
+    deleted = Host.soft_delete_by(id=identifier)
+    if host:
+        record_inventory_deltas('host', [host], 'delete')
+        record_inventory_deltas('group', recompute_dynamic_groups(host.business, changed_host_fields(
+            host.to_dict(), None)), 'update')
+    return deleted
 
 
 def update_host_with_id(identifier, host_info):
@@ -202,10 +291,13 @@ def update_host_with_id(identifier, host_info):
     host_info.update(id=identifier, accounts=accounts,
                      params=params, updated_at=datetime.datetime.now())
 
+    before = host.to_dict()
     updated_host = host.update(**host_info)
+    groups = recompute_dynamic_groups(host.business, changed_host_fields(before, host.to_dict()))
 
     # sync hosts with scheduler to generate inventory.
     sync_updated_hosts_with_scheduler({'updated': [host]})
+    record_inventory_deltas('group', groups, 'update')
 
     return updated_host
 
@@ -217,33 +309,46 @@ def update_host_with_id(identifier, host_info):
 ########################################
 def sync_host_accounts(host_accounts, business):
     """"
-    Sync hosts' accounts with db
+    Sync hosts' accounts with db, the accounts of each host are replaced in one transaction
 
     Args:
         host_acounts: a host account list , include host_name, ip, username, password
+    Returns:
+        the hosts whose accounts changed
     """
-    accounts = _prepare_host_accounts(host_accounts)
-    host_names = [account['host_name'] for account in accounts]
-    account_map = {}
-    for account in accounts:
-        host_name = account['host_name']
-        if host_name not in account_map:
-            account_map[host_name] = []
-        account_map[host_name].append(HostAccount(username=account['username'],
-                                                  password=account['password']))
-
-    hosts = Host.query.filter(Host.name.in_(host_names), Host.business == business).all()
-    updated_hosts = []
-    for host in hosts:
-        for account in host.accounts:
-            account.delete()
-        updated_host = host.update(accounts=account_map[host.name], updated_at=datetime.datetime.now())
-        updated_hosts.append(updated_host)
+    sync = BulkAccountSync(business)
+    sync.add(_prepare_host_accounts(host_accounts))
+    changed_ids = sync.commit()
+    hosts = db.session.query(Host.id, Host.name, Host.identity_ip).filter(Host.id.in_(changed_ids)) \
+        if changed_ids else []
+    return [{'id': id, 'name': name, 'identity_ip': identity_ip} for id, name, identity_ip in hosts]
 
-    # sync hosts with scheduler to generate inventory.
-    sync_updated_hosts_with_scheduler({'updated': updated_hosts})
 
-    return [{'id': host.id, 'name': host.name, 'identity_ip': host.identity_ip} for host in updated_hosts]
+def import_host_accounts(batches, business, progress=None):
+    """
+    Sync the accounts of the hosts with the rows of an imported file batch by batch, the accounts of
+    all the batches are committed at once, so a rotation is applied entirely or not at all
+    Args:
+        batches: the batches of the rows, see sync_host_accounts
+        business: the business of the hosts
+        progress: called with the number of rows and the counts after each batch
+    Returns:
+        {'updated': the number of hosts whose accounts changed, 'skipped': the number of invalid rows}
+    """
+    sync = BulkAccountSync(business)
+    skipped = 0
+    try:
+        for rows in batches:
+            accounts = [account for account in _prepare_host_accounts(rows)
+                        if account.get('host_name') and account.get('username') and account.get('password')]
+            skipped += len(rows) - len(accounts)
+            sync.add(accounts)
+            if progress:
+                progress(len(rows), {'skipped': skipped})
+    except Exception:
+        sync.rollback()
+        raise
+    return {'updated': len(sync.commit()), 'skipped': skipped}
 
 
 def _prepare_host_accounts(accounts):
@@ -268,15 +373,8 @@ def _prepare_host_accounts(accounts):
 def sync_hosts_info(file_hosts_info, business, login_name):
     """sync host information with db ,except accounts, according to BUSINESS GROUP"""
     file_hosts_info = _prepare_host_info(file_hosts_info, business, login_name)
-    results = _sync_host_with_db(file_hosts_info, business)
-
     # relate all hosts with all host group
-    if results['added'] or results['updated']:
-        hosts = []
-        hosts.extend(results['added'])
-        hosts.extend(results['updated'])
-        group = init_aops_all_host_group(business)
-        group.update(hosts=hosts)
+    results = _sync_host_with_db(file_hosts_info, business, group=init_aops_all_host_group(business, login_name))
 
     # sync hosts with scheduler to generate inventory.
     sync_all_groups_with_scheduler(business)
@@ -284,35 +382,101 @@ def sync_hosts_info(file_hosts_info, business, login_name):
     return _load_host_others(results)
 
 
-def sync_host_with_cmdb(business, login_name):
-    """ sync hosts with cmdb by RESTFUL API"""
-    results, count = get_host_list(business)
-    hosts_info = parse_hosts_info_from_cmdb(results, business)
-    hosts = _prepare_host_info(hosts_info, business, login_name)
-    app.logger.info('Hosts from cmdb: {}, {}'.format(hosts, len(hosts)))
-    results = _sync_host_with_db(hosts, business)
+def import_hosts_info(batches, business, login_name, progress=None):
+    """
+    Sync the hosts of the business with the rows of an imported file batch by batch, like sync_hosts_info.
+    Each batch is committed, the hosts missing from the file are deleted after the last batch. If a batch
+    fails, the hosts of the batches committed before are recorded into the inventory outbox for scheduler.
+    Args:
+        batches: the batches of the raw rows, see _prepare_host_info
+        business: the business of the hosts
+        login_name: the user modifying the hosts
+        progress: called with the number of rows and the counts after each batch
+    Returns:
+        {'added', 'updated', 'deleted', 'skipped'}, the numbers of hosts and of invalid rows
+    """
+    sync = BulkHostSync(business, group=init_aops_all_host_group(business, login_name))
+    skipped = 0
+    try:
+        for rows in batches:
+            hosts_info = [info for info in _prepare_host_info(rows, business, login_name)
+                          if info.get('name') and info.get('identity_ip')]
+            skipped += len(rows) - len(hosts_info)
+            sync.add(hosts_info)
+            sync.flush()
+            if progress:
+                progress(len(rows), {'added': len(sync.added_ids), 'updated': len(sync.updated_ids),
+                                     'skipped': skipped})
+    except Exception:
+        sync.rollback()
+        try:
+            sync.record_flushed_deltas()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(u'Record the imported hosts of {} for scheduler failed: {}'.format(business, e))
+        raise
+    results = sync.commit(load=False)
+    recompute_dynamic_groups(business, sync.changed_fields)
+
+    # sync hosts with scheduler to generate inventory.
+    sync_all_groups_with_scheduler(business)
+
+    return {'added': len(results['added']), 'updated': len(results['updated']),
+            'deleted': len(results['deleted']), 'skipped': skipped}
+
+
+def sync_host_with_cmdb(business, login_name, full=False):
+    """
+    Sync hosts with cmdb by RESTFUL API, each page of cmdb is synced as it arrives
+    Args:
+        business: the business of the hosts
+        login_name: the user modifying the hosts
+        full: whether all instances are fetched, otherwise only the instances updated since the
+            watermark are fetched until the full sync is due
+    Returns:
+        {'added': [...], 'updated': [...], 'deleted': [...]}
+    """
+    watermark = load_cmdb_watermark(business)
+    full = full or is_full_sync_due(watermark)
+    last_time = watermark.get('last_time')
+    condition = None if full else [{'field': CMDB_WATERMARK_FIELD, 'operator': '$gte', 'value': last_time}]
+    app.logger.info('Sync hosts of {} with cmdb, full: {}, watermark: {}'.format(business, full, last_time))
 
     # add the host into ALL_HOST_<business> group
-    if results['added'] or results['updated']:
-        hosts = []
-        hosts.extend(results['added'])
-        hosts.extend(results['updated'])
-        group = init_aops_all_host_group(business)
-        group.update(hosts=hosts)
+    sync = BulkHostSync(business, group=init_aops_all_host_group(business, login_name))
+    try:
+        for page in iter_host_pages(business, condition=condition):
+            times = [host[CMDB_WATERMARK_FIELD] for host in page if host.get(CMDB_WATERMARK_FIELD)]
+            last_time = max(times + [last_time]) if last_time else max(times or [None])
+            hosts_info = parse_hosts_info_from_cmdb(page, business)
+            sync.add(_prepare_host_info(hosts_info, business, login_name))
+    except Exception:
+        sync.rollback()
+        raise
+    results = sync.commit(delete_missing=full)
+    recompute_dynamic_groups(business, sync.changed_fields)    # posted with the tree below
+    save_cmdb_watermark(business, {'last_time': last_time,
+                                   'full_at': time.time() if full else watermark['full_at']})
 
     # sync hosts with scheduler to generate inventory.
-    sync_all_groups_with_scheduler(business)
+    if full or any(results.values()):
+        sync_all_groups_with_scheduler(business)
 
     return _load_host_others(results)
 
 
 def _load_host_others(sync_hosts):
+    """ the synced hosts with their attributes, the attributes of the deleted hosts are decoded from others """
+    others = load_host_others([host.id for hosts in sync_hosts.values() for host in hosts])
     results = {}
     for key, hosts in sync_hosts.items():
         results[key] = []
-        for host in hosts:
-            host = host.to_dict()
-            host['others'] = json.loads(host['others'])
+        for host_obj in hosts:
+            host = dict(host_obj.to_dict(), accounts=host_obj.accounts, params=host_obj.params)
+            if host_obj.id in others:
+                host['others'] = others[host_obj.id]
+            else:
+                host['others'] = json.loads(host['others']) if host['others'] else None
             results[key].append(host)
 
     return results
@@ -341,49 +505,12 @@ def parse_hosts_info_from_cmdb(hosts, business):
     return results
 
 
-def _sync_host_with_db(hosts_info, business=None):
-    results = {'added': [], 'deleted': [], 'updated': []}
-    file_hosts = [Host(**host_info) for host_info in hosts_info]
-    db_hosts = get_hosts_list(business=business)
-
-    file_host_names = [host['name'] for host in hosts_info]
-    db_host_names = [host.name for host in db_hosts]
-    file_hosts_map = dict(zip(file_host_names, file_hosts))
-    db_hosts_map = dict(zip(db_host_names, db_hosts))
-
-    common_host_names = list(set(file_host_names).intersection(set(db_host_names)))
-    added_host_names = list(set(file_host_names).difference(set(common_host_names)))
-    deleted_host_names = list(set(db_host_names).difference(set(common_host_names)))
-
-    app.logger.debug('db hosts map  ====> {}'.format(db_hosts_map))
-    app.logger.debug('file hosts map  ====> {}'.format(file_hosts_map))
-    # delete host
-    for (host_name, host) in db_hosts_map.items():
-        if host_name in deleted_host_names:
-            host.delete()
-            results['deleted'].append(host)
-
-    # update host
-    for (host_name, host) in file_hosts_map.items():
-        if host_name in db_host_names:   # update the db host
-            updated_info = {
-                'updated_at': datetime.datetime.now(),
-                'identity_ip': host.identity_ip,
-                'os': host.os,
-                'business': host.business,
-                'others': host.others
-            }
-            updated_host = db_hosts_map[host_name].update(**updated_info)
-            results['updated'].append(updated_host)
-
-    # add host
-    for (host_name, host) in file_hosts_map.items():
-        if host_name in added_host_names:
-            host.save()
-            results['added'].append(host)
-
-    app.logger.info('sync hosts with db  ====> {}'.format(results))
-
+def _sync_host_with_db(hosts_info, business=None, group=None):
+    """ sync the hosts with db in bulk, see sync_hosts_in_bulk, and recompute the dynamic groups of the changes """
+    sync = BulkHostSync(business, group=group)
+    sync.add(hosts_info)
+    results = sync.commit()
+    recompute_dynamic_groups(business, sync.changed_fields)
     return results
 
 
@@ -396,7 +523,7 @@ def _prepare_host_info(hosts_info, business, login_name):
     Returns:
         the parsed hosts information
     """
-    app.logger.info('Raw host information ====> {}'.format(hosts_info))
+    app.logger.debug('Raw host information ====> {}'.format(hosts_info))
 
     key_map = BUSINESS_HOST_KEY_MAP.get(business, None)
     key_name_map = BUSINESS_HOST_KEYNAME_MAP.get(business, None)
@@ -430,7 +557,7 @@ def _prepare_host_info(hosts_info, business, login_name):
 
         results.append(host_info)
 
-    app.logger.info('Converted host information ====> {}'.format(results))
+    app.logger.debug('Converted host information ====> {}'.format(results))
 
     return results
 
@@ -454,14 +581,11 @@ def sync_hosts_with_scheduler(sync_hosts):
     results['deleted'].extend(_prepare_inventory_hosts(sync_hosts.get('deleted')))
     results['updated'].extend(_prepare_inventory_hosts(sync_hosts.get('updated')))
 
-    app.logger.info('Post inventory hosts to scheduler, args: {}'.format(results))
-
     if not results['added'] and not results['deleted'] and not results['updated']:
         app.logger.info('NO sync inventory host with scheduler...')
         return None
 
-    headers = {'Content-Type': 'application/json;charset=utf-8'}
-    response = SchedulerApi('/v1/inventories/sync-hosts/').post(data=json.dumps(results), headers=headers)
+    response = post_inventory('/v1/inventories/sync-hosts/', results)
     app.logger.info('Post inventory hosts to scheduler, result: {}'.format(response))
 
     return response
@@ -505,18 +629,13 @@ def _prepare_inventory_hosts(aops_hosts):
 def _to_dict(host_obj):
     host = host_obj.to_dict()
     host['accounts'] = [{'username': account.username, 'password': account.password}
-                        for account in host['accounts']] if host.get('accounts') else []
+                        for account in host_obj.accounts]
 
     host['params'] = [{'name': param.name, 'value': param.value}
-                      for param in host['params']] if host.get('params') else []
+                      for param in host_obj.params]
 
     return host
 
 
-def sync_hosts_with_cmdb_by_interval():
-    """ sync hosts with cmdb by interval  polling"""
-    pass
-
-
 def sync_hosts_with_scheduler_by_message():
     pass
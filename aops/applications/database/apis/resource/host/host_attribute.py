@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Indexed CMDB attributes of hosts.
+
+The attributes of host.others, e.g. qs, xxs, app or the ips, are stored one row per host and
+key in host_attribute, the value as text with its type. The rows are indexed by key and
+value, so the hosts holding an attribute value and the counts of each value are read by
+index lookups instead of decoding the others of every host. The host columns, e.g. site and
+cabinet, are filtered and counted the same way.
+
+The rows are written with host.others: by the mapper events of the hosts written by the
+session, and by the bulk syncs with index_host_attributes. Values longer than the value
+column or json objects are kept in text, they are read back but not filtered.
+"""
+import json
+
+from sqlalchemy import and_, event, func, select
+from sqlalchemy.orm.attributes import get_history
+
+from aops.applications.database import db
+from aops.applications.database.models.resource.host import Host, host_attributes, HOST_LIST
+
+HOST_COLUMNS = ('business', 'os', 'site', 'cabinet', 'machine')    # the facets read from the host columns
+VALUE_SIZE = 255
+BATCH_SIZE = 500
+
+
+def _chunks(items, size=BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _value_type(value):
+    if isinstance(value, basestring):
+        return 'str'
+    if isinstance(value, bool):
+        return 'bool'
+    if isinstance(value, (int, long)):
+        return 'int'
+    if isinstance(value, float):
+        return 'float'
+    return 'json'
+
+
+def _attribute_rows(host_id, others):
+    """ the rows of the attributes in others, a json list of {'key_cn', 'key_en', 'value'} """
+    if isinstance(others, basestring):
+        try:
+            others = json.loads(others) if others else []
+        except ValueError:
+            others = []
+    rows, keys = {}, []
+    for item in others or []:
+        if not isinstance(item, dict) or not item.get('key_en'):
+            continue
+        value = item.get('value')
+        value_type = _value_type(value)
+        text = value if value_type == 'str' else json.dumps(value)
+        if item['key_en'] not in rows:
+            keys.append(item['key_en'])
+        row = {'host_id': host_id, 'key': item['key_en'], 'key_cn': item.get('key_cn'), 'value_type': value_type,
+               'value': None, 'text': None, 'position': keys.index(item['key_en'])}
+        if value_type != 'json' and len(text) <= VALUE_SIZE:
+            row['value'] = text
+        else:
+            row['text'] = text
+        rows[item['key_en']] = row
+    return [rows[key] for key in keys]
+
+
+def _attribute_texts(others):
+    return dict((row['key'], (row['value_type'], row['value'], row['text'])) for row in _attribute_rows(None, others))
+
+
+def changed_host_fields(before, after):
+    """
+    The host columns of HOST_COLUMNS and the attribute keys differing between two versions of a host
+    Args:
+        before: {column: value, 'others': json}, None for an added host
+        after: {column: value, 'others': json}, None for a deleted host
+    Returns:
+        set of the changed columns and keys
+    """
+    before, after = before or {}, after or {}
+    fields = set(column for column in HOST_COLUMNS if before.get(column) != after.get(column))
+    if before.get('others') != after.get('others'):
+        old, new = _attribute_texts(before.get('others')), _attribute_texts(after.get('others'))
+        fields.update(key for key in set(old) | set(new) if old.get(key) != new.get(key))
+    return fields
+
+
+def _attribute_value(row):
+    text = row.value if row.value is not None else row.text
+    return text if row.value_type == 'str' else json.loads(text)
+
+
+def _write_attributes(execute, hosts, replace=True):
+    if replace:
+        for chunk in _chunks([host_id for host_id, _ in hosts]):
+            execute(host_attributes.delete().where(host_attributes.c.host_id.in_(chunk)))
+    rows = [row for host_id, others in hosts for row in _attribute_rows(host_id, others)]
+    for chunk in _chunks(rows):
+        execute(host_attributes.insert(), chunk)
+
+
+def index_host_attributes(hosts, replace=True):
+    """
+    Write the attribute rows of the hosts, the caller commits the session
+    Args:
+        hosts: [(host id, others)], others is the json of host.others
+        replace: whether the former rows of the hosts are deleted, False for the inserted hosts
+    """
+    _write_attributes(db.session.execute, hosts, replace=replace)
+
+
+def delete_host_attributes(ids):
+    """ delete the attribute rows of the hosts, the caller commits the session """
+    for chunk in _chunks(list(ids)):
+        db.session.execute(host_attributes.delete().where(host_attributes.c.host_id.in_(chunk)))
+
+
+def load_host_others(ids):
+    """
+    Get the attributes of the hosts in the format of host.others
+    Args:
+        ids: the host ids
+    Returns:
+        {host id: [{'key_cn', 'key_en', 'value'}]} in the order of others, the hosts without attributes are missing
+    """
+    others = {}
+    for chunk in _chunks(list(ids)):
+        rows = db.session.query(host_attributes).filter(host_attributes.c.host_id.in_(chunk)). \
+            order_by(host_attributes.c.host_id, host_attributes.c.position)
+        for row in rows:
+            others.setdefault(row.host_id, []).append(
+                {'key_cn': row.key_cn, 'key_en': row.key, 'value': _attribute_value(row)})
+    return others
+
+
+def host_criteria(filters, business=None):
+    """
+    Criteria of the live hosts matching the filters
+    Args:
+        filters: {key: value or [values]}, the keys are host columns of HOST_COLUMNS or attribute keys
+        business: the business of the hosts
+    Returns:
+        the criteria list of Host queries
+    """
+    criteria = [Host.is_deleted.is_(False)]
+    if business:
+        criteria.append(Host.business == business)
+    for key, value in filters.items():
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        if key in HOST_COLUMNS:
+            criteria.append(getattr(Host, key).in_(values))
+            continue
+        holders = select([host_attributes.c.host_id]).where(
+            and_(host_attributes.c.key == key, host_attributes.c.value.in_(values)))
+        criteria.append(Host.id.in_(holders))
+    return criteria
+
+
+def filter_hosts(filters, business=None, page=1, per_page=100):
+    """
+    Get a page of the live hosts matching the filters
+    Args:
+        filters: {key: value or [values]}, see host_criteria
+        business: the business of the hosts
+        page: the page number
+        per_page: the number of hosts in a page
+    Returns:
+        the pagination of host dicts, others are read from the attributes
+    """
+    pagination = Host.query.options(*HOST_LIST).filter(*host_criteria(filters, business)).order_by(Host.id). \
+        paginate(page=page, per_page=per_page, error_out=False)
+    others = load_host_others([host.id for host in pagination.items])
+    pagination.items = [dict(host.to_dict(), others=others.get(host.id)) for host in pagination.items]
+    return pagination
+
+
+def _facet_query(key):
+    if key in HOST_COLUMNS:
+        column = getattr(Host, key)
+        return db.session.query(column, func.count(Host.id)).filter(column.isnot(None)).group_by(column)
+    value = host_attributes.c.value
+    return db.session.query(value, func.count(host_attributes.c.host_id)).select_from(host_attributes). \
+        join(Host, Host.id == host_attributes.c.host_id). \
+        filter(host_attributes.c.key == key, value.isnot(None)).group_by(value)
+
+
+def count_host_facets(keys, filters=None, business=None):
+    """
+    Count the live hosts of each value of the facets. The counts of a facet apply the filters
+    of the other facets, so the values of a filtered facet stay selectable.
+    Args:
+        keys: the facet keys, host columns of HOST_COLUMNS or attribute keys
+        filters: {key: value or [values]}
+        business: the business of the hosts
+    Returns:
+        {key: [{'value', 'count'}]}, by descending count
+    """
+    filters = filters or {}
+    facets = {}
+    for key in keys:
+        others = dict((name, value) for name, value in filters.items() if name != key)
+        counts = _facet_query(key).filter(*host_criteria(others, business)).all()
+        counts.sort(key=lambda item: (-item[1], item[0]))
+        facets[key] = [{'value': value, 'count': count} for value, count in counts]
+    return facets
+
+
+def get_attribute_values(ids, keys):
+    """
+    Get the distinct values of the keys among the hosts
+    Args:
+        ids: the host ids
+        keys: host columns of HOST_COLUMNS or attribute keys
+    Returns:
+        {key: set of values}
+    """
+    values = dict((key, set()) for key in keys)
+    columns = [key for key in keys if key in HOST_COLUMNS]
+    attributes = [key for key in keys if key not in HOST_COLUMNS]
+    for chunk in _chunks(list(ids)):
+        if columns:
+            for row in db.session.query(*[getattr(Host, key) for key in columns]).filter(Host.id.in_(chunk)):
+                for key, value in zip(columns, row):
+                    if value is not None:
+                        values[key].add(value)
+        if attributes:
+            rows = db.session.query(host_attributes.c.key, host_attributes.c.value).distinct(). \
+                filter(host_attributes.c.host_id.in_(chunk), host_attributes.c.key.in_(attributes),
+                       host_attributes.c.value.isnot(None))
+            for key, value in rows:
+                values[key].add(value)
+    return values
+
+
+def rebuild_host_attributes(batch_size=1000):
+    """ Rebuild the attribute rows of all hosts from host.others, used for the hosts synced before the table """
+    db.session.execute(host_attributes.delete())
+    last_id, count = 0, 0
+    while True:
+        hosts = db.session.query(Host.id, Host.others).filter(Host.id > last_id).order_by(Host.id). \
+            limit(batch_size).all()
+        if not hosts:
+            break
+        index_host_attributes(hosts, replace=False)
+        db.session.commit()
+        last_id = hosts[-1].id
+        count += len(hosts)
+    return count
+
+
+@event.listens_for(Host, 'after_insert')
+def _after_insert(mapper, connection, target):
+    if target.others:
+        _write_attributes(connection.execute, [(target.id, target.others)], replace=False)
+
+
+@event.listens_for(Host, 'after_update')
+def _after_update(mapper, connection, target):
+    if get_history(target, 'others').has_changes():
+        _write_attributes(connection.execute, [(target.id, target.others)])
+
+
+@event.listens_for(Host, 'before_delete')
+def _before_delete(mapper, connection, target):
+    connection.execute(host_attributes.delete().where(host_attributes.c.host_id == target.id))
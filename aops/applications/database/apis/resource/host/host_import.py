@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Imports of hosts and host accounts from uploaded files.
+
+An upload is saved and recorded as a HostImportJob, then imported by a greenlet, so the
+request returns at once and the progress is read from the job. The file is parsed as a
+stream of rows, validated and upserted in batches of HOST_IMPORT_BATCH_SIZE rows. Each batch
+updates the progress of the job, so a file of any size is imported in bounded memory and
+the greenlet yields to the requests of the worker between two batches.
+
+An import runs under the lock of its business, see business_lock, so it never interleaves
+with a CMDB sync or another import of the business. A job waits pending for the lock, up to
+HOST_IMPORT_TIMEOUT seconds.
+
+A failed import of hosts keeps the batches committed before, their hosts are published to
+scheduler by the inventory publisher. The hosts missing from a host file are only deleted
+once the whole file is imported, so importing the file again completes it. The accounts of
+an account file are committed at once after the last batch instead, so a rotation of the
+passwords is never applied to a part of the hosts only.
+
+The upload is deleted once its job is finished. A job left pending or running by a worker
+that died is failed when it is read after HOST_IMPORT_TIMEOUT seconds without progress. A
+job is only finished while it's still running, so a job failed that way is never
+overwritten.
+"""
+import datetime
+import os
+import time
+
+import gevent
+from flask import current_app as app
+
+from aops.applications.common.parser import CsvParser, TextParser
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host.business_lock import acquire_lock, release_lock
+from aops.applications.database.apis.resource.host.host import import_hosts_info, import_host_accounts
+from aops.applications.database.models import HostImportJob
+from aops.applications.exceptions.exception import ResourceNotFoundError
+
+PARSERS = {'infos': CsvParser, 'accounts': TextParser}
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def create_import_job(kind, business, path, filename, login_name):
+    """
+    Record the import of a saved upload
+    Args:
+        kind: infos, the hosts in a csv file; accounts, the host accounts in a txt file
+        business: the business of the hosts
+        path: the path of the saved upload
+        filename: the name of the upload
+        login_name: the user importing the file
+    Returns:
+        the pending HostImportJob
+    """
+    return HostImportJob.create(kind=kind, business=business, path=path, filename=filename, status='pending',
+                                created_by=login_name, size=PARSERS[kind](path).size)
+
+
+def _remove_upload(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        app.logger.warning(u'Remove the upload {} failed: {}'.format(path, e))
+
+
+def start_import_job(job):
+    """ import the file of the job in a greenlet """
+    gevent.spawn(_run_import_job, app._get_current_object(), job.id).start()
+    return job
+
+
+def _run_import_job(app, job_id):
+    with app.app_context():
+        run_import_job(HostImportJob.query.get(job_id))
+
+
+def _update_import_job(job, statuses, **kwargs):
+    """
+    Update the job only if it's still in one of the statuses, so a job failed as stalled by a worker
+    isn't finished by another and a finished job isn't failed as stalled
+    Returns:
+        whether the job is updated, the job is refreshed anyway
+    """
+    kwargs['updated_at'] = datetime.datetime.now()
+    updated = HostImportJob.query.filter(HostImportJob.id == job.id, HostImportJob.status.in_(statuses)). \
+        update(kwargs, synchronize_session=False)
+    db.session.commit()
+    db.session.refresh(job)
+    return bool(updated)
+
+
+def _acquire_business_lock(job):
+    """ wait for the lock of the business of the job, the job is kept pending meanwhile """
+    deadline = time.time() + app.config.get('HOST_IMPORT_TIMEOUT', 600)
+    while True:
+        token = acquire_lock(job.business, app.config.get('CMDB_SYNC_LOCK_TIMEOUT', 1800))
+        if token is not None or time.time() >= deadline:
+            return token
+        if not _update_import_job(job, ['pending']):
+            return None
+        gevent.sleep(app.config.get('HOST_IMPORT_LOCK_RETRY', 5))
+
+
+def run_import_job(job, batch_size=None):
+    """
+    Import the file of the job batch by batch under the lock of its business, the job is updated with
+    the progress after each batch
+    Args:
+        job: the pending HostImportJob
+        batch_size: the rows of a batch, HOST_IMPORT_BATCH_SIZE by default
+    Returns:
+        the finished job
+    """
+    token = _acquire_business_lock(job)
+    if token is None:
+        _remove_upload(job.path)
+        app.logger.error(u'Import {} of {} from {} failed: the business is locked'.format(job.kind, job.business,
+                                                                                        job.filename))
+        _update_import_job(job, ['pending'], status='failed',
+                           error=u'The hosts of {} are being synced or imported, try again later'.format(job.business))
+        return job
+    try:
+        return _run_locked_import_job(job, batch_size)
+    finally:
+        release_lock(job.business, token)
+
+
+def _run_locked_import_job(job, batch_size):
+    batch_size = batch_size or app.config.get('HOST_IMPORT_BATCH_SIZE', 500)
+    if not _update_import_job(job, ['pending'], status='running'):
+        return job    # failed as stalled meanwhile
+    parser = PARSERS[job.kind](job.path)
+    started = time.time()
+
+    def progress(rows, counts):
+        job.update(rows=job.rows + rows, offset=parser.offset, updated_at=datetime.datetime.now(), **counts)
+        gevent.sleep(0)
+
+    batches = _batches(parser.rows(), batch_size)
+    try:
+        if job.kind == 'infos':
+            results = import_hosts_info(batches, job.business, job.created_by, progress=progress)
+        else:
+            results = import_host_accounts(batches, job.business, progress=progress)
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(u'Import {} of {} from {} failed: {}'.format(job.kind, job.business, job.filename, e))
+        _update_import_job(job, ['running'], status='failed', error=u'{}'.format(e), duration=time.time() - started)
+        return job
+    finally:
+        _remove_upload(job.path)
+    app.logger.info(u'Import {} of {} from {}, results: {}'.format(job.kind, job.business, job.filename, results))
+    if not _update_import_job(job, ['running'], status='success', offset=parser.size,
+                              duration=time.time() - started, **results):
+        app.logger.warning(u'Import {} of {} from {} was {} already, its results are not recorded'.format(
+            job.kind, job.business, job.filename, job.status))
+    return job
+
+
+def get_import_job(identifier):
+    """
+    Get an import job with its progress, a job without progress for HOST_IMPORT_TIMEOUT seconds is failed
+    Raises:
+        ResourceNotFoundError: the job is not found
+    """
+    job = HostImportJob.query.get(identifier)
+    if job is None:
+        raise ResourceNotFoundError('HostImportJob', identifier)
+    timeout = app.config.get('HOST_IMPORT_TIMEOUT', 600)
+    if job.status in ('pending', 'running') and \
+            job.updated_at < datetime.datetime.now() - datetime.timedelta(seconds=timeout):
+        app.logger.error(u'Import {} of {} from {} stalled, failed'.format(job.kind, job.business, job.filename))
+        _remove_upload(job.path)
+        _update_import_job(job, ['pending', 'running'], status='failed',
+                           error=u'No progress for {} seconds, the import was interrupted'.format(timeout))
+    return job
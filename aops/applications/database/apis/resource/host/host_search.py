@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Trigram search index of the hosts kept in the worker.
+
+The name, ip, description and CMDB attributes of each live host are lowercased into one
+text, every field starting with FIELD_START and ending with FIELD_END, and each trigram of
+the text maps to the ids of the hosts containing it. A query is answered by intersecting the
+hosts of its trigrams and checking their texts, the markers make a prefix query of two
+characters indexed too. Only the substring queries shorter than a trigram scan the texts.
+
+The index is built at startup or by the first search. The ids of the hosts written by a
+committed session, or by the bulk syncs, are reloaded by the next search. With redis, the
+ids are appended to a change log shared by the workers: each write bumps a sequence and
+scores the ids by it, so a worker reloads the ids scored after the sequence it applied. A
+worker behind the trimmed part of the log, or a write of unknown hosts, rebuilds the index.
+Without redis, the log is the host_index_change table and the sequence is the single row
+of host_index_sequence, bumped in the transaction appending the ids. The bump locks the row
+until the commit, so the writes commit in the order of their sequence and a worker never
+applies a sequence before the smaller ones are committed.
+"""
+import heapq
+import json
+from array import array
+
+import gevent
+from flask import current_app as app, has_app_context
+from gevent.lock import BoundedSemaphore
+from redis.exceptions import RedisError
+from sqlalchemy import Column, event, func, select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import object_session
+from sqlalchemy.orm.persistence import BulkDelete
+from sqlalchemy.orm.session import Session
+from sqlalchemy.sql.visitors import iterate
+
+from aops.applications.common.cache import get_redis, read_version, bump_version
+from aops.applications.database import db
+from aops.applications.database.models.resource.host import Host, HostIndexChange, HostIndexSequence
+
+FIELD_START, FIELD_END = b'\x02', b'\x03'
+ALL_HOSTS = '*'
+SEQUENCE_KEY = 'aops:host-index:seq'
+CHANGES_KEY = 'aops:host-index:changes'
+FLOOR_KEY = 'aops:host-index:floor'
+SEQUENCE_ROW = {'id': 1}    # the row of host_index_sequence
+PUBLISH_SCRIPT = """
+local seq = redis.call('incr', KEYS[1])
+for i = 2, #ARGV do
+    if ARGV[i] == '*' then
+        redis.call('del', KEYS[2])
+        redis.call('set', KEYS[3], seq)
+    else
+        redis.call('zadd', KEYS[2], seq, ARGV[i])
+    end
+end
+local excess = redis.call('zcard', KEYS[2]) - tonumber(ARGV[1])
+if excess > 0 then
+    local trimmed = redis.call('zrange', KEYS[2], excess - 1, excess - 1, 'withscores')
+    redis.call('zremrangebyrank', KEYS[2], 0, excess - 1)
+    redis.call('set', KEYS[3], trimmed[2])
+end
+return seq
+"""
+BATCH_SIZE = 500
+INDEXED_COLUMNS = (Host.id, Host.business, Host.name, Host.identity_ip, Host.description, Host.others)
+
+
+def _to_unicode(value):
+    return value if isinstance(value, unicode) else str(value).decode('utf-8')
+
+
+def _trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+def _fields(row):
+    """ the searched values of the host row, the CMDB attributes are read from others """
+    fields = [row.name, row.identity_ip, row.description]
+    try:
+        others = json.loads(row.others) if row.others else []
+    except ValueError:
+        others = []
+    if isinstance(others, list):
+        fields.extend(item.get('value') for item in others if isinstance(item, dict))
+    return [_to_unicode(value).lower() for value in fields if value not in (None, '')]
+
+
+class HostSearchIndex(object):
+    """ The trigrams of the utf-8 host texts
+
+    The ids of each trigram are appended to an array, a host rewritten or removed leaves its
+    ids behind as stale, the checks of the texts skip them. The array of a trigram is compacted
+    once its stale ids are as many as the live ones.
+    """
+
+    def __init__(self):
+        self.hosts = {}    # {host id: (business, name, identity_ip, text)}
+        self.postings = {}    # {trigram: array of host ids}
+        self.stale = {}    # {trigram: count of the stale ids}
+
+    def __len__(self):
+        return len(self.hosts)
+
+    def put(self, row):
+        """ index the host row, replacing its former text """
+        text = b''.join(FIELD_START + field.encode('utf-8') + FIELD_END for field in _fields(row))
+        former = self.hosts.get(row.id)
+        former_grams = _trigrams(former[3]) if former is not None else set()
+        grams = _trigrams(text)
+        self.hosts[row.id] = (row.business, row.name, row.identity_ip, text)
+        for gram in grams - former_grams:
+            self.postings.setdefault(gram, array('i')).append(row.id)
+        self._forget(former_grams - grams)
+
+    def remove(self, host_id):
+        entry = self.hosts.pop(host_id, None)
+        if entry is not None:
+            self._forget(_trigrams(entry[3]))
+
+    def _forget(self, grams):
+        for gram in grams:
+            stale = self.stale[gram] = self.stale.get(gram, 0) + 1
+            if stale * 2 >= len(self.postings[gram]):
+                self._compact(gram)
+
+    def _compact(self, gram):
+        hosts = self.hosts
+        ids = sorted(set(host_id for host_id in self.postings[gram] if host_id in hosts and gram in hosts[host_id][3]))
+        if ids:
+            self.postings[gram] = array('i', ids)
+        else:
+            del self.postings[gram]
+        self.stale.pop(gram, None)
+
+    def _candidates(self, pattern):
+        """ the ids of the hosts holding the rarest trigram of the pattern, None if it has no trigram """
+        grams = _trigrams(pattern)
+        if not grams:
+            return None
+        postings = [self.postings.get(gram) for gram in grams]
+        if not all(postings):
+            return set()
+        return set(min(postings, key=len))
+
+    def search(self, query, business=None, prefix=False, limit=None):
+        """
+        Search the hosts by the query
+        Args:
+            query: the searched text, case insensitive
+            business: the business of the hosts, None for all businesses
+            prefix: whether a field starts with the query, or contains it
+            limit: the max count of the results, None for all of them
+        Returns:
+            [(host id, business, name, identity_ip)], the exact matches first, then the
+            prefix matches, each by name
+        """
+        query = _to_unicode(query).strip().lower().encode('utf-8')
+        if not query:
+            return []
+        head = FIELD_START + query
+        pattern = head if prefix else query
+        candidates = self._candidates(pattern)
+        if candidates is None:
+            candidates = self.hosts
+
+        hosts = self.hosts
+        exact, starts, contains = [], [], []
+        for host_id in candidates:
+            entry = hosts.get(host_id)
+            if entry is None or business is not None and entry[0] != business:
+                continue
+            text = entry[3]
+            if head in text:
+                (exact if head + FIELD_END in text else starts).append((entry[1], host_id))
+            elif not prefix and pattern in text:
+                contains.append((entry[1], host_id))
+
+        results = []
+        for matches in (exact, starts, contains):
+            if limit is None:
+                results.extend(sorted(matches))
+            elif len(results) < limit:
+                results.extend(heapq.nsmallest(limit - len(results), matches))
+        return [(host_id,) + hosts[host_id][:3] for _, host_id in results]
+
+
+_index = HostSearchIndex()
+_state = {'built': False, 'seq': None, 'stale': set()}
+_build_lock = BoundedSemaphore()
+
+
+def _redis():
+    return get_redis() if has_app_context() else None
+
+
+def build_host_index():
+    """ Build the index of all live hosts, e.g. at startup. Returns the count of the indexed hosts """
+    global _index
+    with _build_lock:
+        redis = _redis()
+        seq = None
+        if redis is not None:
+            try:
+                seq = int(redis.get(SEQUENCE_KEY) or 0)
+            except RedisError as e:
+                app.logger.warning(u'Read host index sequence failed: {}'.format(e))
+        elif has_app_context():
+            try:
+                seq = _db_sequence()
+            except SQLAlchemyError as e:
+                app.logger.warning(u'Read host index sequence failed: {}'.format(e))
+        _state['stale'] = set()    # the writes committed from now on are reloaded by the next search
+        index = HostSearchIndex()
+        rows = db.session.query(*INDEXED_COLUMNS).filter(Host.is_deleted.is_(False)).yield_per(BATCH_SIZE)
+        for count, row in enumerate(rows, 1):
+            index.put(row)
+            if count % BATCH_SIZE == 0:
+                gevent.sleep(0)    # let the requests of the worker run while the index is built
+        _index = index
+        _state.update(built=True, seq=seq)
+        app.logger.info('Build host search index of {} hosts'.format(len(index)))
+        return len(index)
+
+
+def _reload(ids):
+    ids = list(ids)
+    rows = {}
+    for start in range(0, len(ids), BATCH_SIZE):
+        chunk = ids[start:start + BATCH_SIZE]
+        q = db.session.query(*INDEXED_COLUMNS).filter(Host.id.in_(chunk), Host.is_deleted.is_(False))
+        rows.update((row.id, row) for row in q)
+    for host_id in ids:
+        if host_id in rows:
+            _index.put(rows[host_id])
+        else:
+            _index.remove(host_id)
+
+
+def _changes_since(redis, seq):
+    """ the ids changed since the applied sequence, ALL_HOSTS if the index must be rebuilt """
+    current, floor = redis.mget([SEQUENCE_KEY, FLOOR_KEY])
+    current, floor = int(current or 0), int(floor or 0)
+    if current == seq:
+        return current, set()
+    if seq is None or seq < floor or current < seq:
+        return current, ALL_HOSTS
+    ids = redis.zrangebyscore(CHANGES_KEY, seq + 1, current)
+    return current, set(int(host_id) for host_id in ids)
+
+
+def _db_sequence():
+    # read in the session, so the hosts and changes read next are as recent as the sequence
+    return read_version(HostIndexSequence.__table__, SEQUENCE_ROW, db.session.connection())
+
+
+def _db_changes_since(seq):
+    """ _changes_since read from the host_index_change table """
+    current = _db_sequence()
+    if current == seq:
+        return current, set()
+    first = db.session.query(func.min(HostIndexChange.seq)).scalar()
+    if seq is None or current < seq or first is None or first > seq + 1:
+        return current, ALL_HOSTS
+    ids = set(host_id for host_id, in db.session.query(HostIndexChange.host_id).filter(
+        HostIndexChange.seq > seq, HostIndexChange.seq <= current))
+    return current, ALL_HOSTS if None in ids else ids
+
+
+def _publish_db_changes(ids):
+    """ append the ids to the host_index_change table in its own transaction, it's called after the commit """
+    table = HostIndexChange.__table__
+    with db.engine.begin() as connection:
+        seq = bump_version(HostIndexSequence.__table__, SEQUENCE_ROW, connection)
+        connection.execute(table.insert(), [{'seq': seq, 'host_id': None if host_id == ALL_HOSTS else host_id}
+                                            for host_id in ids])
+        # keep the last HOST_INDEX_MAX_CHANGES ids at least, the ids of a sequence are trimmed together
+        floor = connection.execute(select([table.c.seq]).order_by(table.c.seq.desc(), table.c.id.desc()).
+                                   offset(app.config.get('HOST_INDEX_MAX_CHANGES', 10000) - 1).limit(1)).scalar()
+        if floor is not None:
+            connection.execute(table.delete().where(table.c.seq < floor))
+
+
+def refresh_host_index():
+    """ apply the writes committed since the last search, by this worker and by the others """
+    if _build_lock.locked():    # the running build reads the writes committed so far
+        _build_lock.wait()
+        return
+    if not _state['built']:
+        build_host_index()
+        return
+    stale, seq = _state['stale'], _state['seq']
+    redis = _redis()
+    if redis is not None or has_app_context():
+        try:
+            seq, changed = _changes_since(redis, seq) if redis is not None else _db_changes_since(seq)
+        except (RedisError, SQLAlchemyError) as e:
+            app.logger.warning(u'Read host index changes failed: {}'.format(e))
+            changed = set()
+        if changed == ALL_HOSTS:
+            build_host_index()
+            return
+        stale = stale | changed
+    if ALL_HOSTS in stale:
+        build_host_index()
+        return
+    _state.update(stale=set(), seq=seq)
+    if stale:
+        _reload(stale)
+
+
+def search_hosts(query, business=None, prefix=False, limit=None):
+    """
+    Search the live hosts by name, ip, description or CMDB attributes
+    Args:
+        query: the searched text, case insensitive
+        business: the business of the hosts, None for all businesses
+        prefix: whether a field starts with the query, or contains it
+        limit: the max count of the results, None for all of them
+    Returns:
+        [{'id', 'business', 'name', 'identity_ip'}], the exact matches first, then the prefix matches
+    """
+    refresh_host_index()
+    return [{'id': host_id, 'business': business, 'name': name, 'identity_ip': ip}
+            for host_id, business, name, ip in _index.search(query, business=business, prefix=prefix, limit=limit)]
+
+
+def invalidate_hosts(ids):
+    """ reload the hosts by the next search of every worker, ALL_HOSTS in the ids rebuilds the index """
+    ids = set(ids)
+    if not ids:
+        return
+    _state['stale'].update(ids)
+    if not has_app_context():
+        return
+    redis = _redis()
+    if redis is None:
+        try:
+            _publish_db_changes(ids)
+        except SQLAlchemyError as e:
+            app.logger.error(u'Publish host index changes failed: {}'.format(e))
+        return
+    try:
+        redis.eval(PUBLISH_SCRIPT, 3, SEQUENCE_KEY, CHANGES_KEY, FLOOR_KEY,
+                   app.config.get('HOST_INDEX_MAX_CHANGES', 10000), *ids)
+    except RedisError as e:
+        app.logger.error(u'Publish host index changes failed: {}'.format(e))
+
+
+def _pending_changes(session):
+    return session.info.setdefault('host_index_changes', set())
+
+
+def _after_write(mapper, connection, target):
+    _pending_changes(object_session(target)).add(target.id)
+
+
+def _after_bulk(context):
+    """ bulk updates, e.g. soft_delete_by, reload the hosts still matched by their criterion """
+    if not issubclass(context.mapper.class_, Host):
+        return
+    changes = _pending_changes(context.session)
+    criterion = context.query.whereclause
+    if isinstance(context, BulkDelete) or criterion is None:
+        changes.add(ALL_HOSTS)
+        return
+    updated = set(getattr(key, 'key', key) for key in dict(context.values))
+    if updated & set(element.key for element in iterate(criterion, {}) if isinstance(element, Column)):
+        changes.add(ALL_HOSTS)
+        return
+    changes.update(host_id for host_id, in context.query.with_entities(Host.id).autoflush(False))
+
+
+for name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Host, name, _after_write)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_changes(session):
+    changes = session.info.pop('host_index_changes', None)
+    if changes:
+        invalidate_hosts(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('host_index_changes', None)
+
+
+event.listen(Session, 'after_bulk_update', _after_bulk)
+event.listen(Session, 'after_bulk_delete', _after_bulk)
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Bulk synchronization of the hosts of a business from CMDB or an imported file.
+
+The stored hosts are read by one query of their synced columns and compared with the
+incoming ones by name: the new hosts are inserted, the changed hosts updated, the missing
+hosts deleted and the unchanged hosts skipped entirely. The changes are applied by batched
+INSERT/UPDATE/DELETE statements in one transaction, so a sync costs a few statements per
+batch instead of several round-trips per host. A host soft deleted before is revived
+instead of being inserted again, since the host names are unique.
+
+The incoming hosts may be added page by page, e.g. while CMDB is paged, only the hosts
+missing from all pages are deleted by the commit. The pages may be flushed as they are
+added, e.g. while a file is imported, so a failed sync keeps the pages flushed before.
+
+The accounts of the hosts are rotated the same way: the incoming accounts of each host are
+diffed with the stored ones, only the accounts gone are deleted and only the new ones are
+inserted, in one transaction with the inventory deltas of the hosts whose accounts changed.
+
+The CMDB sync of a business keeps a watermark in redis, or in the worker when redis isn't
+configured: the latest update time of the instances seen and the time of the last full
+sync. Between two full syncs, only the instances updated since the watermark are fetched
+and no host is deleted, the full sync reconciles the deleted instances.
+"""
+import datetime
+import time
+from collections import Counter
+from itertools import groupby
+
+from flask import current_app as app, has_app_context
+from redis.exceptions import RedisError
+from sqlalchemy import bindparam
+from sqlalchemy.exc import IntegrityError
+
+from aops.applications.common.cache import LRUCache, get_redis
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host.group_tree import invalidate_tree
+from aops.applications.database.apis.resource.host.host_attribute import index_host_attributes, \
+    changed_host_fields, HOST_COLUMNS
+from aops.applications.database.apis.resource.host.host_search import invalidate_hosts
+from aops.applications.database.models import Host, HostAccount, HostParameter, InventoryDelta
+from aops.applications.database.models.resource.application import AppHost
+from aops.applications.database.models.resource.host import groupHost, host_attributes, HOST_LIST
+from aops.applications.exceptions.exception import ValidationError
+
+SYNC_FIELDS = ('identity_ip', 'os', 'site', 'cabinet', 'machine', 'others')    # the columns compared and updated
+BATCH_SIZE = 500
+WATERMARK_KEY = 'aops:cmdb-watermark:{}'
+
+_watermarks = LRUCache(capacity=64)    # used when redis isn't configured
+
+
+def _chunks(items, size=BATCH_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _load_hosts(ids, profile=HOST_LIST):
+    hosts = []
+    for chunk in _chunks(ids):
+        hosts.extend(Host.query.options(*profile).filter(Host.id.in_(chunk)).all())
+    return hosts
+
+
+def _insert_hosts(hosts_info, now):
+    """ insert the hosts by executemany grouped by their keys, each batch shares the columns. Returns {name: id} """
+    table = Host.__table__
+    rows = [dict(info, created_at=now, updated_at=now, is_deleted=False) for info in hosts_info]
+    rows.sort(key=lambda row: sorted(row))
+    for _, same_keys in groupby(rows, key=lambda row: sorted(row)):
+        for chunk in _chunks(list(same_keys)):
+            db.session.execute(table.insert(), chunk)
+
+    ids = {}
+    for chunk in _chunks([info['name'] for info in hosts_info]):
+        ids.update((name, id) for id, name in db.session.query(Host.id, Host.name).filter(Host.name.in_(chunk)))
+    return ids
+
+
+def _update_hosts(changes, revive=False):
+    table = Host.__table__
+    values = dict((field, bindparam('b_' + field)) for field in SYNC_FIELDS)
+    values['updated_at'] = bindparam('b_updated_at')
+    if revive:
+        values.update(is_deleted=False, deleted_at=None, modified_by=bindparam('b_modified_by'))
+    statement = table.update().where(table.c.id == bindparam('b_id')).values(**values)
+    for chunk in _chunks(changes):
+        db.session.execute(statement, chunk)
+
+
+def _delete_hosts(ids):
+    """ delete the hosts with their links and attributes, the accounts and params are kept unlinked """
+    table = Host.__table__
+    for chunk in _chunks(ids):
+        db.session.execute(groupHost.delete().where(groupHost.c.host_id.in_(chunk)))
+        db.session.execute(AppHost.delete().where(AppHost.c.host_id.in_(chunk)))
+        db.session.execute(host_attributes.delete().where(host_attributes.c.host_id.in_(chunk)))
+        for model in (HostAccount, HostParameter):
+            db.session.execute(model.__table__.update().where(model.host_id.in_(chunk)).values(host_id=None))
+        db.session.execute(table.delete().where(table.c.id.in_(chunk)))
+
+
+def _link_hosts(group, ids):
+    """ add the hosts into the group unless they are in it already """
+    linked = set(id for id, in db.session.query(groupHost.c.host_id).filter(groupHost.c.group_id == group.id))
+    links = [{'host_id': id, 'group_id': group.id} for id in ids if id not in linked]
+    for chunk in _chunks(links):
+        db.session.execute(groupHost.insert(), chunk)
+
+
+def _detach(hosts):
+    """ keep the loaded deleted hosts readable after the commit """
+    for host in hosts:
+        for item in host.accounts + host.params:
+            db.session.expunge(item)
+        db.session.expunge(host)
+
+
+class BulkHostSync(object):
+    """ Sync the hosts of a business with the incoming hosts in one transaction
+
+    Args:
+        business: the business of the hosts
+        group: the group every synced host is added into, e.g. ALL_HOST of the business
+    """
+
+    def __init__(self, business, group=None):
+        self.business = business
+        self.group = group
+        self.now = datetime.datetime.now()
+        columns = [Host.id, Host.name, Host.is_deleted] + [getattr(Host, field) for field in SYNC_FIELDS]
+        self.stored = dict((row.name, row) for row in db.session.query(*columns).filter(Host.business == business))
+        self.seen = set()
+        self.added_ids, self.updated_ids, self.synced_ids = [], [], []
+        self.unflushed_ids = []    # the hosts written since the last flush, invalidated by the flush or the commit
+        self.changed_fields = set()    # the host columns and attribute keys changed, see dynamic_group
+
+    def add(self, hosts_info):
+        """ apply a page of the incoming hosts, the hosts seen before are ignored """
+        added, changed, revived, attributes, fields = [], [], [], [], set()
+        for info in hosts_info:
+            name = info['name']
+            if name in self.seen:
+                continue
+            self.seen.add(name)
+            row = self.stored.get(name)
+            if row is None:
+                added.append(info)
+                fields.update(changed_host_fields(None, info))
+                continue
+            change = dict(('b_' + field, info.get(field)) for field in SYNC_FIELDS)
+            change.update(b_id=row.id, b_updated_at=self.now, b_modified_by=info.get('modified_by'))
+            if row.is_deleted:
+                revived.append(change)
+                fields.update(changed_host_fields(None, info), HOST_COLUMNS)
+            elif any(getattr(row, field) != info.get(field) for field in SYNC_FIELDS):
+                changed.append(change)
+                fields.update(changed_host_fields(dict((field, getattr(row, field)) for field in SYNC_FIELDS),
+                                                  dict((field, info.get(field)) for field in SYNC_FIELDS)))
+            if row.others != info.get('others'):
+                attributes.append((row.id, info.get('others')))
+            self.synced_ids.append(row.id)
+
+        try:
+            ids = _insert_hosts(added, self.now) if added else {}
+            _update_hosts(changed)
+            _update_hosts(revived, revive=True)
+            index_host_attributes([(ids[info['name']], info.get('others')) for info in added], replace=False)
+            index_host_attributes(attributes)
+        except IntegrityError as e:
+            self.rollback()
+            raise ValidationError(e)
+        self.added_ids.extend(ids.values())
+        self.added_ids.extend(change['b_id'] for change in revived)
+        self.updated_ids.extend(change['b_id'] for change in changed)
+        self.unflushed_ids.extend(ids.values())
+        self.unflushed_ids.extend(change['b_id'] for change in revived + changed)
+        self.changed_fields.update(fields)
+
+    def flush(self):
+        """ commit the pages added so far, the hosts not seen are only deleted by commit """
+        try:
+            db.session.commit()
+        except IntegrityError as e:
+            self.rollback()
+            raise ValidationError(e)
+        if self.unflushed_ids:
+            invalidate_tree(self.business)
+            invalidate_hosts(self.unflushed_ids)
+            self.unflushed_ids = []
+
+    def commit(self, delete_missing=True, load=True):
+        """
+        Delete the hosts not seen and commit the sync
+        Args:
+            delete_missing: whether the hosts not seen are deleted, False if only the changed hosts are added
+            load: whether the added and updated hosts are loaded, False returns their ids, e.g. for large imports
+        Returns:
+            {'added': [host], 'updated': [host], 'deleted': [host]}, the unchanged hosts are skipped
+        """
+        deleted_ids = [row.id for name, row in self.stored.items()
+                       if delete_missing and not row.is_deleted and name not in self.seen]
+        deleted = _load_hosts(deleted_ids)
+        for host in deleted:
+            self.changed_fields.update(changed_host_fields(host.to_dict(), None))
+        try:
+            _delete_hosts(deleted_ids)
+            if self.group is not None:
+                _link_hosts(self.group, self.synced_ids + self.added_ids)
+            _detach(deleted)
+            db.session.commit()
+        except IntegrityError as e:
+            self.rollback()
+            raise ValidationError(e)
+        invalidate_tree(self.business)
+        invalidate_hosts(self.unflushed_ids + deleted_ids)
+        self.unflushed_ids = []
+
+        results = {
+            'added': _load_hosts(self.added_ids) if load else self.added_ids,
+            'updated': _load_hosts(self.updated_ids) if load else self.updated_ids,
+            'deleted': deleted,
+        }
+        app.logger.info('Sync hosts of {} with db, added: {}, updated: {}, deleted: {}, unchanged: {}'.format(
+            self.business, len(results['added']), len(results['updated']), len(deleted),
+            len(self.seen) - len(self.added_ids) - len(self.updated_ids)))
+        return results
+
+    def rollback(self):
+        db.session.rollback()
+
+    def record_flushed_deltas(self):
+        """ record the hosts of the flushed pages into the inventory outbox, e.g. when a later page failed """
+        unflushed = set(self.unflushed_ids)
+        ids = [id for id in self.added_ids + self.updated_ids if id not in unflushed]
+        deltas = [{'business': self.business, 'node_type': 'host', 'node_id': id, 'action': 'update',
+                   'created_at': self.now, 'updated_at': self.now, 'is_deleted': False} for id in ids]
+        for chunk in _chunks(deltas):
+            db.session.execute(InventoryDelta.__table__.insert(), chunk)
+        db.session.commit()
+        return ids
+
+
+def sync_hosts_in_bulk(hosts_info, business, group=None):
+    """
+    Sync the hosts of the business with the incoming hosts in one transaction
+    Args:
+        hosts_info: the host infos prepared by _prepare_host_info
+        business: the business of the hosts
+        group: the group every synced host is added into, e.g. ALL_HOST of the business
+    Returns:
+        {'added': [host], 'updated': [host], 'deleted': [host]}, the unchanged hosts are skipped
+    """
+    sync = BulkHostSync(business, group=group)
+    sync.add(hosts_info)
+    return sync.commit()
+
+
+class BulkAccountSync(object):
+    """ Replace the accounts of the hosts of a business with the incoming accounts in one transaction
+
+    Args:
+        business: the business of the hosts
+    """
+
+    def __init__(self, business):
+        self.business = business
+        self.now = datetime.datetime.now()
+        self.ids = {}    # {host name: host id or None}, the hosts looked up so far
+        self.incoming = {}    # {host id: [(username, password)]}, the accounts replacing those of the host
+
+    def add(self, host_accounts):
+        """ apply a page of the incoming accounts, {'host_name', 'username', 'password'} """
+        names = sorted(set(account['host_name'] for account in host_accounts) - set(self.ids))
+        for chunk in _chunks(names):
+            self.ids.update((name, None) for name in chunk)
+            self.ids.update((name, id) for id, name in db.session.query(Host.id, Host.name).filter(
+                Host.name.in_(chunk), Host.business == self.business))
+        for account in host_accounts:
+            host_id = self.ids[account['host_name']]
+            if host_id is not None:
+                self.incoming.setdefault(host_id, []).append((account['username'], account['password']))
+
+    def commit(self):
+        """
+        Diff the incoming accounts with the stored ones and commit the changes
+        Returns:
+            the ids of the hosts whose accounts changed, the unchanged hosts are skipped
+        """
+        stored = {}
+        for chunk in _chunks(sorted(self.incoming)):
+            query = db.session.query(HostAccount.id, HostAccount.host_id, HostAccount.username,
+                                     HostAccount.password).filter(HostAccount.host_id.in_(chunk))
+            for id, host_id, username, password in query.order_by(HostAccount.id):
+                stored.setdefault(host_id, []).append((id, (username, password)))
+
+        added, deleted_ids, changed_ids = [], [], []
+        for host_id, accounts in sorted(self.incoming.items()):
+            missing = Counter(accounts)
+            for id, account in stored.get(host_id, []):
+                if missing[account] > 0:
+                    missing[account] -= 1
+                else:
+                    deleted_ids.append(id)
+            new = []
+            for username, password in accounts:
+                if missing[(username, password)] > 0:
+                    missing[(username, password)] -= 1
+                    new.append({'host_id': host_id, 'username': username, 'password': password,
+                                'created_at': self.now, 'updated_at': self.now, 'is_deleted': False})
+            if new or len(stored.get(host_id, [])) != len(accounts):
+                changed_ids.append(host_id)
+            added.extend(new)
+
+        deltas = [{'business': self.business, 'node_type': 'host', 'node_id': id, 'action': 'update',
+                   'created_at': self.now, 'updated_at': self.now, 'is_deleted': False} for id in changed_ids]
+        try:
+            for chunk in _chunks(deleted_ids):
+                db.session.execute(HostAccount.__table__.delete().where(HostAccount.__table__.c.id.in_(chunk)))
+            for chunk in _chunks(added):
+                db.session.execute(HostAccount.__table__.insert(), chunk)
+            for chunk in _chunks(changed_ids):
+                db.session.execute(Host.__table__.update().where(Host.__table__.c.id.in_(chunk)).values(
+                    updated_at=self.now))
+            for chunk in _chunks(deltas):
+                db.session.execute(InventoryDelta.__table__.insert(), chunk)
+            db.session.commit()
+        except IntegrityError as e:
+            self.rollback()
+            raise ValidationError(e)
+        if changed_ids:
+            invalidate_tree(self.business)
+            invalidate_hosts(changed_ids)
+        app.logger.info('Sync host accounts of {} with db, hosts: {}, changed: {}, accounts added: {}, '
+                        'deleted: {}'.format(self.business, len(self.incoming), len(changed_ids), len(added),
+                                             len(deleted_ids)))
+        return changed_ids
+
+    def rollback(self):
+        db.session.rollback()
+
+
+def load_cmdb_watermark(business):
+    """ the watermark of the CMDB sync, {'last_time': the latest update time, 'full_at': timestamp} or {} """
+    redis = get_redis() if has_app_context() else None
+    if redis is None:
+        return _watermarks.get(business) or {}
+    try:
+        watermark = redis.hgetall(WATERMARK_KEY.format(business))
+    except RedisError as e:
+        app.logger.warning(u'Read CMDB watermark of {} failed: {}'.format(business, e))
+        return {}
+    if not watermark.get('full_at'):
+        return {}
+    return {'last_time': watermark.get('last_time') or None, 'full_at': float(watermark['full_at'])}
+
+
+def save_cmdb_watermark(business, watermark):
+    """ remember the watermark after a committed sync """
+    timeout = app.config.get('CMDB_WATERMARK_TIMEOUT', 604800)
+    redis = get_redis()
+    if redis is None:
+        _watermarks.set(business, watermark, ttl=timeout)
+        return
+    key = WATERMARK_KEY.format(business)
+    try:
+        pipe = redis.pipeline()
+        pipe.hmset(key, {'last_time': watermark.get('last_time') or '', 'full_at': watermark['full_at']})
+        pipe.expire(key, timeout)
+        pipe.execute()
+    except RedisError as e:
+        app.logger.warning(u'Save CMDB watermark of {} failed: {}'.format(business, e))
+
+
+def is_full_sync_due(watermark, now=None):
+    """ a full sync is due without a watermark, or after CMDB_FULL_SYNC_INTERVAL """
+    if not watermark or not watermark.get('last_time'):
+        return True
+    now = time.time() if now is None else now
+    return now - watermark['full_at'] >= app.config.get('CMDB_FULL_SYNC_INTERVAL', 21600)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Merkle hashes of the inventory tree posted to Scheduler.
+
+Each node of the inventory tree carries the hash of its own content and the hash of its
+subtree, rolled up from the subtree hashes of its children. The hashes of the last tree
+acknowledged by Scheduler are kept per business in a redis hash, so the next sync only sends
+the subtrees whose hashes changed. Without redis, the hashes are kept in the worker saving
+them, tagged with the version of the snapshot in inventory_snapshot_version, and another
+worker, or the same one after the snapshot was saved by another, posts the whole tree.
+
+The payloads are posted in the compact format of inventory_codec when INVENTORY_COMPACT_FORMAT
+is on, an endpoint answering 415 gets json from the worker afterwards.
+"""
+import hashlib
+import json
+
+from flask import current_app as app, has_app_context
+from redis.exceptions import RedisError
+from sqlalchemy.exc import SQLAlchemyError
+
+from aops.applications.common.cache import LRUCache, get_redis, read_version, bump_version
+from aops.applications.common.inventory_codec import encode_inventory, CONTENT_TYPE, CONTENT_ENCODING
+from aops.applications.common.scheduler_request import SchedulerApi
+from aops.applications.database.models.resource.host import InventorySnapshotVersion
+from aops.applications.exceptions.exception import SchedulerError
+
+INVENTORY_KEY = 'aops:inventory:{}'
+STUB_KEYS = ('id', 'pid', 'name', 'business', 'ip')
+
+_snapshots = LRUCache(capacity=64)    # {business: (version, hashes)}, used when redis isn't configured
+_json_endpoints = set()    # the endpoints not accepting the compact format
+
+
+def _sha1(text):
+    return hashlib.sha1(text).hexdigest()
+
+
+def hash_inventory_tree(tree):
+    """
+    Hash the nodes of the inventory tree
+    Args:
+        tree: the root nodes generated by create_tree_data
+    Returns:
+        {node_id: (tree_hash, self_hash, stub)}, the stub is kept to delete the node later
+    """
+    hashes = {}
+
+    def _hash(node):
+        content = dict((key, value) for key, value in node.items() if key != 'children')
+        self_hash = _sha1(json.dumps(content, sort_keys=True, default=str))
+        child_hashes = sorted(_hash(child) for child in node.get('children') or [])
+        tree_hash = _sha1(self_hash + ''.join(child_hashes))
+        stub = dict((key, node[key]) for key in STUB_KEYS if key in node)
+        hashes[node['id']] = (tree_hash, self_hash, stub)
+        return tree_hash
+
+    for root in tree:
+        _hash(root)
+    return hashes
+
+
+def diff_inventory_tree(tree, hashes, snapshot):
+    """
+    Get the subtrees changed since the snapshot. A changed node keeps its path to the root,
+    the nodes whose own content changed are flagged by is_update and the removed nodes are
+    flagged by is_delete, the unchanged subtrees are pruned.
+    Args:
+        tree: the root nodes generated by create_tree_data
+        hashes: the hashes of the tree by hash_inventory_tree
+        snapshot: the hashes of the acknowledged tree
+    Returns:
+        the root nodes of the changed subtrees, [] if nothing changed
+    """
+    removed = {}
+    for node_id, (_, _, stub) in snapshot.items():
+        if node_id not in hashes:
+            removed.setdefault(stub['pid'], []).append(stub)
+
+    def _removed(pid):
+        nodes = []
+        for stub in removed.pop(pid, []):
+            node = dict(stub, is_update=0, is_delete=1)
+            children = _removed(stub['id'])
+            if children:
+                node['children'] = children
+            nodes.append(node)
+        return nodes
+
+    def _prune(nodes):
+        changed = []
+        for node in nodes:
+            tree_hash, self_hash, _ = hashes[node['id']]
+            previous = snapshot.get(node['id'])
+            if previous and previous[0] == tree_hash:
+                continue
+            pruned = dict((key, value) for key, value in node.items() if key != 'children')
+            if not previous or previous[1] != self_hash:
+                pruned.update({'is_update': 1, 'is_delete': 0})
+            children = _prune(node.get('children') or []) + _removed(node['id'])
+            if children:
+                pruned['children'] = children
+            changed.append(pruned)
+        return changed
+
+    removed_ids = set(node_id for node_id in snapshot if node_id not in hashes)
+    changed = _prune(tree)
+    for pid in [pid for pid in removed if pid not in removed_ids]:
+        changed.extend(_removed(pid))
+    return changed
+
+
+def _db_version(business):
+    return read_version(InventorySnapshotVersion.__table__, {'business': business})
+
+
+def _bump_db_version(business):
+    return bump_version(InventorySnapshotVersion.__table__, {'business': business})
+
+
+def load_inventory_snapshot(business):
+    """ the hashes of the tree last acknowledged by Scheduler, None if unknown """
+    if not has_app_context():
+        return None
+    redis = get_redis()
+    if redis is None:
+        cached = _snapshots.get(business)
+        if cached is None:
+            return None
+        try:
+            return cached[1] if cached[0] == _db_version(business) else None
+        except SQLAlchemyError as e:
+            app.logger.warning(u'Read inventory snapshot version of {} failed: {}'.format(business, e))
+            return None
+    try:
+        fields = redis.hgetall(INVENTORY_KEY.format(business))
+    except RedisError as e:
+        app.logger.warning(u'Read inventory snapshot of {} failed: {}'.format(business, e))
+        return None
+    return dict((node_id.decode('utf-8'), tuple(json.loads(value))) for node_id, value in fields.items()) or None
+
+
+def save_inventory_snapshot(business, hashes):
+    """ remember the hashes of the tree acknowledged by Scheduler """
+    timeout = app.config.get('INVENTORY_SNAPSHOT_TIMEOUT', 86400)
+    redis = get_redis()
+    if redis is None:
+        try:
+            _snapshots.set(business, (_bump_db_version(business), hashes), ttl=timeout)
+        except SQLAlchemyError as e:
+            _snapshots.pop(business)
+            app.logger.warning(u'Save inventory snapshot of {} failed: {}'.format(business, e))
+        return
+    key = INVENTORY_KEY.format(business)
+    try:
+        pipe = redis.pipeline()
+        pipe.delete(key)
+        if hashes:
+            pipe.hmset(key, dict((node_id, json.dumps(value)) for node_id, value in hashes.items()))
+            pipe.expire(key, timeout)
+        pipe.execute()
+    except RedisError as e:
+        app.logger.warning(u'Save inventory snapshot of {} failed: {}'.format(business, e))
+
+
+def post_inventory(endpoint, payload):
+    """
+    Post the inventory payload to scheduler
+    Args:
+        endpoint: the inventory endpoint of scheduler
+        payload: {name: [node dict]}, e.g. {'tree-group': [...]}
+    Returns:
+        the response of scheduler
+    """
+    api = SchedulerApi(endpoint)
+    if app.config.get('INVENTORY_COMPACT_FORMAT') and api.endpoint not in _json_endpoints:
+        data = encode_inventory(payload)
+        app.logger.info('Post compact inventory to {}, {} bytes'.format(api.endpoint, len(data)))
+        try:
+            return api.post(data=data, headers={'Content-Type': CONTENT_TYPE, 'Content-Encoding': CONTENT_ENCODING})
+        except SchedulerError as e:
+            if e.status_code != 415:
+                raise
+            app.logger.warning('Scheduler {} does not accept the compact inventory, post json'.format(api.endpoint))
+            _json_endpoints.add(api.endpoint)
+
+    data = json.dumps(payload)
+    app.logger.info('Post inventory to {}, {} bytes'.format(api.endpoint, len(data)))
+    app.logger.debug('Post inventory to {}, args: {}'.format(api.endpoint, data))
+    return api.post(data=data, headers={'Content-Type': 'application/json;charset=utf-8'})
@@ -16,6 +16,7 @@ from aops.applications.exceptions.exception import ValidationError
 from aops.applications.database.models.system.user import User
 from aops.applications.database.models import SysConfigBusiness
 from aops.applications.database.apis.user_permission.role import get_role_with_id
+from aops.applications.database.apis.user_permission.snapshot import bump_permission_version
 from aops.applications.exceptions.exception import ResourceNotFoundError
 from aops.applications.exceptions.exception import UserLoginError
 from flask import current_app as app
@@ -183,7 +184,9 @@ def check_user_password(username, password):
 
 def delete_user_with_id(identifier):
     user = User.query.filter_by(id=identifier, is_deleted=False).first()
-    return user.update(**{'deleted_at': datetime.datetime.now(), 'is_deleted': True})
+    user = user.update(**{'deleted_at': datetime.datetime.now(), 'is_deleted': True})
+    bump_permission_version([user.username])
+    return user
 
 
 def delete_users_with_ids(identifiers):
@@ -216,6 +219,8 @@ def update_user_with_id(identifier, user_info):
     if user is None:
         raise ResourceNotFoundError('User', identifier)
     user = user.update(**user_info)
+    if 'roles' in user_info:
+        bump_permission_version([user.username])
     add_user_attribute(user)
     return user
 
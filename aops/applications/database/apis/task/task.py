@@ -7,6 +7,7 @@ from flask import request, session
 from sqlalchemy import or_
 from sqlalchemy.orm.exc import NoResultFound
 
+from aops.applications.common.facet import Facet
 from aops.applications.database.models import SysConfigApprove
 from aops.applications.database.models.repository.risk_command import RiskRepository
 from aops.applications.database.models.task.task import Task,TaskReview
@@ -14,6 +15,8 @@ from aops.applications.exceptions.exception import  ResourcesNotFoundError, \
     ResourceAlreadyExistError, ResourcesNotDisabledError, ResourceNotFoundError, \
     NoPermissionError, ConflictError
 
+task_creators = Facet('task_creator', Task, 'creator', scope=('business_group',), is_deleted=False)
+
 
 def get_tasks_list(page, per_page, name=None, type=None, language=None, target_system=None, risk_level=None, is_enable=None, creator=None, fuzzy_query=None):
     """
@@ -87,9 +90,9 @@ def get_creator_list():
     """
     business_group = request.cookies.get('BussinessGroup')
 
-    q = Task.query.filter_by(is_deleted=False, business_group=business_group).all()
-    if q:
-        return {'creator': set([task.creator for task in q])}
+    creators = task_creators.get(business_group)
+    if creators:
+        return {'creator': creators}
     return {}
 
 def _generate_risk(command, args):
@@ -4,6 +4,7 @@
 from aops.applications.database import db
 from aops.applications.database.apis.user_permission.permission import get_permission_with_id
 from aops.applications.database.apis.user_permission.role import get_role_with_id
+from aops.applications.database.apis.user_permission.snapshot import bump_permission_version
 from aops.applications.exceptions.exception import ResourceNotFoundError
 from aops.applications.exceptions.exception import ValidationError
 
@@ -42,6 +43,7 @@ def add_role_permissions(role_id, args):
         for permission_id in args.permission_ids:
             _add_role_permission(role, permission_id, new_role_permission_list)
         db.session.commit()
+        bump_permission_version([user.username for user in role.users])
         return new_role_permission_list
     except Exception as e:
         raise ValidationError(e.message)
@@ -70,6 +72,7 @@ def delete_role_permissions(role_id, args):
         for permission_id in permission_id_list:
             _delete_role_permission(role, permission_id, deleted_permissions_list)
         db.session.commit()
+        bump_permission_version([user.username for user in role.users])
         return deleted_permissions_list
     except Exception as e:
         raise ValidationError(e.message)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Versioned per-user permission snapshots.
+
+A snapshot is the user's roles and permissions, tagged with the user's grant version
+stored in redis. Every change on user roles or role permissions bumps the version of
+the affected users, so the snapshot is only loaded from db when the grants changed.
+Without redis, the versions are rows of permission_version and the snapshots are only
+kept in the worker, so a hit costs one indexed SELECT.
+"""
+import json
+
+from flask import current_app as app
+from redis.exceptions import RedisError
+from sqlalchemy.exc import SQLAlchemyError
+
+from aops.applications.common.cache import LRUCache, get_redis, read_version, bump_version
+from aops.applications.database import db
+from aops.applications.database.models.system.user import User, PermissionVersion
+
+VERSION_KEY = 'aops:permission:version:{}'
+SNAPSHOT_KEY = 'aops:permission:snapshot:{}'
+
+_snapshots = LRUCache(capacity=1024, ttl=300)
+
+
+def _load_snapshot(username):
+    user = User.query.filter_by(username=username, is_deleted=False).first()
+    if user is None:
+        return None
+    privileges = [(role.name, permission.permission) for role in user.roles for permission in
+                  role.permissions]
+    return {
+        'user': user.username,
+        'roles': list(set(map(lambda item: item[0], privileges))),
+        'permissions': list(set(map(lambda item: item[1], privileges)))
+    }
+
+
+def _db_version(username):
+    return read_version(PermissionVersion.__table__, {'username': username})
+
+
+def _bump_db_versions(usernames):
+    with db.engine.begin() as connection:
+        for username in usernames:
+            bump_version(PermissionVersion.__table__, {'username': username}, connection)
+
+
+def _get_db_snapshot(username):
+    try:
+        version = _db_version(username)
+    except SQLAlchemyError as e:
+        app.logger.warning(u'Read permission version of {} failed: {}'.format(username, e))
+        return _load_snapshot(username)
+    cached = _snapshots.get(username)
+    if cached and cached['version'] == version:
+        return cached['snapshot']
+    snapshot = _load_snapshot(username)
+    if snapshot is not None:
+        _snapshots.set(username, {'version': version, 'snapshot': snapshot})
+    return snapshot
+
+
+def get_user_permission_snapshot(username):
+    """
+    Get the roles and permissions of a user
+    Args:
+        username: the user's name
+
+    Returns:
+        {'user': username, 'roles': [...], 'permissions': [...]}, or None if user is not found
+    """
+    redis = get_redis()
+    if redis is None:
+        return _get_db_snapshot(username)
+
+    try:
+        version = int(redis.get(VERSION_KEY.format(username)) or 0)
+        cached = _snapshots.get(username)
+        if cached and cached['version'] == version:
+            return cached['snapshot']
+
+        cached = redis.get(SNAPSHOT_KEY.format(username))
+        cached = json.loads(cached) if cached else None
+        if cached and cached['version'] == version:
+            _snapshots.set(username, cached)
+            return cached['snapshot']
+    except RedisError as e:
+        app.logger.warning(u'Read permission snapshot of {} failed: {}'.format(username, e))
+        return _load_snapshot(username)
+
+    snapshot = _load_snapshot(username)
+    if snapshot is None:
+        return None
+    cached = {'version': version, 'snapshot': snapshot}
+    _snapshots.set(username, cached)
+    try:
+        redis.setex(SNAPSHOT_KEY.format(username), app.config.get('PERMISSION_SNAPSHOT_TIMEOUT', 3600),
+                    json.dumps(cached))
+    except RedisError as e:
+        app.logger.warning(u'Save permission snapshot of {} failed: {}'.format(username, e))
+    return snapshot
+
+
+def bump_permission_version(usernames):
+    """
+    Invalidate the permission snapshots of users after their grants changed
+    Args:
+        usernames: the names of users whose roles or role permissions changed
+    """
+    usernames = set(usernames)
+    for username in usernames:
+        _snapshots.pop(username)
+    if not usernames:
+        return
+    redis = get_redis()
+    if redis is None:
+        try:
+            _bump_db_versions(usernames)
+        except SQLAlchemyError as e:
+            app.logger.error(u'Bump permission version of {} failed: {}'.format(list(usernames), e))
+        return
+    try:
+        pipe = redis.pipeline(transaction=False)
+        for username in usernames:
+            pipe.incr(VERSION_KEY.format(username))
+        pipe.execute()
+    except RedisError as e:
+        app.logger.error(u'Bump permission version of {} failed: {}'.format(list(usernames), e))
@@ -4,6 +4,7 @@
 from aops.applications.database import db
 from aops.applications.database.apis import user as user_api
 from aops.applications.database.apis.user_permission.role import get_role_with_id
+from aops.applications.database.apis.user_permission.snapshot import bump_permission_version
 
 
 def get_user_roles(args):
@@ -43,6 +44,7 @@ def add_user_roles(user_id, args):
     for role_id in args.role_ids:
         _add_user_role(user, role_id, new_user_role_list)
     db.session.commit()
+    bump_permission_version([user.username])
     return new_user_role_list
 
 
@@ -68,6 +70,7 @@ def delete_user_roles(user_id, args):
     for role_id in args.role_ids:
         _delete_user_role(user, role_id, deleted_user_role_list)
     db.session.commit()
+    bump_permission_version([user.username])
     return deleted_user_role_list
 
 
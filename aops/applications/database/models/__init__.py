@@ -1,15 +1,16 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 
-from .common import MinModel, TimeUtilModel
+from .common import MinModel, TimeUtilModel, FacetVersion
 from .ops_job.process import Process, ProcessExecution
 from .job.job import Job
 
 from .resource.application import Application, AppParameter
-from .resource.host import HostAccount, HostParameter, Host, Group
+from .resource.host import HostAccount, HostParameter, Host, Group, InventoryDelta, CmdbSyncRun, CmdbSyncLock, \
+    HostImportJob, GroupTreeVersion, HostIndexChange, HostIndexSequence, InventorySnapshotVersion
 
 from .system.config import SysConfigBusiness, SysConfigApprove, SysConfigAlarm, SysConfigExchange
-from .system.user import User, Permission, Role
+from .system.user import User, Permission, Role, PermissionVersion
 from .system.message import Message
 from .approval.approval import Approval
 
@@ -3,9 +3,23 @@
 from aops.applications.database import db
 from aops.applications.database.models.common import TimeUtilModel, MinModel
 
+# trigram index over audit.operation and audit.message, maintained by audit apis
+audit_tokens = db.Table('audit_token',
+    db.Column('audit_id', db.Integer, db.ForeignKey('audit.id'), primary_key=True),
+    db.Column('field', db.String(16), primary_key=True),
+    db.Column('token', db.String(8), primary_key=True),
+    db.Index('ix_audit_token_field_token', 'field', 'token', 'audit_id')
+)
+
 
 class Audit(MinModel, TimeUtilModel):
     __tablename__ = 'audit'
+    __table_args__ = (
+        db.Index('ix_audit_created_at', 'created_at'),
+        db.Index('ix_audit_user_created_at', 'user', 'created_at'),
+        db.Index('ix_audit_resource_created_at', 'resource', 'resource_id', 'created_at'),
+        db.Index('ix_audit_status_created_at', 'status', 'created_at'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user = db.Column(db.String(80), nullable=False)
     source_ip = db.Column(db.String(80), nullable=True)
@@ -14,3 +28,22 @@ class Audit(MinModel, TimeUtilModel):
     operation = db.Column(db.String(80), nullable=False)
     status = db.Column(db.String(20), nullable=False)
     message = db.Column(db.String(80), nullable=True)
+
+
+class AuditArchive(MinModel, TimeUtilModel):
+    """ A month of audits rolled out of the audit table into compressed chunks, the row locks its rollover """
+    __tablename__ = 'audit_archive'
+    id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.DateTime(), nullable=False, unique=True)    # the first day of the month
+    status = db.Column(db.String(16), nullable=False, default='writing')    # writing, purging, archived
+    owner = db.Column(db.String(128), nullable=True)    # the run rolling the month over, None once archived
+    count = db.Column(db.Integer(), nullable=False, default=0)
+    last_id = db.Column(db.Integer(), nullable=False, default=0)    # the last archived audit id
+
+
+class AuditArchiveChunk(MinModel):
+    """ The compressed json lines of a chunk of archived audits, the chunks are ordered by audit id """
+    __tablename__ = 'audit_archive_chunk'
+    archive_id = db.Column(db.Integer, db.ForeignKey('audit_archive.id'), primary_key=True)
+    seq = db.Column(db.Integer, primary_key=True)
+    data = db.Column(db.LargeBinary(2 ** 24), nullable=False)
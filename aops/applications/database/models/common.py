@@ -103,3 +103,11 @@ class MinModel(db.Model):
     @classmethod
     def find(cls, **kwargs):
         return cls.query.filter_by(**kwargs).all()
+
+
+class FacetVersion(MinModel):
+    """ The version of the distinct values of a facet scope when redis isn't configured """
+    __tablename__ = 'facet_version'
+    name = db.Column(db.String(64), primary_key=True)
+    scope = db.Column(db.String(255), primary_key=True)    # the json of the scope values, or * for all scopes
+    version = db.Column(db.Integer, nullable=False, default=0)
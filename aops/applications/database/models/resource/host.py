@@ -3,6 +3,8 @@
 # @Time    : 18-7-4 上午10:15
 # @Author  : zsf
 
+from sqlalchemy.orm import selectinload
+
 from aops.applications.database import db
 from aops.applications.database.models.common import TimeUtilModel, MinModel
 
@@ -15,6 +17,18 @@ groupHost = db.Table('group_host',
 )
 
 
+host_attributes = db.Table('host_attribute',
+    db.Column('host_id', db.Integer, db.ForeignKey('host.id'), primary_key=True),
+    db.Column('key', db.String(64), primary_key=True),    # key_en of the CMDB attribute
+    db.Column('key_cn', db.String(64), nullable=True),
+    db.Column('value', db.String(255), nullable=True),    # the value as text, None if longer or a json object
+    db.Column('value_type', db.String(16), nullable=False),    # str, int, float, bool, json
+    db.Column('text', db.Text, nullable=True),    # the long or json values, not filtered
+    db.Column('position', db.Integer, nullable=False, default=0),    # the order of the attribute in others
+    db.Index('ix_host_attribute_key_value', 'key', 'value', 'host_id')
+)
+
+
 class Group(MinModel, TimeUtilModel):
     id = db.Column(db.Integer, primary_key=True)
     pid = db.Column(db.Integer, unique=False, nullable=False)
@@ -24,9 +38,16 @@ class Group(MinModel, TimeUtilModel):
     is_read_only = db.Column(db.Integer, unique=False, nullable=False, default=0)   # 0: read only, 1: can be modified
     description = db.Column(db.Text, unique=False, nullable=True)
     modified_by = db.Column(db.String(64), unique=False, nullable=True)
-    hosts = db.relationship('Host', secondary=groupHost, lazy=False,
-                            backref=db.backref('groups', lazy=False))
+    hosts = db.relationship('Host', secondary=groupHost, lazy=True,
+                            backref=db.backref('groups', lazy=True))
     others = db.Column(db.String(64), unique=False, nullable=True)
+    path = db.Column(db.String(255), unique=False, nullable=True, index=True)    # /<root id>/.../<id>/
+    rule = db.Column(db.Text, unique=False, nullable=True)    # the json rule of a dynamic group, see dynamic_group
+
+    @property
+    def ancestor_ids(self):
+        """ ids of the ancestors from the root, [] if the path isn't built """
+        return [int(id) for id in (self.path or '').strip('/').split('/')[:-1] if id]
 
 
 class Host(MinModel, TimeUtilModel):
@@ -41,7 +62,7 @@ class Host(MinModel, TimeUtilModel):
     cabinet = db.Column(db.String(64), unique=False, nullable=True)
     machine = db.Column(db.String(64), unique=False, nullable=True)
     description = db.Column(db.Text, unique=False, nullable=True)
-    others = db.Column(db.Text, unique=False, nullable=True)   # store the variables for different business
+    others = db.Column(db.Text, unique=False, nullable=True)   # the CMDB attributes, indexed by host_attribute
 
 
 class GroupParameter(MinModel, TimeUtilModel):
@@ -50,7 +71,7 @@ class GroupParameter(MinModel, TimeUtilModel):
     value = db.Column(db.String(64), unique=False, nullable=False)
     others = db.Column(db.Text, unique=False, nullable=True)
     group_id = db.Column(db.Integer, db.ForeignKey('group.id'), nullable=True)
-    group = db.relationship('Group', backref=db.backref('params', lazy=False), lazy=False)
+    group = db.relationship('Group', backref=db.backref('params', lazy=True), lazy=True)
 
 
 class HostAccount(MinModel, TimeUtilModel):
@@ -59,7 +80,7 @@ class HostAccount(MinModel, TimeUtilModel):
     password = db.Column(db.String(64), unique=False, nullable=False)
     others = db.Column(db.Text, nullable=True)
     host_id = db.Column(db.Integer, db.ForeignKey('host.id'), nullable=True)
-    host = db.relationship('Host', backref=db.backref('accounts', lazy=False), lazy=False)
+    host = db.relationship('Host', backref=db.backref('accounts', lazy=True), lazy=True)
 
 
 class HostParameter(MinModel, TimeUtilModel):
@@ -68,4 +89,95 @@ class HostParameter(MinModel, TimeUtilModel):
     value = db.Column(db.String(64), unique=False, nullable=False)
     others = db.Column(db.Text, unique=False, nullable=True)
     host_id = db.Column(db.Integer, db.ForeignKey('host.id'), nullable=True)
-    host = db.relationship('Host', backref=db.backref('params', lazy=False), lazy=False)
+    host = db.relationship('Host', backref=db.backref('params', lazy=True), lazy=True)
+
+
+# loading profiles applied by query.options(*profile), the relationships are lazily loaded by default
+HOST_LIST = (selectinload('accounts'), selectinload('params'), selectinload('apps'))    # host_model
+HOST_DETAIL = HOST_LIST + (selectinload('groups'),)
+GROUP_LIST = (selectinload('params'), selectinload('hosts'))    # group_model, the ip tree
+GROUP_INVENTORY = (selectinload('params'), selectinload('hosts').selectinload('accounts'),
+                   selectinload('hosts').selectinload('params'))    # the inventory and the host tree
+
+
+class InventoryDelta(MinModel, TimeUtilModel):
+    """ A group or host change waiting to be published to the Scheduler inventory """
+    __tablename__ = 'inventory_delta'
+    id = db.Column(db.Integer, primary_key=True)
+    business = db.Column(db.String(64), nullable=False, index=True)
+    node_type = db.Column(db.String(16), nullable=False)    # group, host
+    node_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(16), nullable=False)    # update, delete
+
+
+class CmdbSyncRun(MinModel, TimeUtilModel):
+    """ A run of the periodic CMDB sync of a business, created_at is the start time """
+    __tablename__ = 'cmdb_sync_run'
+    id = db.Column(db.Integer, primary_key=True)
+    business = db.Column(db.String(64), nullable=False, index=True)
+    full = db.Column(db.Boolean, nullable=False, default=False)
+    status = db.Column(db.String(16), nullable=False)    # running, success, failed
+    worker = db.Column(db.String(128), nullable=True)    # <hostname>:<pid>
+    duration = db.Column(db.Float, nullable=True)    # seconds
+    added = db.Column(db.Integer, nullable=False, default=0)
+    updated = db.Column(db.Integer, nullable=False, default=0)
+    deleted = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+
+
+class CmdbSyncLock(MinModel):
+    """ A lock of a business when redis isn't configured, see business_lock """
+    __tablename__ = 'cmdb_sync_lock'
+    business = db.Column(db.String(64), primary_key=True)    # the name of the lock
+    owner = db.Column(db.String(128), nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class GroupTreeVersion(MinModel):
+    """ The version of the group trees of a business when redis isn't configured """
+    __tablename__ = 'group_tree_version'
+    business = db.Column(db.String(64), primary_key=True)    # or * for the bulk writes of all businesses
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class InventorySnapshotVersion(MinModel):
+    """ The version of the inventory snapshot of a business when redis isn't configured """
+    __tablename__ = 'inventory_snapshot_version'
+    business = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class HostIndexChange(MinModel):
+    """ A host written for the search indexes of the workers when redis isn't configured """
+    __tablename__ = 'host_index_change'
+    id = db.Column(db.Integer, primary_key=True)
+    seq = db.Column(db.Integer, nullable=False, index=True)    # the sequence of the write
+    host_id = db.Column(db.Integer, nullable=True)    # None rebuilds the index
+
+
+class HostIndexSequence(MinModel):
+    """ The single row counting the writes of host_index_change """
+    __tablename__ = 'host_index_sequence'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)    # the sequence of the last write
+
+
+class HostImportJob(MinModel, TimeUtilModel):
+    """ An import of hosts or host accounts from an uploaded file, created_at is the start time """
+    __tablename__ = 'host_import_job'
+    id = db.Column(db.Integer, primary_key=True)
+    business = db.Column(db.String(64), nullable=False)
+    kind = db.Column(db.String(16), nullable=False)    # infos, accounts
+    filename = db.Column(db.String(255), nullable=False)
+    path = db.Column(db.String(255), nullable=False)    # the saved upload
+    status = db.Column(db.String(16), nullable=False)    # pending, running, success, failed
+    created_by = db.Column(db.String(64), nullable=True)
+    size = db.Column(db.Integer, nullable=False, default=0)    # bytes of the file
+    offset = db.Column(db.Integer, nullable=False, default=0)    # bytes parsed
+    rows = db.Column(db.Integer, nullable=False, default=0)    # rows parsed
+    skipped = db.Column(db.Integer, nullable=False, default=0)    # invalid rows
+    added = db.Column(db.Integer, nullable=False, default=0)
+    updated = db.Column(db.Integer, nullable=False, default=0)
+    deleted = db.Column(db.Integer, nullable=False, default=0)
+    duration = db.Column(db.Float, nullable=True)    # seconds
+    error = db.Column(db.Text, nullable=True)
@@ -60,3 +60,10 @@ class Permission(MinModel, TimeUtilModel):
     resource = db.Column(db.String(100), nullable=False)
     operation = db.Column(db.String(100), nullable=False)
     description = db.Column(db.String(150), nullable=True)
+
+
+class PermissionVersion(MinModel):
+    """ The grant version of a user when redis isn't configured """
+    __tablename__ = 'permission_version'
+    username = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
@@ -66,8 +66,9 @@ class ResourceAlreadyExistError(Error):
 
 
 class SchedulerError(Error):
-    def __init__(self, msg):
+    def __init__(self, msg, status_code=None):
         self.msg = u'Scheduler server occurred error: {}'.format(msg)
+        self.status_code = status_code
         Error.__init__(self, self.msg)
 
 
@@ -8,8 +8,20 @@ from flask import request, session, abort
 from flask import current_app as app
 import json
 from aops.applications.database.apis.audit.audit import add_audit_item
+from aops.applications.database.apis.data_init.generate_permission import generate_permission_index
 
-api = Api(
+
+class AopsApi(Api):
+    """ Api which indexes the required permission of every endpoint when init_app runs """
+
+    permission_index = {}
+
+    def init_app(self, app, **kwargs):
+        super(AopsApi, self).init_app(app, **kwargs)
+        self.permission_index = generate_permission_index(self)
+
+
+api = AopsApi(
     title='aops',
     version='1.0',
     description='AOPS\' api document',
@@ -20,32 +32,20 @@ api = Api(
 def _generate_permission_list(func_name, action=None):
     """
     Args:
-        func_name:
-        action:
+        func_name: the decorated function's name, eg: get, post
+        action: url's specific action
 
     Returns:
-
-    """
-    """
-    :param action: url's specific action
-    :return: current permission list
+        current permission list
     """
-
     r_endpoint = request.endpoint
     url_rule = request.url_rule
 
     # based on namespaces/resources/function_name generate permission_name.
-    for namespace in api.namespaces:
-        cur_permission_list = [namespace.name.split('/')[-1] + "_" + func_name + "_" + res[0].__name__ for res in
-                               namespace.resources if namespace.resources and r_endpoint == res[0].endpoint]
-        if len(cur_permission_list) == 1:
-            break
-        else:
-            continue
-    if len(cur_permission_list) == 1:
-        permission = cur_permission_list[0]
-    else:
+    permission = api.permission_index.get((r_endpoint, func_name))
+    if permission is None:
         abort(400, u'基于{}未能生成对应的权限'.format(r_endpoint))
+    cur_permission_list = [permission]
 
     # permission append action key.
     if isinstance(action, list):
@@ -5,7 +5,7 @@ from flask import stream_with_context
 from flask import abort
 from flask import Response
 from datetime import datetime
-from flask_restplus import Namespace, Resource, Model, fields, reqparse
+from flask_restplus import Namespace, Resource, Model, fields, reqparse, inputs
 from aops.applications.handlers.v1.common import time_util, pagination_base_model
 from aops.applications.exceptions.exception import ResourcesNotFoundError
 from aops.applications.database.apis.audit.audit import get_audit_list, audit_list_search, get_audit_user_list, \
@@ -60,6 +60,8 @@ audit_list_args.add_argument('status', type=str, location='args')
 audit_list_args.add_argument('message', type=str, location='args')
 
 audit_search_args = reqparse.RequestParser()
+audit_search_args.add_argument('start_time', type=str, location='args')
+audit_search_args.add_argument('end_time', type=str, location='args')
 audit_search_args.add_argument('source_ip', type=str, location='args')
 audit_search_args.add_argument('resource_type', type=str, location='args')
 audit_search_args.add_argument('resource_id', type=str, location='args')
@@ -77,6 +79,10 @@ audit_download_params.add_argument('resource_id', type=str, location='args')
 audit_download_params.add_argument('operation', type=str, location='args')
 audit_download_params.add_argument('result', type=str, location='args')
 audit_download_params.add_argument('message', type=str, location='args')
+audit_download_params.add_argument('after_id', type=int, location='args',
+                                   help='resume the download after this audit id')
+audit_download_params.add_argument('gzip', type=inputs.boolean, location='args', default=False,
+                                   help='gzip the csv file')
 
 
 @ns.route('/')
@@ -178,10 +184,11 @@ class AuditsDownload(Resource):
         try:
             app.logger.info(u"Download audits succeed")
             res = get_audits_csv(args)
+            file_name = "audits.csv.gz" if args.gzip else "audits.csv"
             return Response(
                 stream_with_context(res),
-                mimetype="application/tar+gzip",
-                headers={"Content-disposition": "attachment;filename=aops" + "_{}".format(time_now) + "_{}".format("audits.csv")})
+                mimetype="application/gzip" if args.gzip else "application/tar+gzip",
+                headers={"Content-disposition": "attachment;filename=aops" + "_{}".format(time_now) + "_{}".format(file_name)})
         except ResourcesNotFoundError as e:
             app.logger.error(u"Download audits failed, reason: {}".format(e.msg))
             abort(404, e.msg)
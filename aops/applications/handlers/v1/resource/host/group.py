@@ -7,10 +7,10 @@ import datetime
 from flask import current_app as app, jsonify, request
 from flask_restplus import Namespace, Model, fields, reqparse, Resource, abort
 
-from aops.applications.database.apis import group as group_api
+from aops.applications.database.apis import group as group_api, group_tree
 from aops.applications.handlers.v1.common import time_util
 from aops.applications.handlers.v1.resource.host.host import host_ip_model
-from aops.applications.exceptions.exception import ResourceNotFoundError, ResourceAlreadyExistError
+from aops.applications.exceptions.exception import ResourceNotFoundError, ResourceAlreadyExistError, ValidationError
 
 
 ns = Namespace('/v1/groups', description='Groups operations')
@@ -32,13 +32,16 @@ group_without_id_model = Model('groupWithoutID', {
     'description': fields.String(required=True, unique=False, description='The group\'s description'),
     'params': fields.List(fields.Nested(parameter_without_id_model),
                           required=False, unique=False, description='The group\'s parameters'),
-    'others': fields.String(required=False, unique=False, description='Other fields for extension')
+    'others': fields.String(required=False, unique=False, description='Other fields for extension'),
+    'rule': fields.Raw(required=False, description='The rule of a dynamic group, {key: [values]} of the host '
+                                                   'columns and attributes, its hosts are computed')
 })
 
 group_model = group_without_id_model.clone('group', time_util, {
     'id': fields.Integer(readOnly=True, unique=True, description='The group\'s identifier'),
     'modified_by': fields.String(required=True, unique=False, description='The group\'s modified user'),
-    'hosts': fields.List(fields.Nested(host_ip_model))
+    'hosts': fields.List(fields.Nested(host_ip_model)),
+    'rule': fields.String(description='The json rule of a dynamic group')
 })
 
 update_group_model = Model('updateGroupModel', {
@@ -47,7 +50,8 @@ update_group_model = Model('updateGroupModel', {
     'description': fields.String(required=True, unique=False, description='The group\'s description'),
     'host_ids': fields.List(fields.String(required=False, description='The ip list of hosts in one group')),
     'params': fields.List(fields.Nested(parameter_without_id_model),
-                          required=False, unique=False, description='The group\'s parameters')
+                          required=False, unique=False, description='The group\'s parameters'),
+    'rule': fields.Raw(required=False, description='The rule of a dynamic group, {} turns it into a static group')
 })
 
 tree_group_model = Model('treeGroupModel', {
@@ -66,6 +70,7 @@ group_without_id_parser.add_argument('name', required=True)
 group_without_id_parser.add_argument('params', type=list, location='json')
 group_without_id_parser.add_argument('description', required=True)
 group_without_id_parser.add_argument('host_ids', required=False, type=list, location='json')
+group_without_id_parser.add_argument('rule', required=False, type=dict, location='json')
 # group_without_id_parser.add_argument('others', required=False)
 
 group_parser = group_without_id_parser.copy()
@@ -81,6 +86,7 @@ update_group_parser.add_argument('name')
 update_group_parser.add_argument('description')
 update_group_parser.add_argument('host_ids', type=list, location='json')
 update_group_parser.add_argument('params', type=list, location='json')
+update_group_parser.add_argument('rule', type=dict, location='json')
 update_group_parser.add_argument('others')
 
 
@@ -133,6 +139,9 @@ class Groups(Resource):
         except ResourceAlreadyExistError as e:
             app.logger.error('Create group {}'.format(e.message))
             abort(409, 'Already exist')
+        except ValidationError as e:
+            app.logger.error(u'Create group failed, reason: {}'.format(e.msg))
+            abort(400, e.msg)
 
         app.logger.debug("Create group {}".format(created_group))
 
@@ -195,6 +204,9 @@ class Group(Resource):
         except ResourceNotFoundError as e:
             app.logger.error("No found updated group".format(e.message))
             abort(404, e.message)
+        except ValidationError as e:
+            app.logger.error(u'Update group failed, reason: {}'.format(e.msg))
+            abort(400, e.msg)
 
         return updated_group, 201
 
@@ -237,15 +249,13 @@ class TreeGroup(Resource):
         business = request.cookies.get('BussinessGroup') or 'LDDS'
         app.logger.debug("Get tree groups, with root pid {}".format(ROOT_PID))
         try:
-            tree_groups = group_api.get_tree_groups(ROOT_PID, business)
-            app.logger.info("Get tree group {}".format(tree_groups))
+            tree_groups = group_tree.get_tree_json('groups', business)
+            app.logger.debug("Get tree group of {}, {} bytes".format(business, len(tree_groups)))
         except ResourceNotFoundError as e:
             app.logger.warning("No tree group found !!", e.message)
             abort(404, e.message)
 
-        result = jsonify(tree_groups)
-        print result
-        return result
+        return app.response_class(tree_groups, mimetype='application/json')
 
 
 @ns.route('/tree-ips')
@@ -262,12 +272,10 @@ class TreeIPGroup(Resource):
         business = request.cookies.get('BussinessGroup') or 'LDDS'
         app.logger.debug("Get tree ips")
         try:
-            tree_ips = group_api.get_tree_ips('0', business)
-            app.logger.info("Get tree ips {}".format(tree_ips))
+            tree_ips = group_tree.get_tree_json('ips', business)
+            app.logger.debug("Get tree ips of {}, {} bytes".format(business, len(tree_ips)))
         except ResourceNotFoundError as e:
             app.logger.warning("No tree ips found !!", e.message)
             abort(404, e.message)
 
-        result = jsonify(tree_ips)
-
-        return result
\ No newline at end of file
+        return app.response_class(tree_ips, mimetype='application/json')
\ No newline at end of file
@@ -4,14 +4,17 @@
 # @Author  : szf
 
 import os
+import uuid
 from flask import current_app as app, jsonify, request, session
 from werkzeug.datastructures import FileStorage
-from flask_restplus import Namespace, Model, fields, reqparse, Resource, abort
+from werkzeug.utils import secure_filename
+from flask_restplus import Namespace, Model, fields, inputs, reqparse, Resource, abort
 
 from aops.applications.common import parser
-from aops.applications.handlers.v1.common import time_util
+from aops.applications.handlers.v1.common import time_util, pagination_base_model
 from aops.applications.handlers.v1.resource.application.application import application_model
-from aops.applications.database.apis import host as host_api, group as group_api
+from aops.applications.database.apis import host as host_api, group as group_api, cmdb_sync as cmdb_sync_api, \
+    host_search as host_search_api, host_attribute as host_attribute_api, host_import as host_import_api
 from aops.applications.exceptions.exception import ResourceNotFoundError, ResourceAlreadyExistError, Error
 
 
@@ -108,6 +111,50 @@ update_account_model = Model('UpdateAccount', {
     'identity_ip': fields.String(required=True, unique=True, description='The identify ip of a host')
 })
 
+cmdb_sync_run_model = Model('CmdbSyncRun', {
+    'id': fields.Integer(readOnly=True, description='The run\'s identifier'),
+    'business': fields.String(description='The synced business group'),
+    'full': fields.Boolean(description='Whether all CMDB instances were fetched'),
+    'status': fields.String(description='The run\'s status, running, success or failed'),
+    'worker': fields.String(description='The worker running the sync, <hostname>:<pid>'),
+    'created_at': fields.DateTime(description='The run\'s start time point'),
+    'duration': fields.Float(description='Seconds the run took'),
+    'added': fields.Integer(description='The number of added hosts'),
+    'updated': fields.Integer(description='The number of updated hosts'),
+    'deleted': fields.Integer(description='The number of deleted hosts'),
+    'error': fields.String(description='The error of a failed run')
+})
+
+host_import_job_model = Model('HostImportJob', {
+    'id': fields.Integer(readOnly=True, description='The job\'s identifier'),
+    'business': fields.String(description='The business group of the hosts'),
+    'kind': fields.String(description='infos, the hosts in a csv file; accounts, the host accounts in a txt file'),
+    'filename': fields.String(description='The imported file'),
+    'status': fields.String(description='The job\'s status, pending, running, success or failed'),
+    'created_by': fields.String(description='The user importing the file'),
+    'created_at': fields.DateTime(description='The job\'s start time point'),
+    'size': fields.Integer(description='The bytes of the file'),
+    'offset': fields.Integer(description='The bytes of the file imported'),
+    'rows': fields.Integer(description='The rows imported'),
+    'skipped': fields.Integer(description='The invalid rows skipped'),
+    'added': fields.Integer(description='The number of added hosts'),
+    'updated': fields.Integer(description='The number of updated hosts'),
+    'deleted': fields.Integer(description='The number of deleted hosts'),
+    'duration': fields.Float(description='Seconds the import took'),
+    'error': fields.String(description='The error of a failed import')
+})
+
+host_search_model = Model('HostSearchResult', {
+    'id': fields.Integer(readOnly=True, description='The host\'s identifier'),
+    'business': fields.String(description='The host\'s business group'),
+    'name': fields.String(description='The host name'),
+    'identity_ip': fields.String(description='The identify ip of a host')
+})
+
+host_pagination_model = pagination_base_model.clone('HostPagination', {
+    'items': fields.List(fields.Nested(host_model))
+})
+
 # register models
 ns.add_model(accounts_without_id_model.name, accounts_without_id_model)
 ns.add_model(parameter_without_id_model.name, parameter_without_id_model)
@@ -120,6 +167,10 @@ ns.add_model(host_ids_model.name, host_ids_model)
 ns.add_model(update_account_model.name, update_account_model)
 ns.add_model(host_other_field_model.name, host_other_field_model)
 ns.add_model(host_update_model.name, host_update_model)
+ns.add_model(cmdb_sync_run_model.name, cmdb_sync_run_model)
+ns.add_model(host_import_job_model.name, host_import_job_model)
+ns.add_model(host_search_model.name, host_search_model)
+ns.add_model(host_pagination_model.name, host_pagination_model)
 
 # define parsers
 host_without_id_parser = reqparse.RequestParser()
@@ -140,6 +191,27 @@ host_list_args = reqparse.RequestParser()
 host_list_args.add_argument("business", type=str, location='args')
 host_list_args.add_argument("fuzzy_query", type=str, location='args')
 
+host_search_args = reqparse.RequestParser()
+host_search_args.add_argument('q', type=str, location='args', required=True, help='The searched text')
+host_search_args.add_argument('business', type=str, location='args')
+host_search_args.add_argument('prefix', type=inputs.boolean, location='args', default=False,
+                              help='Whether a field starts with the text, or contains it')
+host_search_args.add_argument('limit', type=int, location='args', default=20)
+
+host_filter_args = reqparse.RequestParser()
+host_filter_args.add_argument('filter', type=str, location='args', action='append', default=[],
+                              help='The filters <key>:<value>, e.g. site:IDC1, repeated for more values or keys')
+host_filter_args.add_argument('business', type=str, location='args')
+
+host_filter_page_args = host_filter_args.copy()
+host_filter_page_args.add_argument('page', type=int, location='args', default=1, help='Current page number.')
+host_filter_page_args.add_argument('per_page', type=int, location='args', default=100,
+                                   help='The number of items in a page.')
+
+host_facet_args = host_filter_args.copy()
+host_facet_args.add_argument('key', type=str, location='args', action='append', required=True,
+                             help='The counted keys, host columns or CMDB attributes, e.g. site or qs')
+
 file_parser = reqparse.RequestParser()
 file_parser.add_argument('file', location='files', type=FileStorage, required=True)
 
@@ -172,10 +244,10 @@ class Hosts(Resource):
         args = host_list_args.parse_args()
         app.logger.debug("Get host list's params are: {}".format(args))
         try:
-            hosts = host_api.get_hosts_list(business=args.identity_ip, fuzzy_query=args.fuzzy_query)
+            hosts = host_api.get_hosts_list(business=args.business, fuzzy_query=args.fuzzy_query)
         except ResourceNotFoundError as e:
-            app.logger.error("Host list can\'t be found with params: identity_ip={}, fuzzy_query={}". \
-                             format(args.host_ip, args.fuzzy_query))
+            app.logger.error("Host list can\'t be found with params: business={}, fuzzy_query={}". \
+                             format(args.business, args.fuzzy_query))
             abort(404, e.message)
 
         app.logger.info("Get host list's result {}".format(hosts))
@@ -183,6 +255,76 @@ class Hosts(Resource):
         return hosts
 
 
+@ns.route('/search')
+class HostSearch(Resource):
+    """
+    Search the hosts for the target picker
+    """
+
+    @ns.doc('search_hosts')
+    @ns.expect(host_search_args)
+    @ns.marshal_list_with(host_search_model)
+    def get(self):
+        """
+        Search the hosts by name, ip, description or CMDB attributes
+        Returns:
+             the matched hosts, the exact matches first, then the prefix matches
+        """
+        args = host_search_args.parse_args()
+        app.logger.debug("Search hosts with params: {}".format(args))
+        return host_search_api.search_hosts(args.q, business=args.business, prefix=args.prefix, limit=args.limit)
+
+
+def _parse_filters(items):
+    """ {key: [values]} of the filters <key>:<value> """
+    filters = {}
+    for item in items:
+        key, sep, value = item.partition(':')
+        if not sep or not key:
+            abort(400, 'Invalid filter {}, expect <key>:<value>'.format(item))
+        filters.setdefault(key, []).append(value)
+    return filters
+
+
+@ns.route('/filter')
+class HostFilter(Resource):
+    """
+    Filter the hosts by their columns and CMDB attributes
+    """
+
+    @ns.doc('filter_hosts')
+    @ns.expect(host_filter_page_args)
+    @ns.marshal_with(host_pagination_model)
+    def get(self):
+        """
+        Get a page of the hosts matching all filters, e.g. site:IDC1 and qs:QS1
+        """
+        args = host_filter_page_args.parse_args()
+        app.logger.debug("Filter hosts with params: {}".format(args))
+        return host_attribute_api.filter_hosts(_parse_filters(args['filter']), business=args.business,
+                                               page=args.page, per_page=args.per_page)
+
+
+@ns.route('/facets')
+class HostFacets(Resource):
+    """
+    Count the hosts of each value of their columns and CMDB attributes
+    """
+
+    @ns.doc('count_host_facets')
+    @ns.expect(host_facet_args)
+    def get(self):
+        """
+        Count the hosts matching the filters by each value of the keys
+        Returns:
+             {key: [{'value', 'count'}]}, the counts of a key apply the filters of the other keys
+        """
+        args = host_facet_args.parse_args()
+        app.logger.debug("Count host facets with params: {}".format(args))
+        return host_attribute_api.count_host_facets(args.key, filters=_parse_filters(args['filter']),
+                                                    business=args.business), 200
+
+
 @ns.route('/<string:identifier>')
 @ns.param('identifier', 'The host\'s identifier, eg, \'1\' or \'a_1\'')
 class Host(Resource):
@@ -249,6 +391,19 @@ class HostIps(Resource):
         return host_ips
 
 
+def _start_import(kind, business, login_name):
+    """ save the uploaded file and import it in the background, returns the job """
+    uploaded_file = file_parser.parse_args()['file']
+    if not uploaded_file or not allowed_file(uploaded_file.filename):
+        abort(400, 'The uploaded file shall be one of {}'.format(sorted(ALLOWED_EXTENSIONS)))
+    FILE_DIR = os.path.join(app.root_path, 'upload_files', 'host')
+    server_path = os.path.join(FILE_DIR, '{}_{}'.format(uuid.uuid4().hex, secure_filename(uploaded_file.filename)))
+    uploaded_file.save(server_path)
+    job = host_import_api.create_import_job(kind, business, server_path, uploaded_file.filename, login_name)
+    app.logger.info(u'Import {} of {} from {}, job: {}'.format(kind, business, uploaded_file.filename, job.id))
+    return host_import_api.start_import_job(job)
+
+
 @ns.route('/accounts')
 class ImportAccount(Resource):
     """
@@ -256,31 +411,14 @@ class ImportAccount(Resource):
     """
     @ns.doc('import host accounts')
     @ns.expect(file_parser)
-    @ns.marshal_list_with(update_account_model)
+    @ns.marshal_with(host_import_job_model, code=202)
     def post(self):
         """
-        Update the hosts' accounts by uploaded file
+        Update the hosts' accounts by uploaded file, the file is imported in the background
         """
-        args = file_parser.parse_args()
-        business = request.cookies.get('BussinessGroup')
-        app.logger.debug("Get import host account args {} in bussiness {}".format(args, business))
-        try:
-            uploaded_file = args['file']
-            if uploaded_file and allowed_file(uploaded_file.filename):
-                FILE_DIR = os.path.join(app.root_path, 'upload_files', 'host')
-                server_path = os.path.join(FILE_DIR, uploaded_file.filename)
-                uploaded_file.save(server_path)
-            host_accounts = parser.TextParser(server_path).parse()
-            app.logger.info('Host accounts from file ====> {}'.format(host_accounts))
-            hosts = host_api.sync_host_accounts(host_accounts, business)
-            app.logger.info('Host accounts Sync to DB ====> {}'.format(hosts))
-        except Error as e:
-            app.logger.error("Import host account Error {}".format(e.message))
-            abort(404, e.message)
-
-        app.logger.debug("Imported  host account {}".format(hosts))
-
-        return hosts
+        business = request.cookies.get('BussinessGroup') or 'LDDS'
+        login_name = session.get('user_info').get('user')
+        return _start_import('accounts', business, login_name), 202
 
 
 @ns.route('/infos')
@@ -290,33 +428,33 @@ class ImportInformation(Resource):
     """
     @ns.doc('import host information, excluding host accounts')
     @ns.expect(file_parser)
-    @ns.marshal_with(update_host_info_model)
+    @ns.marshal_with(host_import_job_model, code=202)
     def post(self):
         """
-        update hosts' basic information by uploaded file
+        update hosts' basic information by uploaded file, the file is imported in the background
         """
-        args = file_parser.parse_args()
-        business = request.cookies.get('BussinessGroup')
+        business = request.cookies.get('BussinessGroup') or 'LDDS'
         login_name = session.get('user_info').get('user')
-        business = business or 'LDDS'
+        return _start_import('infos', business, login_name), 202
 
-        app.logger.debug("Get import host information args {}".format(args))
+
+@ns.route('/imports/<int:identifier>')
+@ns.param('identifier', 'The import job\'s identifier')
+class ImportJob(Resource):
+    """
+    The progress of an import by uploaded file
+    """
+    @ns.doc('get an import job')
+    @ns.marshal_with(host_import_job_model)
+    def get(self, identifier):
+        """
+        Get an import job with its progress
+        """
         try:
-            uploaded_file = args['file']
-            if uploaded_file and allowed_file(uploaded_file.filename):
-                FILE_DIR = os.path.join(app.root_path, 'upload_files', 'host')
-                server_path = os.path.join(FILE_DIR, uploaded_file.filename)
-                uploaded_file.save(server_path)
-            hosts_items = parser.CsvParser(server_path).parse()
-            sync_hosts = host_api.sync_hosts_info(hosts_items, business, login_name)
-        except Error as e:
-            app.logger.error("Import host information Error {}".format(e.message))
+            return host_import_api.get_import_job(identifier)
+        except ResourceNotFoundError as e:
             abort(404, e.message)
 
-        app.logger.debug("Imported  host information {}".format(sync_hosts))
-
-        return sync_hosts
-
 
 @ns.route('/cmdb')
 class SyncCMDB(Resource):
@@ -327,20 +465,35 @@ class SyncCMDB(Resource):
     @ns.marshal_with(update_host_info_model)
     def post(self):
         """
-        Sync host information with CMDB
+        Sync host information with CMDB, under the lock of the periodic sync of the business
         """
         business = request.cookies.get('BussinessGroup')
         login_name = session.get('user_info').get('user')
         business = business or 'LDDS'
-        try:
-            results = host_api.sync_host_with_cmdb(business, login_name)
-        except Error as e:
-            app.logger.error("Sync hosts with CMDB", e.message)
-            abort(404, e.message)
+        run, results = cmdb_sync_api.run_manual_cmdb_sync(business, login_name)
+        if run is None:
+            abort(409, 'The hosts of {} are being synced with CMDB, please retry later'.format(business))
+        if run.status == 'failed':
+            app.logger.error("Sync hosts with CMDB: {}".format(run.error))
+            abort(404, run.error)
 
         return results, 200
 
 
+@ns.route('/cmdb/runs')
+class CMDBSyncRuns(Resource):
+    """
+    The periodic syncs with CMDB
+    """
+    @ns.doc('list the last sync run of each business')
+    @ns.marshal_list_with(cmdb_sync_run_model)
+    def get(self):
+        """
+        Get the last sync run of each business
+        """
+        return cmdb_sync_api.get_last_cmdb_sync_runs(), 200
+
+
 @ns.route('/scheduler/')
 class SyncScheduler(Resource):
     """
@@ -355,7 +508,7 @@ class SyncScheduler(Resource):
         business = business or 'LDDS'
         app.logger.info("Sync hosts with scheduler args: {}".format(business))
         try:
-            results = group_api.sync_all_groups_with_scheduler(business)
+            results = group_api.sync_all_groups_with_scheduler(business, force=True)
             app.logger.info("Sync hosts with scheduler result: {}".format(results))
         except Error as e:
             app.logger.error("Sync hosts with scheduler", e.message)
@@ -6,3 +6,4 @@ ns = Namespace('/v1/workers', description='Get all celery worker stats')
 
 import health
 import statistic
+import scheduler
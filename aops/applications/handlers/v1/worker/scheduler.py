@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from flask import current_app as app
+from flask_restplus import Resource, fields, Model
+
+from aops.applications.common.scheduler_request import get_scheduler_stats
+from aops.applications.handlers.v1.worker import ns
+
+scheduler_endpoint_model = Model('SchedulerEndpointStats', {
+    'endpoint': fields.String(required=True, description="The method and path of the Scheduler endpoint"),
+    'count': fields.Integer(required=True, description="The number of calls"),
+    'errors': fields.Integer(required=True, description="The number of failed calls"),
+    'avg_ms': fields.Float(required=True, description="The average latency in milliseconds"),
+    'max_ms': fields.Float(required=True, description="The max latency in milliseconds"),
+})
+
+scheduler_cache_model = Model('SchedulerCacheStats', {
+    'endpoint': fields.String(required=True, description="The path of the cached Scheduler endpoint"),
+    'hits': fields.Integer(required=True, description="The number of GETs served by the cache"),
+    'misses': fields.Integer(required=True, description="The number of GETs sent to the Scheduler"),
+    'coalesced': fields.Integer(required=True, description="The number of GETs sharing an in-flight call"),
+})
+
+scheduler_stats_model = Model('SchedulerStats', {
+    'circuit': fields.String(required=True, description="The circuit state: closed, open or half_open"),
+    'failures': fields.Integer(required=True, description="The number of continuous failures"),
+    'endpoints': fields.List(fields.Nested(scheduler_endpoint_model)),
+    'cache': fields.List(fields.Nested(scheduler_cache_model)),
+})
+
+ns.add_model(scheduler_endpoint_model.name, scheduler_endpoint_model)
+ns.add_model(scheduler_cache_model.name, scheduler_cache_model)
+ns.add_model(scheduler_stats_model.name, scheduler_stats_model)
+
+
+@ns.route('/scheduler-stats')
+class SchedulerStats(Resource):
+    """The Scheduler client and response cache stats of current AOPS worker."""
+
+    @ns.doc('Get the Scheduler client stats of current AOPS worker')
+    @ns.marshal_with(scheduler_stats_model)
+    def get(self):
+        """Get the circuit state and the per endpoint counters of the Scheduler client."""
+        stats = get_scheduler_stats()
+        app.logger.debug("Get the Scheduler client stats: {}".format(stats))
+        return stats
@@ -4,8 +4,10 @@
 import json
 import datetime
 from flask import current_app as app, jsonify
+import gevent
 from aops.applications.common.cmdb_request import CmdbRequest
-from aops.conf.cmdb_config import CMDB_BUSINESSES, SUPPLIER_ACCOUNT, CMDB_VERSION
+from aops.conf.cmdb_config import CMDB_BUSINESSES, SUPPLIER_ACCOUNT, CMDB_VERSION, CMDB_PAGE_SIZE, \
+    CMDB_PAGE_TIMEOUT
 
 """
     User login for CMDB
@@ -14,21 +16,61 @@ from aops.conf.cmdb_config import CMDB_BUSINESSES, SUPPLIER_ACCOUNT, CMDB_VERSIO
 
 def get_host_list(business='LDDS'):
     """ GET host instance list by business, LDDS, CLOUD, ... """
+    results = [host for page in iter_host_pages(business) for host in page]
+    return results or None, len(results)
+
+
+def _get_host_page(business, start, limit, condition=None):
+    """ GET a page of the host instances by business, returns the instances and the total count """
     endpoint = "api/{}/inst/association/search/owner/{}/object/{}".\
         format(CMDB_VERSION, SUPPLIER_ACCOUNT, CMDB_BUSINESSES[business])
-    data = {"page":{"sort":"-bk_inst_id"},"fields":{},"condition":{}}
+    data = {"page": {"start": start, "limit": limit, "sort": "-bk_inst_id"}, "fields": {},
+            "condition": {CMDB_BUSINESSES[business]: condition} if condition else {}}
     headers = {'Content-Type': 'application/json;charset=utf-8'}
 
-    response = CmdbRequest(endpoint).post(data=json.dumps(data), headers=headers)
+    response = CmdbRequest(endpoint).post(data=json.dumps(data), headers=headers, timeout=CMDB_PAGE_TIMEOUT)
 
     if response['data'] and response['data']['count']:
-        results, count = response['data']['info'], response['data']['count']
-    else:
-        results, count = None, 0
+        return response['data']['info'] or [], response['data']['count']
+    return [], 0
 
-    app.logger.info('Get host list with business<{}> , count: {}, results: {}'.format(business, count, results))
 
-    return results, count
+def iter_host_pages(business='LDDS', condition=None, page_size=CMDB_PAGE_SIZE):
+    """
+    Iterate the host instances of the business page by page, ordered by bk_inst_id desc. Each page
+    continues below the last bk_inst_id of the previous one instead of at an offset, so an instance
+    deleted meanwhile doesn't shift the next pages and hide a live instance from the sync deleting
+    the unseen hosts. The next page is fetched while the consumer handles the current one.
+    Args:
+        business: LDDS, CLOUD, ...
+        condition: the conditions of the instances, e.g. [{"field": "os", "operator": "$eq", "value": "AIX"}]
+        page_size: the host instances of a page
+    Yields:
+        the host instances of a page
+    """
+    flask_app = app._get_current_object()
+
+    def _fetch(last_id):
+        conditions = list(condition or [])
+        if last_id is not None:
+            conditions.append({"field": "bk_inst_id", "operator": "$lt", "value": last_id})
+        with flask_app.app_context():
+            return _get_host_page(business, 0, page_size, conditions)[0]
+
+    first, count = _get_host_page(business, 0, page_size, condition)
+    app.logger.info('Get host list with business<{}>, count: {}'.format(business, count))
+    page = first
+    while page:
+        fetching = gevent.spawn(_fetch, page[-1]['bk_inst_id']) if len(page) >= page_size else None
+        try:
+            yield page
+        except GeneratorExit:
+            if fetching is not None:
+                fetching.kill()
+            raise
+        if fetching is None:
+            return
+        page = fetching.get()
 
 
 def get_all_machine_list():
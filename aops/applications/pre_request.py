@@ -1,23 +1,17 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 from flask import session, request, abort, current_app as app
-from aops.applications.database.apis.system.user.user import get_user_with_name
-from aops.applications.database.apis.user_permission.user_role import get_user_roles
-from aops.applications.database.apis.user_permission.role_permission import get_role_permissions
+from aops.applications.database.apis.user_permission.snapshot import get_user_permission_snapshot
 
 
 def _update_user_permissions(username):
-    user = get_user_with_name(username)
-    privileges = [(role.name, permission.permission) for role in user.roles for permission in
-                  role.permissions]
-    roles = list(set(map(lambda item: item[0], privileges)))
-    permissions = list(set(map(lambda item: item[1], privileges)))
-    session['user_info'] = {
-        'user': user.username,
-        'roles': roles,
-        'permissions': permissions
-    }
-    app.logger.debug('User info in Session: {}'.format(session['user_info']))
+    user_info = get_user_permission_snapshot(username)
+    if user_info is None:
+        abort(401, u'登录失效')
+    # only rewrite the session when the user's grants changed
+    if session.get('user_info') != user_info:
+        session['user_info'] = user_info
+        app.logger.debug('User info in Session: {}'.format(session['user_info']))
 
 
 def _in_white_list(base_url):
@@ -6,6 +6,9 @@ CMDB_HOST = "10.111.2.59"
 CMDB_PORT = 8083
 SUPPLIER_ACCOUNT = 0
 CMDB_VERSION = 'v3'
+CMDB_PAGE_SIZE = 500    # the host instances fetched by a page
+CMDB_PAGE_TIMEOUT = 30    # seconds a page may take
+CMDB_WATERMARK_FIELD = 'last_time'    # the update time of an instance kept by CMDB
 CMDB_BUSINESSES = {
     'LDDS': 'vm_private',
     'CLOUD': 'vm_public',
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Benchmark for rotating the passwords of the host accounts.
+
+Compare sync_host_accounts before BulkAccountSync, which deletes and recreates the accounts
+of every host with a commit each, with the diff of BulkAccountSync, on a rotation where one
+account of a part of the hosts gets a new password.
+
+Usage:
+    python benchmarks/bench_account_rotation.py [--hosts 1000] [--changed 0.5]
+"""
+import argparse
+import datetime
+import json
+import logging
+import time
+
+from sqlalchemy import event
+
+from aops.app import create_testing_app
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host.host_sync import BulkAccountSync, sync_hosts_in_bulk
+from aops.applications.database.models import Host, HostAccount, InventoryDelta
+
+
+def _infos(hosts):
+    return [{'name': 'host{}'.format(i), 'identity_ip': '10.{}.{}.{}'.format(i // 65536, i // 256 % 256, i % 256),
+             'os': 'Linux', 'business': 'LDDS', 'type': 'host', 'others': json.dumps([])} for i in range(hosts)]
+
+
+def _accounts(hosts, changed=0.0):
+    step = int(1 / changed) if changed else 0
+    accounts = []
+    for i in range(hosts):
+        accounts.append({'host_name': 'host{}'.format(i), 'username': 'root',
+                         'password': 'new{}'.format(i) if step and i % step == 0 else 'old{}'.format(i)})
+        accounts.append({'host_name': 'host{}'.format(i), 'username': 'admin', 'password': 'admin'})
+    return accounts
+
+
+def _one_by_one(accounts, business):
+    """ sync_host_accounts before BulkAccountSync """
+    account_map = {}
+    for account in accounts:
+        account_map.setdefault(account['host_name'], []).append(
+            HostAccount(username=account['username'], password=account['password']))
+    hosts = Host.query.filter(Host.name.in_(list(account_map)), Host.business == business).all()
+    for host in hosts:
+        for account in host.accounts:
+            account.delete()
+        host.update(accounts=account_map[host.name], updated_at=datetime.datetime.now())
+        db.session.add(InventoryDelta(business=business, node_type='host', node_id=host.id, action='update'))
+    db.session.commit()
+    return hosts
+
+
+def _bulk(accounts, business):
+    sync = BulkAccountSync(business)
+    sync.add(accounts)
+    return sync.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', type=int, default=1000)
+    parser.add_argument('--changed', type=float, default=0.5)
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    for label, sync in [('one-by-one', _one_by_one), ('bulk', _bulk)]:
+        app = create_testing_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "SQLALCHEMY_ECHO": False,
+                                  "REDIS_HOST": None})
+        with app.app_context():
+            db.create_all()
+            sync_hosts_in_bulk(_infos(args.hosts), 'LDDS')
+            _bulk(_accounts(args.hosts), 'LDDS')
+            InventoryDelta.query.delete()
+            db.session.commit()
+
+            accounts = _accounts(args.hosts, args.changed)
+            statements = []
+            event.listen(db.engine, 'before_cursor_execute', lambda *params: statements.append(params[2]))
+            started = time.time()
+            sync(accounts, 'LDDS')
+            cost = time.time() - started
+            print('{:<10} deltas {:>6} {:>8} statements {:>10.1f} ms'.format(
+                label, InventoryDelta.query.count(), len(statements), cost * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Benchmark for the audit search.
+
+Compare the leading-wildcard LIKE filters of the audit list before the audit indexes with
+the filters served by the composite indexes and the audit token index, on a synthetic
+audit table. The table is generated once into the given sqlite file and reused later.
+
+Usage:
+    python benchmarks/bench_audit_search.py [--rows 2000000] [--db /tmp/bench_audit.db]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app as app
+from sqlalchemy import or_
+
+from aops.app import create_testing_app
+from aops.applications.database import db
+from aops.applications.database.apis.audit.audit import _filter_audits
+from aops.applications.database.apis.audit.audit_index import generate_grams, TOKEN_FIELDS
+from aops.applications.database.models.audit.audit import Audit
+
+USERS = ['user{}'.format(i) for i in range(200)]
+RESOURCES = ['tasks', 'jobs', 'hosts', 'groups', 'files', 'scripts', 'flows', 'users', 'roles', 'audits']
+METHODS = ['get', 'post', 'put', 'delete']
+STATUSES = ['200', '200', '200', '200', '400', '404', '500']
+NOTES = ['deploy', 'rollback', 'restart', 'upgrade', 'backup', 'check']
+ROUNDS = 5
+
+CASES = [
+    ('user', {'user': 'user199'}),
+    ('time range', {'start_time': '2018-01-20', 'end_time': '2018-01-21'}),
+    ('status', {'status': '500', 'resource_type': 'flows'}),
+    ('operation', {'operation': 'delete_Roles'}),
+    ('message', {'message': '"identifier": 123457}'}),
+    ('fuzzy query', {'fuzzy_query': 'rollback'}),
+]
+
+
+def _generate(path, rows):
+    conn = sqlite3.connect(path)
+    start = datetime(2018, 1, 1)
+    batch_size = 10000
+    for offset in range(0, rows, batch_size):
+        audits, tokens = [], []
+        for audit_id in range(offset + 1, min(offset + batch_size, rows) + 1):
+            resource = random.choice(RESOURCES)
+            created_at = str(start + timedelta(seconds=audit_id * 15))
+            operation = '{}_{}'.format(random.choice(METHODS), resource.capitalize())
+            message = '{{"path_args": {{"identifier": {}}}, "notes": "{}"}}'.format(audit_id, random.choice(NOTES))
+            audits.append((audit_id, created_at, created_at, 0, random.choice(USERS), '10.0.{}.{}'.format(
+                audit_id % 256, audit_id % 200), resource, audit_id % 1000, operation, random.choice(STATUSES),
+                message))
+            for field, value in zip(TOKEN_FIELDS, (operation, message)):
+                tokens.extend((audit_id, field, token) for token in generate_grams(value))
+        conn.executemany('INSERT INTO audit (id, created_at, updated_at, is_deleted, user, source_ip, resource, '
+                         'resource_id, operation, status, message) VALUES (?,?,?,?,?,?,?,?,?,?,?)', audits)
+        conn.executemany('INSERT INTO audit_token (audit_id, field, token) VALUES (?,?,?)', tokens)
+        conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+
+
+def _legacy_filter(args):
+    """ the audit list filters before the audit indexes """
+    q = Audit.query.filter_by(is_deleted=False).order_by(Audit.updated_at.desc())
+    if args.get('user'):
+        q = q.filter(Audit.user.like("%{}%".format(args.get('user'))))
+    if args.get('start_time'):
+        q = q.filter(Audit.created_at >= datetime.strptime(args.get('start_time'), app.config.get("DATE_FORMAT")))
+    if args.get('end_time'):
+        q = q.filter(Audit.updated_at <= datetime.strptime(args.get('end_time'), app.config.get("DATE_FORMAT")))
+    for key, column in [('resource_type', Audit.resource), ('operation', Audit.operation),
+                        ('status', Audit.status), ('message', Audit.message)]:
+        if args.get(key):
+            q = q.filter(column.like("%{}%".format(args.get(key))))
+    if args.get('fuzzy_query'):
+        q = q.filter(or_(Audit.operation.like("%{}%".format(args.get('fuzzy_query'))),
+                         Audit.message.like("%{}%".format(args.get('fuzzy_query')))))
+    return q
+
+
+def _measure(build, args):
+    cost = 0
+    for _ in range(ROUNDS):
+        started = time.time()
+        page = build(args).paginate(page=1, per_page=20, error_out=False)
+        cost += time.time() - started
+    return cost * 1000 / ROUNDS, page.total
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--db', default='/tmp/bench_audit.db')
+    options = parser.parse_args()
+
+    app = create_testing_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///{}".format(options.db),
+                              "SQLALCHEMY_ECHO": False})
+    with app.app_context():
+        exists = os.path.exists(options.db)
+        db.create_all()
+        if not exists:
+            started = time.time()
+            _generate(options.db, options.rows)
+            print('generate {} audits in {:.1f}s'.format(options.rows, time.time() - started))
+        print('audits: {}'.format(Audit.query.count()))
+
+        print('{:<12} {:>14} {:>14} {:>10}'.format('filter', 'like scan(ms)', 'indexed(ms)', 'matched'))
+        for name, args in CASES:
+            legacy_cost, legacy_total = _measure(_legacy_filter, args)
+            indexed_cost, indexed_total = _measure(_filter_audits, args)
+            assert legacy_total == indexed_total
+            print('{:<12} {:>14.1f} {:>14.1f} {:>10}'.format(name, legacy_cost, indexed_cost, indexed_total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Benchmark for recomputing the members of the dynamic groups.
+
+Compare one filter query and one link diff per group with the host sets and the links shared
+by the groups of dynamic_group, for all the groups and for the groups reading a changed
+attribute only, on synthetic hosts synced in bulk.
+
+Usage:
+    python benchmarks/bench_dynamic_groups.py [--hosts 100000]
+"""
+import argparse
+import json
+import time
+
+from sqlalchemy import or_
+
+from aops.app import create_testing_app
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host import dynamic_group
+from aops.applications.database.apis.resource.host.dynamic_group import parse_rule, recompute_dynamic_groups
+from aops.applications.database.apis.resource.host.host_attribute import host_criteria
+from aops.applications.database.apis.resource.host.host_sync import sync_hosts_in_bulk
+from aops.applications.database.models.resource.host import Group, Host
+
+ROUNDS = 3
+
+
+def _generate(hosts):
+    infos = []
+    for i in range(hosts):
+        others = [{'key_cn': 'qs', 'key_en': 'qs', 'value': 'QS{}'.format(i % 16)},
+                  {'key_cn': 'xxs', 'key_en': 'xxs', 'value': 'XXS{}'.format(i % 40)},
+                  {'key_cn': 'app', 'key_en': 'app', 'value': 'app{}'.format(i % 300)}]
+        ip = '10.{}.{}.{}'.format(i // 65536, i // 256 % 256, i % 256)
+        infos.append({'name': 'host{}'.format(i), 'identity_ip': ip, 'business': 'LDDS', 'type': 'host',
+                      'site': 'IDC{}'.format(i % 3), 'os': 'Windows' if i % 5 else 'CentOS',
+                      'machine': 'pm-{}'.format(i % 7) if i % 2 else None, 'others': json.dumps(others)})
+    sync_hosts_in_bulk(infos, 'LDDS')
+
+
+def _rules():
+    """ the groups of each qs and site, each xxs and host type, each app and os """
+    rules = []
+    for i in range(16):
+        rules.extend({'qs': 'QS{}'.format(i), 'site': 'IDC{}'.format(site)} for site in range(3))
+    for i in range(40):
+        rules.extend({'xxs': 'XXS{}'.format(i), 'host_type': host_type} for host_type in ('Virtual', 'Physical'))
+    for i in range(0, 300, 20):
+        rules.extend({'app': ['app{}'.format(i), 'app{}'.format(i + 1)], 'os': os} for os in ('Linux', 'Windows'))
+    return rules
+
+
+def _per_group():
+    """ one filter query and one link diff per group """
+    for group in Group.query.filter(Group.rule.isnot(None)):
+        rule = parse_rule(group.rule)
+        filters = dict((key, value) for key, value in rule.items() if key not in dynamic_group.DERIVED_FIELDS)
+        criteria = host_criteria(filters, 'LDDS')
+        criteria.extend(or_(*[dynamic_group._derived_criteria(key, value) for value in values])
+                        for key, values in rule.items() if key in dynamic_group.DERIVED_FIELDS)
+        members = set(id for id, in db.session.query(Host.id).filter(*criteria))
+        dynamic_group._link_members(group.id, dynamic_group._load_links([group.id])[group.id], members)
+    db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', type=int, default=100000)
+    args = parser.parse_args()
+
+    app = create_testing_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "SQLALCHEMY_ECHO": False,
+                              "REDIS_HOST": None})
+    with app.app_context():
+        db.create_all()
+        _generate(args.hosts)
+        rules = _rules()
+        for i, rule in enumerate(rules):
+            db.session.add(Group(pid=0, name='dynamic{}'.format(i), business='LDDS', type='group',
+                                 rule=json.dumps(parse_rule(rule))))
+        db.session.commit()
+        recompute_dynamic_groups('LDDS')
+        print('hosts: {}, dynamic groups: {}'.format(args.hosts, len(rules)))
+
+        runs = [('query per group', _per_group),
+                ('host sets, all', lambda: recompute_dynamic_groups('LDDS')),
+                ('host sets, qs', lambda: recompute_dynamic_groups('LDDS', set(['qs'])))]
+        for label, run in runs:
+            started = time.time()
+            for _ in range(ROUNDS):
+                run()
+            print('{:<16} {:>10.1f} ms'.format(label, (time.time() - started) / ROUNDS * 1000))
+        print('members: {}'.format(sum(len(group.hosts) for group in Group.query.filter(Group.rule.isnot(None)))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Benchmark for filtering and counting hosts by their CMDB attributes.
+
+Compare decoding host.others of every host, the only way to read the attributes before
+host_attribute, with the indexed lookups of filter_hosts and count_host_facets on synthetic
+hosts synced in bulk.
+
+Usage:
+    python benchmarks/bench_host_facets.py [--hosts 100000]
+"""
+import argparse
+import json
+import time
+from collections import Counter
+
+from aops.app import create_testing_app
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host.host_attribute import count_host_facets, filter_hosts, \
+    host_criteria
+from aops.applications.database.apis.resource.host.host_sync import sync_hosts_in_bulk
+from aops.applications.database.models.resource.host import Host
+
+ROUNDS = 3
+FILTERS = {'site': ['IDC2'], 'qs': ['QS7']}
+
+
+def _generate(hosts):
+    infos = []
+    for i in range(hosts):
+        others = [{'key_cn': 'qs', 'key_en': 'qs', 'value': 'QS{}'.format(i % 16)},
+                  {'key_cn': 'xxs', 'key_en': 'xxs', 'value': 'XXS{}'.format(i % 40)},
+                  {'key_cn': 'app', 'key_en': 'app', 'value': 'app{}'.format(i % 300)},
+                  {'key_cn': 'zf_ip', 'key_en': 'zf_ip', 'value': '172.16.{}.{}'.format(i // 256 % 256, i % 256)}]
+        ip = '10.{}.{}.{}'.format(i // 65536, i // 256 % 256, i % 256)
+        infos.append({'name': 'host{}'.format(i), 'identity_ip': ip, 'business': 'LDDS', 'type': 'host',
+                      'site': 'IDC{}'.format(i % 3), 'others': json.dumps(others)})
+    sync_hosts_in_bulk(infos, 'LDDS')
+
+
+def _decode_all():
+    """ filter and count by decoding the others of every host """
+    matched, facets = [], {'site': Counter(), 'qs': Counter()}
+    for host in Host.query.filter_by(is_deleted=False, business='LDDS'):
+        others = dict((item['key_en'], item['value']) for item in json.loads(host.others or '[]'))
+        if host.site in FILTERS['site']:
+            facets['qs'][others.get('qs')] += 1
+        if others.get('qs') in FILTERS['qs']:
+            facets['site'][host.site] += 1
+            if host.site in FILTERS['site']:
+                matched.append(host.id)
+    return len(matched), facets
+
+
+def _indexed():
+    total = db.session.query(Host.id).filter(*host_criteria(FILTERS, 'LDDS')).count()
+    filter_hosts(FILTERS, business='LDDS', per_page=100)
+    return total, count_host_facets(['site', 'qs'], filters=FILTERS, business='LDDS')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', type=int, default=100000)
+    args = parser.parse_args()
+
+    app = create_testing_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "SQLALCHEMY_ECHO": False,
+                              "REDIS_HOST": None})
+    with app.app_context():
+        db.create_all()
+        _generate(args.hosts)
+        print('hosts: {}, filters: {}'.format(args.hosts, FILTERS))
+        for label, run in [('decode others', _decode_all), ('indexed', _indexed)]:
+            started = time.time()
+            for _ in range(ROUNDS):
+                db.session.expire_all()
+                matched, facets = run()
+            cost = (time.time() - started) / ROUNDS
+            print('{:<14} {:>6} matched hosts {:>10.1f} ms'.format(label, matched, cost * 1000))
+
+
+if __name__ == '__main__':
+    main()
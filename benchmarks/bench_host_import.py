@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Benchmark for importing a host file.
+
+Compare the import before the jobs, which parses the whole file into a list and syncs it in
+one go, with run_import_job, which streams the rows and syncs them batch by batch. Each mode
+runs in its own process on its own sqlite file, so the peak resident memory of the process is
+the one of the mode and not of an in-memory database.
+
+Usage:
+    python benchmarks/bench_host_import.py [--hosts 100000] [--batch 500]
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from aops.app import create_testing_app
+from aops.applications.common.parser import CsvParser
+from aops.applications.common.scheduler_request import SchedulerApi
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host.host import sync_hosts_info
+from aops.applications.database.apis.resource.host.host_import import create_import_job, run_import_job
+from aops.applications.database.models import Group
+
+ANNOTATION = u'实例名,内网IP1,操作系统,状态\r\n类型,类型,类型,类型\r\n'.encode('utf-8')
+
+
+def _write(path, hosts):
+    with open(path, 'wb') as f:
+        f.write(ANNOTATION)
+        f.write('bk_inst_name,cwdm_ip1,os,status\r\n')
+        for i in range(hosts):
+            f.write('host{},10.{}.{}.{},Linux,on\r\n'.format(i, i // 65536, i // 256 % 256, i % 256))
+
+
+def _run(mode, path, batch, database):
+    SchedulerApi.post = lambda self, **kwargs: {}
+    logging.disable(logging.INFO)    # the rows logged by the debug lines would be measured too
+    app = create_testing_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + database, "SQLALCHEMY_ECHO": False,
+                              "REDIS_HOST": None})
+    with app.app_context():
+        db.create_all()
+        Group.create(pid=0, name='LDDS', business='LDDS', type='business')
+        started = time.time()
+        if mode == 'parse all':
+            hosts = len(sync_hosts_info(CsvParser(path).parse(), 'LDDS', 'admin')['added'])
+        else:
+            job = run_import_job(create_import_job('infos', 'LDDS', path, 'hosts.csv', 'admin'), batch_size=batch)
+            hosts = job.added
+        cost = time.time() - started
+    print(json.dumps({'hosts': hosts, 'ms': cost * 1000,
+                      'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', type=int, default=100000)
+    parser.add_argument('--batch', type=int, default=500)
+    parser.add_argument('--mode')
+    parser.add_argument('--path')
+    parser.add_argument('--database')
+    args = parser.parse_args()
+    if args.mode:
+        return _run(args.mode, args.path, args.batch, args.database)
+
+    fd, path = tempfile.mkstemp(suffix='.csv')
+    os.close(fd)
+    try:
+        _write(path, args.hosts)
+        print('hosts: {}, file: {:.1f} MB'.format(args.hosts, os.path.getsize(path) / 1024.0 / 1024))
+        for mode in ('parse all', 'batches'):
+            shutil.copy(path, path + '.upload')    # the job deletes its upload
+            database = tempfile.mktemp(suffix='.db')
+            try:
+                output = subprocess.check_output([sys.executable, __file__, '--mode', mode, '--path', path + '.upload',
+                                                  '--batch', str(args.batch), '--database', database])
+            finally:
+                for name in (path + '.upload', database):
+                    if os.path.exists(name):
+                        os.remove(name)
+            result = json.loads(output.strip().splitlines()[-1])
+            print('{:<10} added {:>7} {:>10.1f} ms, peak rss {:>7.1f} MB'.format(
+                mode, result['hosts'], result['ms'], result['rss']))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
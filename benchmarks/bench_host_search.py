@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Benchmark for the host search of the target picker.
+
+Compare a LIKE scan of the concatenated host columns, the query get_hosts_list meant to run
+before the index, with the trigram index of host_search on synthetic hosts carrying CMDB
+attributes in others. Reports the build time and the growth of the worker's memory too.
+
+Usage:
+    python benchmarks/bench_host_search.py [--hosts 100000]
+"""
+import argparse
+import json
+import os
+import time
+
+from aops.app import create_testing_app
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host import host_search
+from aops.applications.database.models.resource.host import Host
+
+ROUNDS = 20
+QUERIES = [
+    ('exact ip', '10.1.134.96', False),
+    ('ip prefix', '10.1.13', True),
+    ('name substring', 'st-99', False),
+    ('name prefix, 2 chars', 'we', True),
+    ('short substring', '7', False),
+    ('cmdb attribute', 'rack-c12', False),
+    ('no match', 'nothing-here', False),
+]
+
+
+def _generate(hosts):
+    sites = ['IDC1', 'IDC2', 'IDC3']
+    db.session.execute(Host.__table__.insert(), [
+        {'id': i + 1, 'name': '{}-host-{}'.format('web' if i % 3 else 'db', i), 'business': 'LDDS', 'type': 'host',
+         'is_deleted': False, 'identity_ip': '10.{}.{}.{}'.format(i // 65536, i // 256 % 256, i % 256),
+         'description': 'synthetic host {}'.format(i),
+         'others': json.dumps([
+             {'key_cn': 'site', 'key_en': 'site', 'value': sites[i % 3]},
+             {'key_cn': 'cabinet', 'key_en': 'cabinet', 'value': 'rack-{}{}'.format('ABCDEFGH'[i % 8], i % 50)},
+             {'key_cn': 'host', 'key_en': 'host', 'value': 'pm-{}'.format(i // 20)},
+             {'key_cn': 'status', 'key_en': 'status', 'value': 'running'},
+         ])} for i in range(hosts)])
+    db.session.commit()
+
+
+def _rss():
+    """ the resident memory of the process in MB, linux only """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024.0 / 1024.0
+
+
+def _like(query):
+    pattern = u'%{}%'.format(query)
+    return db.session.query(Host.id).filter(
+        Host.is_deleted.is_(False),
+        Host.name.concat(Host.identity_ip).concat(Host.description).concat(Host.others).like(pattern)).limit(20).all()
+
+
+def _timed(search):
+    started = time.time()
+    for _ in range(ROUNDS):
+        results = search()
+    return len(results), (time.time() - started) / ROUNDS * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', type=int, default=100000)
+    args = parser.parse_args()
+
+    app = create_testing_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "SQLALCHEMY_ECHO": False,
+                              "REDIS_HOST": None})
+    with app.app_context():
+        db.create_all()
+        _generate(args.hosts)
+
+        rss = _rss()
+        started = time.time()
+        host_search.build_host_index()
+        print('hosts: {}, build: {:.1f} s, trigrams: {}, rss growth: {:.0f} MB'.format(
+            args.hosts, time.time() - started, len(host_search._index.postings),
+            _rss() - rss))
+
+        for name, query, prefix in QUERIES:
+            like_count, like_cost = _timed(lambda: _like(query))
+            count, cost = _timed(lambda: host_search.search_hosts(query, prefix=prefix, limit=20))
+            total = len(host_search.search_hosts(query, prefix=prefix))
+            print('{:<22} like {:>3} hits {:>8.1f} ms   index {:>3} hits of {:>6} {:>7.2f} ms'.format(
+                name, like_count, like_cost, count, total, cost))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Benchmark for synchronizing the hosts of a business with db.
+
+Compare the one-by-one sync of _sync_host_with_db before the bulk engine, which commits and
+refreshes every host, with sync_hosts_in_bulk, on a resync where a part of the hosts changed,
+some are removed and some are new.
+
+Usage:
+    python benchmarks/bench_host_sync.py [--hosts 10000] [--changed 0.1]
+"""
+import argparse
+import datetime
+import json
+import time
+
+from sqlalchemy import event
+
+from aops.app import create_testing_app
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host.host_sync import sync_hosts_in_bulk
+from aops.applications.database.models import Host
+
+
+def _infos(hosts, changed=0.0, offset=0):
+    step = int(1 / changed) if changed else 0
+    return [{'name': 'host{}'.format(i), 'identity_ip': '10.{}.{}.{}'.format(i // 65536, i // 256 % 256, i % 256),
+             'os': 'AIX' if step and i % step == 0 else 'Linux', 'business': 'LDDS', 'type': 'host',
+             'modified_by': 'admin', 'others': json.dumps([{'key_cn': 'site', 'key_en': 'site', 'value': 'IDC1'}])}
+            for i in range(offset, hosts + offset)]
+
+
+def _sync_one_by_one(hosts_info, business):
+    """ _sync_host_with_db before the bulk engine """
+    results = {'added': [], 'deleted': [], 'updated': []}
+    file_hosts = dict((info['name'], Host(**info)) for info in hosts_info)
+    db_hosts = dict((host.name, host) for host in Host.query.filter_by(is_deleted=False, business=business))
+    for name, host in db_hosts.items():
+        if name not in file_hosts:
+            host.delete()
+            results['deleted'].append(host)
+    for name, host in file_hosts.items():
+        if name in db_hosts:
+            results['updated'].append(db_hosts[name].update(
+                updated_at=datetime.datetime.now(), identity_ip=host.identity_ip, os=host.os,
+                business=host.business, others=host.others))
+        else:
+            results['added'].append(host.save())
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', type=int, default=10000)
+    parser.add_argument('--changed', type=float, default=0.1)
+    args = parser.parse_args()
+
+    for label, sync in [('one-by-one', _sync_one_by_one), ('bulk', sync_hosts_in_bulk)]:
+        app = create_testing_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "SQLALCHEMY_ECHO": False,
+                                  "REDIS_HOST": None})
+        with app.app_context():
+            db.create_all()
+            sync_hosts_in_bulk(_infos(args.hosts), 'LDDS')
+            db.session.expire_all()
+
+            # 1% of the hosts are removed and 1% are new
+            infos = _infos(args.hosts, args.changed, offset=args.hosts // 100)
+            statements = []
+            event.listen(db.engine, 'before_cursor_execute', lambda *params: statements.append(params[2]))
+            started = time.time()
+            results = sync(infos, 'LDDS')
+            cost = time.time() - started
+            print('{:<10} added {:>6} updated {:>6} deleted {:>6} {:>8} statements {:>10.1f} ms'.format(
+                label, len(results['added']), len(results['updated']), len(results['deleted']), len(statements),
+                cost * 1000))
+
+
+if __name__ == '__main__':
+    main()
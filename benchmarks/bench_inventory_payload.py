@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Benchmark for the payloads of the inventories posted to Scheduler.
+
+Compare the size and the encode time of the json posted before, the json compressed by gzip
+and the compact format of inventory_codec, on a synthetic inventory tree whose groups hold
+the given number of hosts, and on the flat payload of sync_hosts_with_scheduler.
+
+Usage:
+    python benchmarks/bench_inventory_payload.py [--hosts 50000] [--groups 500]
+"""
+import argparse
+import gzip
+import json
+import time
+from io import BytesIO
+
+from aops.applications.common.inventory_codec import encode_inventory, decode_inventory
+
+ROUNDS = 3
+
+
+def _host(index, pid):
+    return {'id': '{}_{}'.format(pid, index), 'pid': pid, 'name': u'host{}'.format(index), 'type': u'host',
+            'ip': '10.{}.{}.{}'.format(index // 65536, index // 256 % 256, index % 256), 'os': u'Linux',
+            'business': u'LDDS', 'is_virtual': 1, 'connect_type': u'ssh',
+            'accounts': [{'username': u'root', 'password': u'******'}, {'username': u'aops', 'password': u'******'}],
+            'params': {u'env': u'prod', u'idc': u'IDC{}'.format(index % 4)}}
+
+
+def _generate(hosts, groups):
+    group_nodes = [{'id': str(index + 2), 'pid': '1', 'name': u'group{}'.format(index), 'type': u'group',
+                    'business': u'LDDS', 'params': {u'owner': u'ops'}, 'children': []} for index in range(groups)]
+    for index in range(hosts):
+        group = group_nodes[index % groups]
+        group['children'].append(_host(index, group['id']))
+    tree = {'tree-group': [{'id': '1', 'pid': '0', 'name': u'LDDS', 'type': u'business', 'business': u'LDDS',
+                            'params': {}, 'children': group_nodes}]}
+    flat = {'added': [_host(index, '0') for index in range(hosts)], 'deleted': [], 'updated': []}
+    return tree, flat
+
+
+def _gzip_json(payload):
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6) as f:
+        f.write(json.dumps(payload))
+    return buf.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', type=int, default=50000)
+    parser.add_argument('--groups', type=int, default=500)
+    args = parser.parse_args()
+
+    tree, flat = _generate(args.hosts, args.groups)
+    print('hosts: {}, groups: {}'.format(args.hosts, args.groups))
+    for name, payload in [('tree-group', tree), ('sync-hosts', flat)]:
+        for label, encode in [('json', json.dumps), ('json+gzip', _gzip_json), ('compact', encode_inventory)]:
+            started = time.time()
+            for _ in range(ROUNDS):
+                data = encode(payload)
+            cost = (time.time() - started) / ROUNDS
+            print('{:<12} {:<10} {:>12} bytes {:>10.1f} ms'.format(name, label, len(data), cost * 1000))
+        started = time.time()
+        assert decode_inventory(encode_inventory(payload)) == payload
+        print('{:<12} {:<10} round trip {:>10.1f} ms'.format(name, 'compact', (time.time() - started) * 1000))
+
+
+if __name__ == '__main__':
+    main()
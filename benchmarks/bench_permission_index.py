@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Micro-benchmark for the permission lookup of passport_auth.
+
+Compare the per-request cost of scanning all registered namespaces with the
+endpoint-to-permission index built by api.init_app.
+
+Usage:
+    python benchmarks/bench_permission_index.py
+"""
+import timeit
+
+from aops.app import create_testing_app
+from aops.applications.handlers.v1 import api
+
+ROUNDS = 2000
+
+
+def _scan_permission(endpoint, func_name):
+    """ the lookup of passport_auth before the permission index """
+    for namespace in api.namespaces:
+        cur_permission_list = [namespace.name.split('/')[-1] + "_" + func_name + "_" + res[0].__name__ for res in
+                               namespace.resources if namespace.resources and endpoint == res[0].endpoint]
+        if len(cur_permission_list) == 1:
+            return cur_permission_list[0]
+
+
+def _index_permission(endpoint, func_name):
+    return api.permission_index.get((endpoint, func_name))
+
+
+def main():
+    create_testing_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "SQLALCHEMY_ECHO": False})
+    keys = sorted(api.permission_index.keys())
+    print('namespaces: {}, indexed permissions: {}'.format(len(api.namespaces), len(keys)))
+
+    for name, lookup in [('namespace scan', _scan_permission), ('permission index', _index_permission)]:
+        cost = timeit.timeit(lambda: [lookup(endpoint, method) for endpoint, method in keys], number=ROUNDS)
+        print('{:<18} {:>10.3f} us/request'.format(name, cost * 1e6 / (ROUNDS * len(keys))))
+
+
+if __name__ == '__main__':
+    main()
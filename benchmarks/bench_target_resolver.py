@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+Benchmark for resolving the target ids of jobs into host ips.
+
+Compare the recursive walk of get_host_ips_with_ids before the bulk resolver, which queries
+every group and child group, with resolve_host_ips backed by the group paths, on a synthetic
+binary group tree of the given depth whose leaf groups hold the hosts.
+
+Usage:
+    python benchmarks/bench_target_resolver.py [--depth 10] [--hosts 50000]
+"""
+import argparse
+import time
+
+from sqlalchemy import event
+
+from aops.app import create_testing_app
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host.group import get_groups_with_pid
+from aops.applications.database.apis.resource.host.host import resolve_host_ips
+from aops.applications.database.models.resource.host import Group, Host, groupHost
+
+ROUNDS = 3
+
+
+def _generate(depth, hosts):
+    """ insert a binary tree of groups, the hosts are spread over the leaf groups """
+    root = Group.create(pid=0, name='LDDS', business='LDDS', type='business')
+    levels = [[root]]
+    for level in range(1, depth):
+        groups = [Group(pid=parent.id, name='g{}_{}'.format(level, index * 2 + child), business='LDDS', type='group')
+                  for index, parent in enumerate(levels[-1]) for child in range(2)]
+        db.session.add_all(groups)
+        db.session.commit()
+        levels.append(groups)
+
+    leaves = levels[-1]
+    db.session.execute(Host.__table__.insert(), [
+        {'id': i + 1, 'name': 'host{}'.format(i), 'business': 'LDDS', 'type': 'host', 'is_deleted': False,
+         'identity_ip': '10.{}.{}.{}'.format(i // 65536, i // 256 % 256, i % 256)} for i in range(hosts)])
+    db.session.execute(groupHost.insert(), [
+        {'host_id': i + 1, 'group_id': leaves[i % len(leaves)].id} for i in range(hosts)])
+    db.session.commit()
+    return levels
+
+
+def _walk_host_ips(ids):
+    """ get_host_ips_with_ids before the bulk resolver """
+    def _tree_host_ips(node, ips):
+        if node.hosts:
+            ips.extend([host.identity_ip for host in node.hosts if not host.is_deleted])
+        else:
+            for child in get_groups_with_pid(node.id):
+                _tree_host_ips(child, ips)
+
+    host_ips, host_ids = [], []
+    for id in ids:
+        if '_' not in str(id):
+            _tree_host_ips(Group.query.filter_by(id=int(id), is_deleted=False).first(), host_ips)
+        else:
+            host_ids.append(str(id).split('_')[1])
+    hosts = Host.query.filter(Host.id.in_(host_ids), Host.is_deleted.is_(False)).all() if host_ids else []
+    host_ips.extend(host.identity_ip for host in hosts if host.identity_ip)
+    return list(set(host_ips))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depth', type=int, default=10)
+    parser.add_argument('--hosts', type=int, default=50000)
+    args = parser.parse_args()
+
+    app = create_testing_app({"SQLALCHEMY_DATABASE_URI": "sqlite://", "SQLALCHEMY_ECHO": False,
+                              "REDIS_HOST": None})
+    with app.app_context():
+        db.create_all()
+        levels = _generate(args.depth, args.hosts)
+        print('groups: {}, hosts: {}, depth: {}'.format(sum(len(level) for level in levels), args.hosts,
+                                                     args.depth))
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *params: statements.append(params[2]))
+
+        cases = [
+            ('whole tree', [str(levels[0][0].id)]),
+            ('mid-level groups', [str(group.id) for group in levels[args.depth // 2][:4]]),
+            ('leaf groups + hosts', [str(group.id) for group in levels[-1][:20]] +
+             ['{}_{}'.format(levels[-1][0].id, i) for i in range(1, 200, 2)]),
+        ]
+        for name, ids in cases:
+            for label, resolve in [('walk', _walk_host_ips), ('bulk', lambda ids: resolve_host_ips([ids])[0])]:
+                db.session.expire_all()
+                del statements[:]
+                started = time.time()
+                for _ in range(ROUNDS):
+                    ips = resolve(ids)
+                cost = (time.time() - started) / ROUNDS
+                print('{:<20} {:<5} {:>8} ips {:>6} queries {:>10.1f} ms'.format(
+                    name, label, len(ips), len(statements) // ROUNDS, cost * 1000))
+
+
+if __name__ == '__main__':
+    main()
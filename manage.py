@@ -22,5 +22,40 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=1000)
+def index_audits(batch_size):
+    """ Rebuild the token index of audits, run it once after the audit_token table is created """
+    from aops.applications.database.apis.audit.audit_index import rebuild_audit_index
+    print('Indexed {} audits'.format(rebuild_audit_index(batch_size)))
+
+
+@manager.command
+def archive_audits():
+    """ Roll the audits before the hot months into archive chunks """
+    from aops.applications.database.apis.audit.audit_archive import archive_audits
+    print('Archived months: {}'.format(archive_audits()))
+
+
+@manager.command
+def index_groups():
+    """ Rebuild the ancestry paths of groups, run it once after the group.path column is created """
+    from aops.applications.database.apis.resource.host.group_path import rebuild_group_paths
+    print('Indexed {} groups'.format(rebuild_group_paths()))
+
+
+@manager.option('-b', '--batch-size', dest='batch_size', type=int, default=1000)
+def index_host_attributes(batch_size):
+    """ Rebuild the attribute rows of hosts, run it once after the host_attribute table is created """
+    from aops.applications.database.apis.resource.host.host_attribute import rebuild_host_attributes
+    print('Indexed {} hosts'.format(rebuild_host_attributes(batch_size)))
+
+
+@manager.option('-b', '--business', dest='business', required=True)
+def recompute_groups(business):
+    """ Recompute the members of all the dynamic groups of a business """
+    from aops.applications.database.apis.resource.host.dynamic_group import recompute_dynamic_groups
+    print('Changed groups: {}'.format([group.name for group in recompute_dynamic_groups(business)]))
+
+
 if __name__ == '__main__':
     manager.run()
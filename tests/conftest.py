@@ -1,8 +1,12 @@
 import os
 import tempfile
+from contextlib import contextmanager
 
 import pytest
+from sqlalchemy import event
+
 from aops.app import create_testing_app
+from aops.applications.database import db
 
 
 @pytest.fixture(scope="class", autouse=True)
@@ -50,3 +54,26 @@ def runner(app):
         runner: Standard flask cli runner
     """
     return app.test_cli_runner()
+
+
+@pytest.fixture
+def count_statements(app):
+    """Record the SQL statements executed by the engine in a block.
+
+    Args:
+        App instance
+    Returns:
+        count_statements: a context manager yielding the list of the statements,
+            used in an app context
+    """
+    @contextmanager
+    def record():
+        statements = []
+        listener = lambda *args: statements.append(args[2])
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+
+    return record
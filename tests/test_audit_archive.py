@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import zlib
+from datetime import datetime, timedelta
+
+from flask_restplus.reqparse import ParseResult
+
+from aops.applications.common.cache import LRUCache
+from aops.applications.database import db
+from aops.applications.database.apis.audit.audit import add_audit_item, get_audit_list, audit_list_search, \
+    get_audits_csv
+from aops.applications.database.apis.audit import audit_archive
+from aops.applications.database.apis.audit.audit_archive import archive_audits, get_hot_start
+from aops.applications.database.models.audit.audit import Audit, AuditArchive, AuditArchiveChunk
+
+
+class TestAuditArchive(object):
+    @classmethod
+    def setup_class(cls):
+        cls.now = datetime(2018, 9, 15)
+        cls.months = [datetime(2018, 5, 10), datetime(2018, 6, 10), datetime(2018, 9, 10)]
+
+    def test_hot_start(self, app):
+        with app.app_context():
+            assert get_hot_start(self.now) == datetime(2018, 7, 1)
+            assert get_hot_start(datetime(2018, 2, 1)) == datetime(2017, 12, 1)
+
+    def test_archive(self, app):
+        with app.app_context():
+            db.create_all()
+            for month in self.months:
+                for i in range(3):
+                    add_audit_item(user='user{}'.format(i), source_ip='127.0.0.1', resource='tasks', resource_id=i,
+                                   operation='get_Task', status='200', message='{}', created_at=month,
+                                   updated_at=month)
+
+            assert archive_audits(self.now) == [datetime(2018, 5, 1), datetime(2018, 6, 1)]
+            assert archive_audits(self.now) == []
+            assert Audit.query.count() == 3
+            assert [archive.count for archive in AuditArchive.query.order_by(AuditArchive.month)] == [3, 3]
+            assert all(archive.status == 'archived' and archive.owner is None for archive in AuditArchive.query)
+            assert AuditArchiveChunk.query.count() == 2
+
+    def test_list_archived(self, app, monkeypatch):
+        with app.app_context():
+            # the chunks are counted once, then each page only decompresses the chunks it returns
+            decompressed, decompress = [], zlib.decompress
+            monkeypatch.setattr(audit_archive, '_chunk_counts', LRUCache())
+            monkeypatch.setattr(zlib, 'decompress', lambda data: decompressed.append(data) or decompress(data))
+            pages = []
+            for page in (1, 2, 3):
+                del decompressed[:]
+                pages.append(get_audit_list(page, 4, {'start_time': '2018-05-01'}))
+                assert len(decompressed) == [3, 2, 1][page - 1]
+            monkeypatch.undo()
+            assert [page.total for page in pages] == [9, 9, 9]
+            items = [item for page in pages for item in page.items]
+            created_at = [item.created_at if isinstance(item, Audit) else item['created_at'] for item in items]
+            assert created_at == [month for month in reversed(self.months) for _ in range(3)]
+
+            assert get_audit_list(1, 10, {}).total == 9
+            assert get_audit_list(1, 10, {'start_time': '2018-09-01'}).total == 3
+            june = get_audit_list(1, 10, {'start_time': '2018-06-01', 'end_time': '2018-06-30', 'user': 'user1'})
+            assert [(item['user'], item['created_at']) for item in june.items] == [('user1', datetime(2018, 6, 10))]
+
+    def test_search_and_download_archived(self, app):
+        with app.app_context():
+            args = {'start_time': '2018-05-01', 'resource_id': '1'}
+            audits = audit_list_search(args)
+            created_at = [item.created_at if isinstance(item, Audit) else item['created_at'] for item in audits]
+            assert created_at == list(reversed(self.months))
+
+            csv = ''.join(get_audits_csv(ParseResult(args, after_id=None, gzip=False))).splitlines()
+            assert [line.split(',')[0] for line in csv[1:]] == [str(month) for month in reversed(self.months)]
+            resumed = ''.join(get_audits_csv(ParseResult(args, after_id=5, gzip=False))).splitlines()
+            assert [line.split(',')[0] for line in resumed[1:]] == [str(self.months[0])]
+
+    def test_locked_month(self, app):
+        now = datetime(2018, 12, 15)
+        with app.app_context():
+            AuditArchive.create(month=datetime(2018, 9, 1), status='writing', owner='node2:1:run')
+            assert archive_audits(now) == []
+            assert Audit.query.count() == 3
+
+            AuditArchive.query.filter_by(owner='node2:1:run').update({'updated_at': datetime.now() - timedelta(hours=1)})
+            db.session.commit()
+            assert archive_audits(now) == [datetime(2018, 9, 1)]
+            assert Audit.query.count() == 0
+            assert get_audit_list(1, 10, {}).total == 9
+            assert get_audit_list(1, 10, {'start_time': '2018-05-01', 'end_time': '2018-06-30'}).total == 6
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import zlib
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+from aops.applications.database import db
+from aops.applications.database.apis.audit.audit import _stream_audits_csv, add_audit_item
+from aops.applications.database.models.audit.audit import Audit
+
+
+def _ids(csv):
+    lines = csv.splitlines()
+    column = lines[0].split(',').index('id')
+    return [int(line.split(',')[column]) for line in lines[1:]]
+
+
+class TestAuditCsv(object):
+    def test_stream_in_chunks(self, app, monkeypatch):
+        monkeypatch.setitem(app.config, 'AUDIT_CSV_CHUNK_SIZE', 2)
+        monkeypatch.setitem(app.config, 'REDIS_HOST', None)
+        with app.app_context():
+            db.create_all()
+            for i in range(5):
+                add_audit_item(user='alice', source_ip='10.0.0.1', resource='tasks', resource_id=i,
+                               operation='get_Task', status='200', message='m{}'.format(i))
+            ids = sorted((audit.id for audit in Audit.query), reverse=True)
+
+            chunks = list(_stream_audits_csv(Audit.query))
+            assert len(chunks) == 4 and chunks[0].startswith('created_at,')
+            assert _ids(''.join(chunks)) == ids
+
+            assert _ids(''.join(_stream_audits_csv(Audit.query, after_id=ids[1]))) == ids[2:]
+
+            data = ''.join(_stream_audits_csv(Audit.query, compress=True))
+            assert _ids(zlib.decompress(data, 16 + zlib.MAX_WBITS)) == ids
+
+    def test_error_aborts_stream(self, app, monkeypatch):
+        monkeypatch.setitem(app.config, 'AUDIT_CSV_CHUNK_SIZE', 2)
+        with app.app_context():
+            db.create_all()
+            stream = _stream_audits_csv(Audit.query, compress=True)
+            chunks = [next(stream), next(stream)]
+            db.session.execute('DROP TABLE audit')
+            with pytest.raises(OperationalError):
+                chunks.extend(stream)
+            # no gzip trailer, the truncated csv can't be taken for a complete one
+            with pytest.raises(zlib.error):
+                zlib.decompress(''.join(chunks), 16 + zlib.MAX_WBITS)
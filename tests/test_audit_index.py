@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from aops.applications.database import db
+from aops.applications.database.apis.audit.audit import add_audit_item, audit_list_search
+from aops.applications.database.apis.audit.audit_index import generate_grams, rebuild_audit_index
+from aops.applications.database.models.audit.audit import audit_tokens
+
+
+class TestAuditIndex(object):
+    @classmethod
+    def setup_class(cls):
+        cls.audits = [
+            dict(user='alice', source_ip='10.1.1.1', resource='tasks', resource_id=3, operation='get_Task',
+                 status='200', message=u'{"path_args": {"identifier": 3}, "notes": "部署任务"}'),
+            dict(user='bob', source_ip='10.2.1.1', resource='jobs', resource_id=4, operation='post_Jobs',
+                 status='400', message=u'{"notes": "hello"}'),
+        ]
+
+    def test_generate_grams(self):
+        assert generate_grams('get_Task') == {'get', 'et_', 't_t', '_ta', 'tas', 'ask'}
+        assert generate_grams('a, bc') == set()
+
+    def test_search(self, app):
+        with app.app_context():
+            db.create_all()
+            for audit in self.audits:
+                add_audit_item(**audit)
+
+            def search(**args):
+                return [audit.user for audit in audit_list_search(args)]
+
+            assert search(operation='task') == ['alice']
+            assert search(message=u'部署') == ['alice']
+            assert search(message='"notes": "he') == ['bob']
+            assert search(message='ti') == ['alice']
+            assert search(operation='xyz') == []
+            assert search(status='400', resource_type='jobs') == ['bob']
+            assert search(source_ip='10.1') == ['alice']
+
+    def test_rebuild(self, app):
+        with app.app_context():
+            count = db.session.query(audit_tokens).count()
+            assert rebuild_audit_index(batch_size=1) == len(self.audits)
+            assert db.session.query(audit_tokens).count() == count
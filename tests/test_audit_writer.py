@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import os
+import tempfile
+from datetime import datetime
+
+from aops.applications.database.apis.audit.audit_writer import AuditWriter, _encode, _decode
+
+
+class TestAuditSpill(object):
+    @classmethod
+    def setup_class(cls):
+        now = datetime.now()
+        cls.record = dict(user='test_user', source_ip='127.0.0.1', resource='tasks', resource_id=1,
+                          operation='get_Task', status=200, message='{}', created_at=now, updated_at=now,
+                          deleted_at=None, is_deleted=False)
+
+    def test_encode_decode(self):
+        assert _decode(_encode(self.record)) == self.record
+
+    def test_spill_and_claim(self, app):
+        spill_dir = tempfile.mkdtemp()
+        app.config['AUDIT_SPILL_FILE'] = os.path.join(spill_dir, 'audit_spill.log')
+        writer = AuditWriter()
+        writer._app = app
+        writer._spill([self.record, self.record])
+
+        claimed = writer._claim_spilled_files()
+        assert len(claimed) == 1
+        assert not os.path.exists(app.config['AUDIT_SPILL_FILE'])
+        with open(claimed[0]) as f:
+            assert [_decode(line) for line in f] == [self.record, self.record]
+        assert writer._claim_spilled_files() == claimed
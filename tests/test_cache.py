@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import time
+
+from aops.applications.common.cache import LRUCache, read_version, bump_version
+from aops.applications.database import db
+from aops.applications.database.models import FacetVersion
+
+
+class TestLRUCache(object):
+
+    def test_evict_least_recently_used(self):
+        cache = LRUCache(capacity=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        assert 'b' not in cache
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert len(cache) == 2
+
+    def test_expired_entry(self):
+        cache = LRUCache(capacity=2, ttl=0.01)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=60)
+        time.sleep(0.02)
+        assert cache.get('a') is None
+        assert cache.get('b') == 2
+
+    def test_pop(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        assert cache.pop('a') == 1
+        assert cache.pop('a') is None
+
+
+class TestVersionRow(object):
+
+    def test_read_and_bump(self, app):
+        with app.app_context():
+            db.create_all()
+            table = FacetVersion.__table__
+            key = {'name': 'user', 'scope': 'LDDS'}
+            assert read_version(table, key) == 0
+            assert bump_version(table, key) == 1 and bump_version(table, key) == 2
+            assert read_version(table, [{'name': 'user', 'scope': '*'}, key]) == (0, 2)
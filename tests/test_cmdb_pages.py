@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import datetime
+import json
+
+import gevent
+import pytest
+from flask import Flask, request, session
+from gevent.pywsgi import WSGIServer
+
+import aops.conf.cmdb_config as cmdb_config
+from aops.applications.common.cache import LRUCache
+from aops.applications.common.scheduler_request import SchedulerApi
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host import host_sync, inventory
+from aops.applications.database.apis.resource.host.cmdb_sync import run_cmdb_sync, sync_hosts_with_cmdb_by_interval
+from aops.applications.database.apis.resource.host.host import sync_host_with_cmdb
+from aops.applications.database.models import CmdbSyncLock, CmdbSyncRun, Group, Host
+from aops.applications.lib.cmdb_api import iter_host_pages
+
+
+def _instance(index):
+    return {'bk_inst_id': index, 'bk_inst_name': 'vm{}'.format(index), 'os': 'Linux', 'site': 'IDC1',
+            'cabinet': 'A1', 'host': 'pm1', 'cwdm_ip1': '10.0.{}.{}'.format(index // 256, index % 256),
+            'status': 'running', 'app': [{'bk_inst_name': 'web'}], 'last_time': '2018-07-01 10:00:00'}
+
+
+@pytest.fixture
+def cmdb(monkeypatch):
+    """ a local CMDB serving the paged host instances of LDDS """
+    fake = Flask('fake_cmdb')
+    fake.instances = [_instance(i) for i in range(1, 24)]
+    fake.calls = []
+
+    @fake.route('/api/v3/inst/association/search/owner/0/object/vm_private', methods=['POST'])
+    def search():
+        data = json.loads(request.data)
+        page, conditions = data['page'], data['condition'].get('vm_private', [])
+        fake.calls.append(dict(page, condition=conditions))
+        gevent.sleep(0.01)
+        instances = sorted((instance for instance in fake.instances
+                            if all(instance[c['field']] >= c['value'] for c in conditions if c['operator'] == '$gte')
+                            and all(instance[c['field']] < c['value'] for c in conditions if c['operator'] == '$lt')),
+                           key=lambda instance: -instance['bk_inst_id'])
+        info = instances[page['start']:page['start'] + page['limit']]
+        return json.dumps({'result': True, 'data': {'count': len(instances), 'info': info}})
+
+    server = WSGIServer(('127.0.0.1', 0), fake, log=None)
+    server.start()
+    monkeypatch.setattr(cmdb_config, 'CMDB_HOST', '127.0.0.1')
+    monkeypatch.setattr(cmdb_config, 'CMDB_PORT', server.server_port)
+    yield fake
+    server.stop()
+
+
+class TestCmdbPages(object):
+    def test_iter_host_pages(self, app, cmdb):
+        with app.app_context():
+            pages = list(iter_host_pages('LDDS', page_size=5))
+            assert [len(page) for page in pages] == [5, 5, 5, 5, 3]
+            assert [host['bk_inst_id'] for page in pages for host in page] == range(23, 0, -1)
+            assert [call['condition'] for call in cmdb.calls][:2] == \
+                [[], [{'field': 'bk_inst_id', 'operator': '$lt', 'value': 19}]]
+
+            # an instance deleted during the iteration hides no other instance
+            pages = iter_host_pages('LDDS', page_size=5)
+            ids = [host['bk_inst_id'] for host in next(pages)]
+            cmdb.instances = [instance for instance in cmdb.instances if instance['bk_inst_id'] != 20]
+            ids.extend(host['bk_inst_id'] for page in pages for host in page)
+            assert ids == range(23, 0, -1)
+
+    def test_sync_host_with_cmdb(self, app, cmdb, monkeypatch):
+        monkeypatch.setattr(SchedulerApi, 'post', lambda self, **kwargs: {})
+        monkeypatch.setattr(inventory, '_snapshots', LRUCache(capacity=64))
+        monkeypatch.setattr(host_sync, '_watermarks', LRUCache(capacity=64))
+        app.config['REDIS_HOST'] = None
+        with app.test_request_context():
+            session['user_info'] = {'user': 'admin'}
+            db.create_all()
+            Group.create(pid=0, name='LDDS', business='LDDS', type='business')
+            Host.create(name='vm99', business='LDDS', identity_ip='10.9.9.9')
+
+            results = sync_host_with_cmdb('LDDS', 'admin')
+            assert len(results['added']) == 23 and [host['name'] for host in results['deleted']] == ['vm99']
+            assert Group.query.filter_by(name='ALL_HOST').one().hosts[0].machine == 'pm1'
+
+            cmdb.instances[0]['os'] = 'AIX'
+            results = sync_host_with_cmdb('LDDS', 'admin')
+            assert results['added'] == [] and [host['os'] for host in results['updated']] == ['AIX']
+
+    def test_sync_changes_since_watermark(self, app, cmdb, monkeypatch):
+        monkeypatch.setattr(SchedulerApi, 'post', lambda self, **kwargs: {})
+        monkeypatch.setattr(inventory, '_snapshots', LRUCache(capacity=64))
+        monkeypatch.setattr(host_sync, '_watermarks', LRUCache(capacity=64))
+        app.config['REDIS_HOST'] = None
+        with app.test_request_context():
+            session['user_info'] = {'user': 'admin'}
+            db.create_all()
+            if not Group.query.filter_by(name='LDDS').first():
+                Group.create(pid=0, name='LDDS', business='LDDS', type='business')
+
+            sync_host_with_cmdb('LDDS', 'admin')
+            assert cmdb.calls[-1]['condition'] == []
+
+            cmdb.instances[1].update(os='AIX', last_time='2018-07-01 11:00:00')
+            removed = cmdb.instances.pop()
+            del cmdb.calls[:]
+            results = sync_host_with_cmdb('LDDS', 'admin')
+            assert [call['condition'][0]['value'] for call in cmdb.calls] == ['2018-07-01 10:00:00']
+            assert [host['name'] for host in results['updated']] == ['vm2'] and results['deleted'] == []
+
+            results = sync_host_with_cmdb('LDDS', 'admin')
+            assert cmdb.calls[-1]['condition'][0]['value'] == '2018-07-01 11:00:00'
+            assert results == {'added': [], 'updated': [], 'deleted': []}
+
+            monkeypatch.setitem(app.config, 'CMDB_FULL_SYNC_INTERVAL', 0)
+            results = sync_host_with_cmdb('LDDS', 'admin')
+            assert cmdb.calls[-1]['condition'] == []
+            assert [host['name'] for host in results['deleted']] == [removed['bk_inst_name']]
+
+
+class TestCmdbSyncRuns(object):
+    def test_run_once_per_interval(self, app, client, cmdb, monkeypatch):
+        monkeypatch.setattr(SchedulerApi, 'post', lambda self, **kwargs: {})
+        monkeypatch.setattr(inventory, '_snapshots', LRUCache(capacity=64))
+        monkeypatch.setattr(host_sync, '_watermarks', LRUCache(capacity=64))
+        monkeypatch.setitem(app.config, 'CMDB_SYNC_BUSINESSES', ['LDDS', 'CLOUD'])
+        app.config['REDIS_HOST'] = None
+        with app.app_context():
+            db.create_all()
+            Group.create(pid=0, name='LDDS', business='LDDS', type='business')
+
+            runs = sync_hosts_with_cmdb_by_interval()
+            assert [(run.business, run.status, run.added) for run in runs] == [('LDDS', 'success', 23),
+                                                                                ('CLOUD', 'failed', 0)]
+            assert sync_hosts_with_cmdb_by_interval() == []
+            assert CmdbSyncLock.query.count() == 0
+
+            CmdbSyncLock.create(business='LDDS', owner='node2:1', expires_at=datetime.datetime.now() +
+                                datetime.timedelta(seconds=60))
+            assert run_cmdb_sync('LDDS') is None
+            CmdbSyncLock.query.filter_by(business='LDDS').update({'expires_at': datetime.datetime.now()})
+            db.session.commit()
+            assert run_cmdb_sync('LDDS').status == 'success'
+
+        runs = json.loads(client.get('/v1/hosts/cmdb/runs').data)
+        assert [(run['business'], run['status']) for run in runs] == [('CLOUD', 'failed'), ('LDDS', 'success')]
+
+    def test_manual_sync_under_lock(self, app, client, cmdb, monkeypatch):
+        monkeypatch.setattr(SchedulerApi, 'post', lambda self, **kwargs: {})
+        monkeypatch.setattr(inventory, '_snapshots', LRUCache(capacity=64))
+        monkeypatch.setattr(host_sync, '_watermarks', LRUCache(capacity=64))
+        app.config['REDIS_HOST'] = None
+        with client.session_transaction() as session:
+            session['user_info'] = {'user': 'admin'}
+        with app.app_context():
+            db.create_all()
+            lock = CmdbSyncLock.create(business='LDDS', owner='node2:1', expires_at=datetime.datetime.now() +
+                                       datetime.timedelta(seconds=60))
+            response = client.post('/v1/hosts/cmdb')
+            assert response.status_code == 409
+            lock.delete()
+
+            response = client.post('/v1/hosts/cmdb')
+            assert response.status_code == 200
+            results = json.loads(response.data)
+            run = CmdbSyncRun.query.order_by(CmdbSyncRun.id.desc()).first()
+            assert (run.business, run.status, run.full) == ('LDDS', 'success', True)
+            assert [len(results[key]) for key in ('added', 'updated', 'deleted')] == [run.added, run.updated,
+                                                                                     run.deleted]
+            assert CmdbSyncLock.query.count() == 0
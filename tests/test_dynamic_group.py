@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import json
+
+import pytest
+
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host.dynamic_group import parse_rule, recompute_dynamic_groups, \
+    update_group_members
+from aops.applications.database.apis.resource.host.host import _sync_host_with_db
+from aops.applications.database.apis.resource.host.host_sync import BulkHostSync
+from aops.applications.database.models import Group, Host
+from aops.applications.database.models.resource.host import groupHost
+from aops.applications.exceptions.exception import ValidationError
+
+
+def _info(index, qs, site='IDC1', os='CentOS 7', machine=None):
+    others = [{'key_cn': u'区属', 'key_en': 'qs', 'value': qs}, {'key_cn': 'cpu', 'key_en': 'cpu', 'value': 8}]
+    return {'name': 'host{}'.format(index), 'identity_ip': '10.0.0.{}'.format(index), 'business': 'LDDS',
+            'type': 'host', 'site': site, 'os': os, 'machine': machine, 'others': json.dumps(others)}
+
+
+def _members(name):
+    return sorted(host.name for host in Group.query.filter_by(name=name).one().hosts)
+
+
+def _group(name, rule):
+    group = Group.create(pid=0, name=name, business='LDDS', type='group', rule=json.dumps(parse_rule(rule)))
+    update_group_members(group)
+    return group
+
+
+class TestDynamicGroup(object):
+    def test_parse_rule(self):
+        assert parse_rule('{"qs": "QS1", "cpu": [8, 16], "os": ["Windows"]}') == \
+            {'qs': ['QS1'], 'cpu': ['16', '8'], 'os': ['Windows']}
+        for rule in ('not json', {}, [], {'qs': []}, {'qs': [None]}, {'qs': {'a': 1}}, {'host_type': 'VM'}):
+            with pytest.raises(ValidationError):
+                parse_rule(rule)
+
+    def test_recompute_changed_groups(self, app, monkeypatch):
+        monkeypatch.setitem(app.config, 'REDIS_HOST', None)
+        with app.app_context():
+            db.create_all()
+            _sync_host_with_db([_info(0, 'QS1'), _info(1, 'QS2', os='Windows 2008'),
+                                _info(2, 'QS1', site='IDC2', machine='pm-1'), _info(3, 'QS3')], 'LDDS')
+            qs = _group('qs', {'qs': ['QS1', 'QS2'], 'site': 'IDC1'})
+            _group('virtual', {'host_type': 'Virtual'})
+            _group('windows', {'os': 'Windows', 'cpu': 8})
+            assert _members('qs') == ['host0', 'host1']
+            assert _members('virtual') == ['host2'] and _members('windows') == ['host1']
+
+            sync = BulkHostSync('LDDS')
+            sync.add([_info(0, 'QS3'), _info(1, 'QS2', os='Windows 2012'), _info(2, 'QS1', site='IDC2', machine='pm-1'),
+                      _info(3, 'QS1'), _info(4, 'QS9', machine='pm-2')])
+            sync.commit()
+            assert sync.changed_fields == set(['qs', 'os', 'cpu', 'site', 'machine', 'business'])
+            changed = recompute_dynamic_groups('LDDS', sync.changed_fields)
+            assert sorted(group.name for group in changed) == ['qs', 'virtual']
+            assert _members('qs') == ['host1', 'host3'] and _members('virtual') == ['host2', 'host4']
+
+            # only the groups whose rules read the changed fields are recomputed
+            host2 = Host.query.filter_by(name='host2').one()
+            db.session.execute(groupHost.insert(), {'group_id': qs.id, 'host_id': host2.id})
+            db.session.commit()
+            assert recompute_dynamic_groups('LDDS', set(['cpu'])) == []
+            assert _members('qs') == ['host1', 'host2', 'host3']
+            _sync_host_with_db([_info(1, 'QS2', os='Windows 2012'), _info(2, 'QS1', site='IDC2', machine='pm-1'),
+                                _info(3, 'QS1'), _info(4, 'QS9', machine='pm-2')], 'LDDS')
+            assert Host.query.filter_by(name='host0').first() is None
+            assert _members('qs') == ['host1', 'host3']
+
+    def test_recompute_moved_hosts(self, app, monkeypatch):
+        monkeypatch.setitem(app.config, 'REDIS_HOST', None)
+        with app.app_context():
+            db.create_all()
+            _sync_host_with_db([_info(20, 'QS5', site='IDC5'), _info(21, 'QS5', site='IDC5', machine='pm-1')], 'LDDS')
+            _group('idc5', {'site': 'IDC5', 'qs': 'QS5'})
+            _group('physical5', {'host_type': 'Physical', 'qs': 'QS5'})
+            assert _members('idc5') == ['host20', 'host21'] and _members('physical5') == ['host20']
+
+            sync = BulkHostSync('LDDS')
+            sync.add([_info(20, 'QS5', site='IDC6', machine='pm-2'), _info(21, 'QS5', site='IDC5')])
+            sync.commit(delete_missing=False)
+            assert sync.changed_fields == set(['site', 'machine'])
+            assert sorted(group.name for group in recompute_dynamic_groups('LDDS', sync.changed_fields)) == \
+                ['idc5', 'physical5', 'virtual']
+            assert _members('idc5') == ['host21'] and _members('physical5') == ['host21']
+            assert 'host20' in _members('virtual')
+            assert Host.query.filter_by(name='host20').one().site == 'IDC6'
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import json
+
+from aops.applications.database import db
+from aops.applications.database.apis.audit.audit import add_audit_item, get_audit_user_list, audit_users
+from aops.applications.database.models.audit.audit import Audit
+
+
+class TestFacet(object):
+    @classmethod
+    def setup_class(cls):
+        cls.audit = dict(source_ip='127.0.0.1', resource='tasks', resource_id=1, operation='get_Task',
+                         status='200', message='{}')
+
+    def test_audit_users(self, app, count_statements):
+        app.config['REDIS_HOST'] = None
+        with app.app_context():
+            db.create_all()
+            add_audit_item(user='alice', **self.audit)
+            assert get_audit_user_list() == {'creator': {'alice'}}
+            with count_statements() as statements:
+                add_audit_item(user='alice', **self.audit)
+                assert get_audit_user_list() == {'creator': {'alice'}}
+            assert not [statement for statement in statements if 'DISTINCT' in statement]
+
+            add_audit_item(user='bob', **self.audit)
+            assert get_audit_user_list() == {'creator': {'alice', 'bob'}}
+
+            Audit.query.filter_by(user='bob').first().update(user='carol')
+            assert get_audit_user_list() == {'creator': {'alice', 'carol'}}
+
+            Audit.soft_delete_by(user='alice')
+            assert get_audit_user_list() == {'creator': {'carol'}}
+
+            db.session.add(Audit(user='dave', resource='tasks', operation='get_Task', status='200'))
+            db.session.rollback()
+            assert get_audit_user_list() == {'creator': {'carol'}}
+
+    def test_invalidated_by_other_worker(self, app):
+        with app.app_context():
+            assert get_audit_user_list() == {'creator': {'carol'}}
+            # written by another worker, which bumps the version in db but not the values kept here
+            db.session.execute(Audit.__table__.insert(), dict(user='erin', **self.audit))
+            db.session.commit()
+            assert get_audit_user_list() == {'creator': {'carol'}}
+            audit_users._bump_db_version(json.dumps(()))
+            assert get_audit_user_list() == {'creator': {'carol', 'erin'}}
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import pytest
+
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host.group import get_parent_tree
+from aops.applications.database.apis.resource.host.group_path import get_ancestors, get_descendants, \
+    is_in_subtree, rebuild_group_paths
+from aops.applications.database.apis.resource.host.host import get_tree_host_ips
+from aops.applications.database.models import Group, Host
+from aops.applications.exceptions.exception import ValidationError
+
+
+def _create(name, parent=None):
+    return Group.create(pid=parent.id if parent else 0, name=name, business='LDDS',
+                        type='group' if parent else 'business')
+
+
+class TestGroupPath(object):
+    def test_ancestry(self, app, count_statements):
+        with app.app_context():
+            db.create_all()
+            root = _create('LDDS')
+            web = _create('web', root)
+            nginx = _create('nginx', web)
+            db_group = _create('db', root)
+            assert nginx.path == '/{}/{}/{}/'.format(root.id, web.id, nginx.id)
+            assert nginx.ancestor_ids == [root.id, web.id]
+
+            with count_statements() as statements:
+                assert sorted(get_ancestors([nginx])) == sorted([root.id, web.id, nginx.id])
+                assert sorted(group.id for group in get_descendants(web)) == sorted([web.id, nginx.id])
+            assert len(statements) == 2
+            assert sorted(node['name'] for node in get_parent_tree([nginx, db_group])) == \
+                ['LDDS', 'db', 'nginx', 'web']
+            assert is_in_subtree(nginx, web) and not is_in_subtree(db_group, web)
+
+            web.update(pid=db_group.id)
+            assert Group.query.get(nginx.id).path == '/{}/{}/{}/{}/'.format(root.id, db_group.id, web.id, nginx.id)
+            with pytest.raises(ValidationError):
+                db_group.update(pid=nginx.id)
+            db.session.rollback()
+
+            Group.query.update({'path': None})
+            db.session.commit()
+            assert rebuild_group_paths() == 4
+            assert Group.query.get(nginx.id).path == '/{}/{}/{}/{}/'.format(root.id, db_group.id, web.id, nginx.id)
+
+    def test_tree_host_ips(self, app):
+        with app.app_context():
+            db.create_all()
+            web = Group.query.filter_by(name='web').one()
+            nginx = Group.query.filter_by(name='nginx').one()
+            nginx.update(hosts=[Host.create(name='host0', business='LDDS', identity_ip='10.0.0.1')])
+            assert get_tree_host_ips(web) == ['10.0.0.1']
+            assert get_tree_host_ips(Group.query.filter_by(name='LDDS').one()) == ['10.0.0.1']
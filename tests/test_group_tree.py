@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import json
+
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host import group_tree
+from aops.applications.database.apis.resource.host.group_tree import get_tree_json
+from aops.applications.database.models import Group, Host, HostAccount
+
+
+class TestGroupTree(object):
+    def test_tree_invalidated_by_writes(self, app, count_statements):
+        app.config['REDIS_HOST'] = None
+        with app.app_context():
+            db.create_all()
+            root = Group.create(pid=0, name='LDDS', business='LDDS', type='business')
+            group = Group.create(pid=root.id, name='web', business='LDDS', type='group')
+            hosts = [Host.create(name='host{}'.format(i), business='LDDS', identity_ip='10.0.0.{}'.format(i))
+                     for i in range(3)]
+            group.update(hosts=hosts)
+
+            tree = get_tree_json('ips', 'LDDS')
+            labels = [node['label'] for node in json.loads(tree)[0]['children'][0]['children']]
+            assert sorted(labels) == ['10.0.0.0', '10.0.0.1', '10.0.0.2']
+
+            with count_statements() as statements:
+                assert get_tree_json('ips', 'LDDS') is tree
+            assert len(statements) == 1 and 'group_tree_version' in statements[0]
+
+            hosts[0].update(identity_ip='10.0.0.9')
+            assert '10.0.0.9' in get_tree_json('ips', 'LDDS')
+
+            tree = get_tree_json('groups', 'LDDS')
+            HostAccount.create(username='root', password='secret', host=hosts[1])
+            assert 'secret' in get_tree_json('groups', 'LDDS')
+
+            Host.soft_delete_by(id=hosts[2].id)
+            assert '10.0.0.2' not in get_tree_json('ips', 'LDDS')
+
+    def test_tree_invalidated_by_other_workers(self, app):
+        app.config['REDIS_HOST'] = None
+        with app.app_context():
+            db.create_all()
+            tree = get_tree_json('ips', 'LDDS')
+            assert '10.0.0.1' in tree
+
+            # a write of another worker only bumps the shared version
+            db.session.execute(Host.__table__.update().where(Host.name == 'host1').values(identity_ip='10.0.0.8'))
+            db.session.commit()
+            assert get_tree_json('ips', 'LDDS') is tree
+            group_tree._bump_db_version('LDDS')
+            assert '10.0.0.8' in get_tree_json('ips', 'LDDS')
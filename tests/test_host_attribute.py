@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import json
+
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host.group import _get_group_classify
+from aops.applications.database.apis.resource.host.host import get_host_with_id
+from aops.applications.database.apis.resource.host.host_attribute import count_host_facets, filter_hosts, \
+    rebuild_host_attributes
+from aops.applications.database.apis.resource.host.host_sync import sync_hosts_in_bulk
+from aops.applications.database.models import Host
+from aops.applications.database.models.resource.host import host_attributes
+
+
+def _info(index, site, qs, **others):
+    attributes = [{'key_cn': u'区属', 'key_en': 'qs', 'value': qs},
+                  {'key_cn': u'信息系统', 'key_en': 'xxs', 'value': 'xxs{}'.format(index % 2)}]
+    attributes.extend({'key_cn': key, 'key_en': key, 'value': value} for key, value in others.items())
+    return {'name': 'host{}'.format(index), 'identity_ip': '10.0.0.{}'.format(index), 'business': 'LDDS',
+            'type': 'host', 'site': site, 'others': json.dumps(attributes)}
+
+
+def _names(hosts):
+    return sorted(host['name'] for host in hosts)
+
+
+class TestHostAttribute(object):
+    def test_filter_and_count(self, app, client, monkeypatch):
+        monkeypatch.setitem(app.config, 'REDIS_HOST', None)
+        with app.app_context():
+            db.create_all()
+            sync_hosts_in_bulk([_info(0, 'IDC1', 'QS1', cpu=8, app=['web', 'db'], note='x' * 300),
+                                _info(1, 'IDC1', 'QS2'), _info(2, 'IDC2', 'QS1'), _info(3, 'IDC2', 'QS1')], 'LDDS')
+            host0 = Host.query.filter_by(name='host0').one()
+
+            others = dict((item['key_en'], item['value']) for item in get_host_with_id(host0.id)['others'])
+            assert others == {'qs': 'QS1', 'xxs': 'xxs0', 'cpu': 8, 'app': ['web', 'db'], 'note': 'x' * 300}
+
+            assert _names(filter_hosts({'site': ['IDC1'], 'qs': ['QS1']}).items) == ['host0']
+            assert _names(filter_hosts({'qs': ['QS1', 'QS2'], 'xxs': 'xxs1'}).items) == ['host1', 'host3']
+            assert _names(filter_hosts({'cpu': '8'}).items) == ['host0']
+            assert filter_hosts({'note': 'x' * 300}).items == []
+            page = filter_hosts({'qs': 'QS1'}, business='LDDS', per_page=2)
+            assert page.total == 3 and len(page.items) == 2
+
+            facets = count_host_facets(['site', 'qs'], filters={'qs': ['QS1']})
+            assert facets == {'site': [{'value': 'IDC2', 'count': 2}, {'value': 'IDC1', 'count': 1}],
+                              'qs': [{'value': 'QS1', 'count': 3}, {'value': 'QS2', 'count': 1}]}
+
+            host0.others = json.dumps([{'key_cn': u'区属', 'key_en': 'qs', 'value': 'QS2'}])
+            db.session.commit()
+            Host.soft_delete_by(name='host3')
+            assert count_host_facets(['qs'])['qs'] == [{'value': 'QS2', 'count': 2}, {'value': 'QS1', 'count': 1}]
+            assert _get_group_classify(Host.query.all())['xxs'] in (['xxs0', 'xxs1'], ['xxs1', 'xxs0'])
+
+            response = client.get('/v1/hosts/facets?key=site&key=qs&filter=site:IDC1&business=LDDS')
+            assert json.loads(response.data)['qs'] == [{'value': 'QS2', 'count': 2}]
+            response = client.get('/v1/hosts/filter?filter=qs:QS2&filter=site:IDC1')
+            assert _names(json.loads(response.data)['items']) == ['host0', 'host1']
+            assert client.get('/v1/hosts/filter?filter=qs').status_code == 400
+
+            db.session.execute(host_attributes.delete())
+            db.session.commit()
+            assert rebuild_host_attributes(batch_size=2) == 4
+            assert db.session.query(host_attributes).filter_by(host_id=host0.id).count() == 1
+
+    def test_keep_order_and_fallback(self, app, monkeypatch):
+        monkeypatch.setitem(app.config, 'REDIS_HOST', None)
+        with app.app_context():
+            db.create_all()
+            attributes = [{'key_cn': key, 'key_en': key, 'value': value}
+                          for key, value in [('zone', 'z1'), ('app', 'web'), ('qs', 'QS1'), ('app', 'db')]]
+            sync_hosts_in_bulk([{'name': 'host9', 'identity_ip': '10.0.1.9', 'business': 'LDDS', 'type': 'host',
+                                 'others': json.dumps(attributes)}], 'LDDS')
+            host = Host.query.filter_by(name='host9').one()
+            others = get_host_with_id(host.id)['others']
+            assert [(item['key_en'], item['value']) for item in others] == [('zone', 'z1'), ('app', 'db'),
+                                                                            ('qs', 'QS1')]
+
+            db.session.execute(host_attributes.delete().where(host_attributes.c.host_id == host.id))
+            db.session.commit()
+            assert get_host_with_id(host.id)['others'] == attributes
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import datetime
+import json
+import os
+from io import BytesIO
+
+import gevent
+
+from aops.applications.common.cache import LRUCache
+from aops.applications.common.parser import CsvParser, TextParser
+from aops.applications.common.scheduler_request import SchedulerApi
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host import inventory
+from aops.applications.database.apis.resource.host.business_lock import acquire_lock, release_lock
+from aops.applications.database.apis.resource.host.host_import import create_import_job, get_import_job, \
+    run_import_job
+from aops.applications.database.models import Group, Host, HostImportJob, InventoryDelta
+
+ANNOTATION = u'实例名,内网IP1,操作系统,状态\r类型,类型,类型,类型\r'.encode('utf-8')
+
+
+def _csv(tmpdir, name, rows, newline='\r\n'):
+    path = tmpdir.join(name)
+    path.write(ANNOTATION + 'bk_inst_name,cwdm_ip1,os,status' + newline + newline.join(rows) + newline, mode='wb')
+    return str(path)
+
+
+class TestParser(object):
+    def test_rows(self, tmpdir):
+        path = tmpdir.join('accounts.txt')
+        path.write('Hostname IPAddress Account Password\rvm1 10.0.0.1 root a\r\nvm2 10.0.0.2 root b\n\nvm3 10.0.0.3', mode='wb')
+        parser = TextParser(str(path))
+        rows = parser.rows()
+        assert next(rows) == {'Hostname': 'vm1', 'IPAddress': '10.0.0.1', 'Account': 'root', 'Password': 'a'}
+        assert [row['Hostname'] for row in rows] == ['vm2', 'vm3'] and parser.offset == parser.size
+
+        parser = CsvParser(_csv(tmpdir, 'hosts.CSV', ['vm1,10.0.0.1,Linux,on', '', 'vm2,10.0.0.2,,off'], '\n'))
+        assert parser.parse() == [{'bk_inst_name': 'vm1', 'cwdm_ip1': '10.0.0.1', 'os': 'Linux', 'status': 'on'},
+                                  {'bk_inst_name': 'vm2', 'cwdm_ip1': '10.0.0.2', 'os': '', 'status': 'off'}]
+
+
+class TestHostImport(object):
+    def test_import_in_batches(self, app, tmpdir, monkeypatch):
+        monkeypatch.setitem(app.config, 'REDIS_HOST', None)
+        monkeypatch.setattr(SchedulerApi, 'post', lambda self, **kwargs: {})
+        monkeypatch.setattr(inventory, '_snapshots', LRUCache(capacity=64))
+        with app.app_context():
+            db.create_all()
+            Group.create(pid=0, name='LDDS', business='LDDS', type='business')
+            rows = ['vm{0},10.0.0.{0},Linux,on'.format(i) for i in range(5)] + ['broken,,Linux,on']
+            job = create_import_job('infos', 'LDDS', _csv(tmpdir, 'hosts.CSV', rows, '\r'), 'hosts.CSV', 'admin')
+            assert job.status == 'pending' and job.size > 0
+
+            progress = []
+            monkeypatch.setattr(gevent, 'sleep', lambda seconds=0: progress.append((job.rows, job.added)))
+            job = run_import_job(job, batch_size=2)
+            assert progress == [(2, 2), (4, 4), (6, 5)]
+            assert (job.status, job.rows, job.skipped, job.added, job.deleted) == ('success', 6, 1, 5, 0)
+            assert job.offset == job.size and Host.query.count() == 5
+            assert not os.path.exists(job.path)
+            assert len(Group.query.filter_by(name='ALL_HOST').one().hosts) == 5
+
+            rows = ['vm{0},10.0.0.{0},Linux,on'.format(i) for i in range(1, 5)]
+            rows[0] = 'vm1,10.0.0.1,Windows,on'
+            job = run_import_job(create_import_job('infos', 'LDDS', _csv(tmpdir, 'less.CSV', rows), 'less.CSV',
+                                                   'admin'), batch_size=3)
+            assert (job.status, job.added, job.updated, job.deleted) == ('success', 0, 1, 1)
+            assert sorted(host.name for host in Host.query) == ['vm1', 'vm2', 'vm3', 'vm4']
+
+            path = tmpdir.join('accounts.txt')
+            path.write('Hostname IPAddress Account Password\nvm1 - root a\nvm2 - root b\nvm1 - admin c\nvm9', mode='wb')
+            job = run_import_job(create_import_job('accounts', 'LDDS', str(path), 'accounts.txt', 'admin'),
+                                 batch_size=2)
+            assert (job.status, job.rows, job.updated, job.skipped) == ('success', 4, 2, 1)
+            accounts = Host.query.filter_by(name='vm1').one().accounts
+            assert sorted((account.username, account.password) for account in accounts) == [('admin', 'c'),
+                                                                                            ('root', 'a')]
+
+            job = run_import_job(create_import_job('infos', 'LDDS', _csv(tmpdir, 'bad.CSV', ['vm5,10.0.0.1,,']),
+                                                   'bad.CSV', 'admin'))
+            assert job.status == 'failed' and job.error and Host.query.filter_by(name='vm5').first() is None
+            assert not os.path.exists(job.path)
+
+    def test_import_under_business_lock(self, app, tmpdir, monkeypatch):
+        monkeypatch.setitem(app.config, 'REDIS_HOST', None)
+        monkeypatch.setitem(app.config, 'HOST_IMPORT_TIMEOUT', 0)
+        monkeypatch.setattr(SchedulerApi, 'post', lambda self, **kwargs: {})
+        monkeypatch.setattr(inventory, '_snapshots', LRUCache(capacity=64))
+        with app.app_context():
+            db.create_all()
+            Group.create_if_not_exist(pid=0, name='LDDS', business='LDDS', type='business')
+            path = _csv(tmpdir, 'locked.CSV', ['lk1,10.1.0.1,Linux,on'])
+            token = acquire_lock('LDDS', 60)
+            job = run_import_job(create_import_job('infos', 'LDDS', path, 'locked.CSV', 'admin'))
+            assert job.status == 'failed' and job.error and Host.query.filter_by(name='lk1').first() is None
+            assert not os.path.exists(path)
+            release_lock('LDDS', token)
+
+            # the batch committed before the failed one is recorded for scheduler
+            rows = ['lk1,10.1.0.1,Linux,on', 'lk2,10.1.0.1,Linux,on']
+            job = run_import_job(create_import_job('infos', 'LDDS', _csv(tmpdir, 'half.CSV', rows), 'half.CSV',
+                                                   'admin'), batch_size=1)
+            host = Host.query.filter_by(name='lk1').one()
+            assert job.status == 'failed' and Host.query.filter_by(name='lk2').first() is None
+            deltas = InventoryDelta.query.filter(InventoryDelta.created_at >= job.created_at)
+            assert [(delta.node_id, delta.action) for delta in deltas] == [(host.id, 'update')]
+            token = acquire_lock('LDDS', 60)
+            assert token is not None
+            release_lock('LDDS', token)
+
+    def test_stalled_job_not_finished(self, app, tmpdir, monkeypatch):
+        monkeypatch.setitem(app.config, 'REDIS_HOST', None)
+        monkeypatch.setattr(SchedulerApi, 'post', lambda self, **kwargs: {})
+        monkeypatch.setattr(inventory, '_snapshots', LRUCache(capacity=64))
+        with app.app_context():
+            db.create_all()
+            Group.create_if_not_exist(pid=0, name='LDDS', business='LDDS', type='business')
+            job = create_import_job('infos', 'LDDS', _csv(tmpdir, 'slow.CSV', ['st1,10.2.0.1,Linux,on']),
+                                    'slow.CSV', 'admin')
+
+            # failed as stalled by another worker while importing
+            table = HostImportJob.__table__
+            monkeypatch.setattr(gevent, 'sleep', lambda seconds=0: db.session.execute(
+                table.update().where(table.c.id == job.id).values(status='failed', error='stalled')))
+            job = run_import_job(job)
+            assert (job.status, job.error) == ('failed', 'stalled')
+            assert Host.query.filter_by(name='st1').one().business == 'LDDS'
+
+    def test_stalled_job_failed(self, app, tmpdir, monkeypatch):
+        monkeypatch.setitem(app.config, 'REDIS_HOST', None)
+        with app.app_context():
+            db.create_all()
+            path = _csv(tmpdir, 'stalled.CSV', ['vm1,10.0.0.1,Linux,on'])
+            job = create_import_job('infos', 'LDDS', path, 'stalled.CSV', 'admin')
+            job.update(status='running', updated_at=datetime.datetime.now() - datetime.timedelta(seconds=60))
+            assert get_import_job(job.id).status == 'running'
+
+            monkeypatch.setitem(app.config, 'HOST_IMPORT_TIMEOUT', 30)
+            job = get_import_job(job.id)
+            assert job.status == 'failed' and job.error and not os.path.exists(path)
+
+    def test_import_endpoint(self, app, client, tmpdir, monkeypatch):
+        monkeypatch.setitem(app.config, 'REDIS_HOST', None)
+        monkeypatch.setattr(app, 'root_path', str(tmpdir))
+        tmpdir.mkdir('upload_files').mkdir('host')
+        with client.session_transaction() as session:
+            session['user_info'] = {'user': 'admin'}
+        with app.app_context():
+            db.create_all()
+            jobs = HostImportJob.query.count()
+            response = client.post('/v1/hosts/accounts', data={'file': (BytesIO('Hostname Account Password\n'),
+                                                                        'accounts.txt')})
+            assert response.status_code == 202
+            job = json.loads(response.data)
+            assert (job['kind'], job['status'], job['filename']) == ('accounts', 'pending', 'accounts.txt')
+            gevent.sleep(0.1)
+            job = json.loads(client.get('/v1/hosts/imports/{}'.format(job['id'])).data)
+            assert (job['status'], job['rows']) == ('success', 0)
+            assert client.get('/v1/hosts/imports/999').status_code == 404
+            assert client.post('/v1/hosts/infos', data={'file': (BytesIO('x'), 'hosts.xls')}).status_code == 400
+            assert HostImportJob.query.count() == jobs + 1
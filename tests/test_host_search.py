@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import json
+from collections import namedtuple
+
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host import host_search
+from aops.applications.database.apis.resource.host.host import get_hosts_list
+from aops.applications.database.apis.resource.host.host_search import HostSearchIndex, search_hosts
+from aops.applications.database.apis.resource.host.host_sync import sync_hosts_in_bulk
+from aops.applications.database.models import Host, HostIndexChange
+
+Row = namedtuple('Row', ['id', 'business', 'name', 'identity_ip', 'description', 'others'])
+
+
+def _others(**attributes):
+    return json.dumps([{'key_cn': key, 'key_en': key, 'value': value} for key, value in attributes.items()])
+
+
+def _names(results):
+    return [result['name'] if isinstance(result, dict) else result[2] for result in results]
+
+
+class TestHostSearchIndex(object):
+    def test_search(self):
+        index = HostSearchIndex()
+        index.put(Row(1, 'LDDS', 'web01', '10.0.0.1', 'Nginx front', _others(cabinet='A12')))
+        index.put(Row(2, 'LDDS', 'web02', '10.0.0.2', None, None))
+        index.put(Row(3, 'CLOUD', 'db-web', '10.0.1.3', u'数据库', _others(cabinet='B07')))
+        index.put(Row(4, 'CLOUD', 'web', '10.0.1.4', None, 'not json'))
+
+        assert _names(index.search('WEB')) == ['web', 'web01', 'web02', 'db-web']
+        assert _names(index.search('web', prefix=True)) == ['web', 'web01', 'web02']
+        assert _names(index.search('we', prefix=True, business='LDDS')) == ['web01', 'web02']
+        assert _names(index.search('b0')) == ['db-web', 'web01', 'web02']
+        assert _names(index.search('10.0.1.')) == ['db-web', 'web']
+        assert _names(index.search('a12')) == ['web01']
+        assert _names(index.search(u'数据')) == ['db-web']
+        assert _names(index.search('web', limit=2)) == ['web', 'web01']
+        assert index.search('front door') == [] and index.search('  ') == []
+        assert index.search('web0', prefix=True)[0] == (1, 'LDDS', 'web01', '10.0.0.1')
+
+        index.put(Row(1, 'LDDS', 'app01', '10.0.0.1', None, None))
+        index.remove(2)
+        assert _names(index.search('web', business='LDDS')) == []
+        assert index.search('nginx') == []
+        assert len(index) == 3 and 'ngi' not in index.postings
+
+
+class TestHostSearch(object):
+    def test_index_follows_writes(self, app, client, monkeypatch):
+        monkeypatch.setitem(app.config, 'REDIS_HOST', None)
+        monkeypatch.setattr(host_search, '_index', HostSearchIndex())
+        monkeypatch.setattr(host_search, '_state', {'built': False, 'seq': None, 'stale': set()})
+        with app.app_context():
+            db.create_all()
+            web = Host.create(name='web01', business='LDDS', identity_ip='10.0.0.1', description='nginx')
+            Host.create(name='web02', business='LDDS', identity_ip='10.0.0.2')
+            Host.create(name='gone', business='LDDS', identity_ip='10.0.0.3', is_deleted=True)
+
+            assert _names(search_hosts('10.0.0')) == ['web01', 'web02']
+            assert [host.name for host in get_hosts_list(fuzzy_query='NGINX')] == ['web01']
+
+            web.description = 'apache'
+            db.session.commit()
+            Host.create(name='web03', business='CLOUD', identity_ip='10.0.0.4')
+            Host.soft_delete_by(name='web02')
+            assert _names(search_hosts('web')) == ['web01', 'web03']
+            assert search_hosts('nginx') == [] and _names(search_hosts('apache')) == ['web01']
+
+            sync_hosts_in_bulk([{'name': 'db01', 'identity_ip': '10.0.1.1', 'business': 'CLOUD', 'type': 'host',
+                                 'others': _others(cabinet='C3')}], 'CLOUD')
+            assert _names(search_hosts('c3')) == ['db01']
+            assert _names(search_hosts('web')) == ['web01']
+
+            response = client.get('/v1/hosts/search?q=10.0&prefix=true&business=CLOUD')
+            assert response.status_code == 200
+            assert json.loads(response.data) == [
+                {'id': Host.query.filter_by(name='db01').one().id, 'business': 'CLOUD', 'name': 'db01',
+                 'identity_ip': '10.0.1.1'}]
+
+    def test_index_follows_other_workers(self, app, monkeypatch):
+        monkeypatch.setitem(app.config, 'REDIS_HOST', None)
+        monkeypatch.setitem(app.config, 'HOST_INDEX_MAX_CHANGES', 3)
+        monkeypatch.setattr(host_search, '_index', HostSearchIndex())
+        monkeypatch.setattr(host_search, '_state', {'built': False, 'seq': None, 'stale': set()})
+        with app.app_context():
+            db.create_all()
+            host = Host.create(name='mail01', business='LDDS', identity_ip='10.0.2.1')
+            assert _names(search_hosts('mail')) == ['mail01']
+
+            # the writes of another worker are only seen through the change table
+            table = Host.__table__
+            db.session.execute(table.update().where(table.c.id == host.id).values(name='smtp01'))
+            db.session.commit()
+            assert _names(search_hosts('mail')) == ['mail01']
+            host_search._publish_db_changes([host.id])
+            assert search_hosts('mail') == [] and _names(search_hosts('smtp')) == ['smtp01']
+
+            # a worker behind the trimmed changes rebuilds its index
+            db.session.execute(table.update().where(table.c.id == host.id).values(name='imap01'))
+            db.session.commit()
+            host_search._publish_db_changes([-1, -2, -3, -4])
+            host_search._publish_db_changes([-5, -6, -7])
+            assert HostIndexChange.query.count() == 3
+            assert _names(search_hosts('imap')) == ['imap01']
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import json
+
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host.host import _load_host_others
+from aops.applications.database.apis.resource.host.host import sync_host_accounts
+from aops.applications.database.apis.resource.host.host_sync import sync_hosts_in_bulk
+from aops.applications.database.models import Group, Host, HostAccount, InventoryDelta
+
+# the versions shared by the workers
+CACHE_TABLES = ('group_tree_version', 'host_index_change', 'host_index_sequence')
+
+
+def _info(index, os='Linux'):
+    return {'name': 'host{}'.format(index), 'identity_ip': '10.0.0.{}'.format(index), 'os': os,
+            'business': 'LDDS', 'type': 'host', 'modified_by': 'admin',
+            'others': json.dumps([{'key_cn': u'机柜', 'key_en': 'cabinet', 'value': 'A{}'.format(index)}])}
+
+
+class TestHostSync(object):
+    def test_sync_hosts_in_bulk(self, app, count_statements):
+        app.config['REDIS_HOST'] = None
+        with app.app_context():
+            db.create_all()
+            group = Group.create(pid=0, name='ALL_HOST', business='LDDS', type='group')
+            results = sync_hosts_in_bulk([_info(i) for i in range(6)], 'LDDS', group=group)
+            assert sorted(host.name for host in results['added']) == ['host{}'.format(i) for i in range(6)]
+            assert results['updated'] == [] and results['deleted'] == []
+            assert len(Group.query.get(group.id).hosts) == 6
+
+            removed = Host.query.filter_by(name='host5').one()
+            HostAccount.create(username='root', password='secret', host_id=removed.id)
+            Host.soft_delete_by(name='host4')
+
+            infos = [_info(0), _info(1, os='AIX'), _info(2), _info(3), _info(4), _info(6)]
+            with count_statements() as statements:
+                results = sync_hosts_in_bulk(infos, 'LDDS', group=group)
+
+            assert sorted(host.name for host in results['added']) == ['host4', 'host6']
+            assert [(host.name, host.os) for host in results['updated']] == [('host1', 'AIX')]
+            assert [host.name for host in results['deleted']] == ['host5']
+            writes = [statement.split()[0] for statement in statements
+                      if not statement.startswith('SELECT') and not any(table in statement for table in CACHE_TABLES)]
+            assert writes == ['INSERT', 'UPDATE', 'UPDATE', 'INSERT', 'DELETE', 'DELETE', 'DELETE', 'UPDATE', 'UPDATE',
+                              'DELETE', 'INSERT']
+
+            others = _load_host_others(results)
+            assert others['deleted'][0]['accounts'][0].username == 'root'
+            assert others['added'][0]['others'][0]['key_en'] == 'cabinet'
+            assert Host.query.filter_by(name='host5').first() is None
+            assert HostAccount.query.filter_by(username='root').one().host_id is None
+            assert sorted(host.name for host in Group.query.get(group.id).hosts) == \
+                ['host{}'.format(i) for i in (0, 1, 2, 3, 4, 6)]
+            assert Host.query.filter_by(name='host4').one().is_deleted is False
+
+            assert sync_hosts_in_bulk(infos, 'LDDS', group=group) == {'added': [], 'updated': [], 'deleted': []}
+
+    def test_sync_host_accounts(self, app, count_statements):
+        app.config['REDIS_HOST'] = None
+        with app.app_context():
+            db.create_all()
+            sync_hosts_in_bulk([_info(i) for i in range(10, 14)], 'LDDS')
+            hosts = dict((host.name, host.id) for host in Host.query.filter(Host.name.in_(
+                ['host10', 'host11', 'host12', 'host13'])))
+            for name, username, password in [('host10', 'root', 'a'), ('host10', 'admin', 'b'),
+                                             ('host11', 'root', 'c'), ('host12', 'root', 'd')]:
+                HostAccount.create(username=username, password=password, host_id=hosts[name])
+            kept = HostAccount.query.filter_by(host_id=hosts['host10'], username='root').one().id
+            InventoryDelta.query.delete()
+            db.session.commit()
+
+            rows = [{'Hostname': 'host10', 'Account': 'root', 'Password': 'a'},
+                    {'Hostname': 'host10', 'Account': 'admin', 'Password': 'new'},
+                    {'Hostname': 'host11', 'Account': 'root', 'Password': 'c'},
+                    {'Hostname': 'host13', 'Account': 'root', 'Password': 'e'},
+                    {'Hostname': 'unknown', 'Account': 'root', 'Password': 'f'}]
+            with count_statements() as statements:
+                changed = sync_host_accounts(rows, 'LDDS')
+
+            assert sorted(host['name'] for host in changed) == ['host10', 'host13']
+            writes = [statement.split()[0] for statement in statements
+                      if not statement.startswith('SELECT') and not any(table in statement for table in CACHE_TABLES)]
+            assert writes == ['DELETE', 'INSERT', 'UPDATE', 'INSERT']
+            accounts = sorted((account.host_id, account.username, account.password) for account in
+                              HostAccount.query.filter(HostAccount.host_id.in_(hosts.values())))
+            assert accounts == sorted([(hosts['host10'], 'root', 'a'), (hosts['host10'], 'admin', 'new'),
+                                       (hosts['host11'], 'root', 'c'), (hosts['host12'], 'root', 'd'),
+                                       (hosts['host13'], 'root', 'e')])
+            assert HostAccount.query.filter_by(host_id=hosts['host10'], username='root').one().id == kept
+            assert sorted(delta.node_id for delta in InventoryDelta.query) == sorted([hosts['host10'],
+                                                                                      hosts['host13']])
+            assert sync_host_accounts(rows, 'LDDS') == [] and InventoryDelta.query.count() == 2
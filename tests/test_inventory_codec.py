@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import json
+
+import pytest
+
+from aops.applications.common.inventory_codec import encode_inventory, decode_inventory, CONTENT_TYPE
+from aops.applications.common.scheduler_request import SchedulerApi
+from aops.applications.database.apis.resource.host import inventory
+from aops.applications.database.apis.resource.host.inventory import post_inventory
+from aops.applications.exceptions.exception import SchedulerError
+
+
+def _payload(hosts=200):
+    children = [{'id': '2_{}'.format(i), 'pid': '2', 'name': u'host{}'.format(i),
+                 'ip': '10.0.{}.{}'.format(i // 256, i % 256), 'os': u'Linux', 'accounts': [{'username': u'root', 'password': None}], 'params': {}}
+                for i in range(hosts)]
+    children[0]['is_update'] = 1
+    group = {'id': '2', 'pid': '1', 'name': u'web', 'business': u'LDDS', 'params': {u'env': u'prod'},
+             'children': children}
+    return {'tree-group': [{'id': '1', 'pid': '0', 'name': u'LDDS', 'business': u'LDDS', 'params': {},
+                            'children': [group]}]}
+
+
+class TestInventoryCodec(object):
+    def test_round_trip(self):
+        payload = _payload()
+        assert decode_inventory(encode_inventory(payload)) == payload
+        flat = {'added': [{'ip': '10.0.0.1', 'name': u'主机'}], 'deleted': [], 'updated': []}
+        assert decode_inventory(encode_inventory(flat)) == flat
+
+    def test_smaller_than_json(self):
+        payload = _payload()
+        assert len(encode_inventory(payload)) * 5 < len(json.dumps(payload))
+
+    def test_post_falls_back_to_json(self, app, monkeypatch):
+        posted = []
+
+        def _post(self, data=None, headers=None, **kwargs):
+            posted.append(headers['Content-Type'])
+            if headers['Content-Type'] == CONTENT_TYPE:
+                raise SchedulerError('Unsupported Media Type', 415)
+            return {'status': 'ok'}
+
+        def _bad_gateway(self, **kwargs):
+            raise SchedulerError('Bad Gateway', 502)
+
+        monkeypatch.setattr(SchedulerApi, 'post', _post)
+        monkeypatch.setattr(inventory, '_json_endpoints', set())
+        app.config['INVENTORY_COMPACT_FORMAT'] = True
+        try:
+            with app.app_context():
+                assert post_inventory('/v1/inventories/sync-hosts/', _payload(2)) == {'status': 'ok'}
+                assert post_inventory('/v1/inventories/sync-hosts/', _payload(2)) == {'status': 'ok'}
+                assert posted == [CONTENT_TYPE, 'application/json;charset=utf-8', 'application/json;charset=utf-8']
+
+                monkeypatch.setattr(SchedulerApi, 'post', _bad_gateway)
+                with pytest.raises(SchedulerError):
+                    post_inventory('/v1/inventories/update-hosts/', _payload(2))
+        finally:
+            app.config['INVENTORY_COMPACT_FORMAT'] = False
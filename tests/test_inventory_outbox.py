@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import datetime
+import json
+
+from aops.applications.common.scheduler_request import SchedulerApi
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host.business_lock import acquire_lock, release_lock, INVENTORY_LOCK
+from aops.applications.database.apis.resource.host.group import publish_inventory_deltas, \
+    sync_updated_hosts_with_scheduler, sync_updated_groups_with_scheduler
+from aops.applications.database.models import Group, Host, InventoryDelta
+from aops.applications.exceptions.exception import SchedulerError
+
+
+class TestInventoryOutbox(object):
+    def test_publish_debounced_deltas(self, app, monkeypatch):
+        posted = []
+        monkeypatch.setattr(SchedulerApi, 'post', lambda self, data=None, **kwargs: posted.append(json.loads(data)))
+        monkeypatch.setitem(app.config, 'REDIS_HOST', None)
+        with app.app_context():
+            db.create_all()
+            root = Group.create(pid=0, name='LDDS', business='LDDS', type='business')
+            group = Group.create(pid=root.id, name='web', business='LDDS', type='group')
+            hosts = [Host.create(name='host{}'.format(i), business='LDDS', identity_ip='10.0.0.{}'.format(i))
+                     for i in range(3)]
+            group.update(hosts=hosts)
+
+            for host in hosts:
+                host.update(description=u'edited')
+                sync_updated_hosts_with_scheduler({'updated': [host]})
+            sync_updated_hosts_with_scheduler({'deleted': [hosts[2]]})
+            assert InventoryDelta.count() == 4
+
+            assert publish_inventory_deltas() == 0
+            assert not posted
+
+            assert publish_inventory_deltas(datetime.datetime.now() + datetime.timedelta(seconds=3)) == 4
+            assert len(posted) == 1
+            tree = posted[0]['tree-group'][0]
+            assert tree['name'] == 'LDDS' and 'is_update' not in tree
+            web = tree['children'][0]
+            assert web['name'] == 'web' and 'is_update' not in web
+            states = dict((node['ip'], (node['is_update'], node['is_delete'])) for node in web['children'])
+            assert states == {'10.0.0.0': (1, 0), '10.0.0.1': (1, 0), '10.0.0.2': (0, 1)}
+            assert InventoryDelta.count() == 0
+
+    def test_publish_group_delta(self, app, monkeypatch):
+        posted = []
+        monkeypatch.setattr(SchedulerApi, 'post', lambda self, data=None, **kwargs: posted.append(json.loads(data)))
+        monkeypatch.setitem(app.config, 'REDIS_HOST', None)
+        with app.app_context():
+            db.create_all()
+            group = Group.query.filter_by(name='web').one()
+            sync_updated_groups_with_scheduler({'updated': [group]})
+            sync_updated_groups_with_scheduler({'deleted': [group]})
+
+            assert publish_inventory_deltas(datetime.datetime.now() + datetime.timedelta(seconds=60)) == 2
+            web = posted[0]['tree-group'][0]['children'][0]
+            assert (web['is_update'], web['is_delete']) == (0, 1)
+            assert len(web['children']) == 3
+
+    def test_failed_business_kept(self, app, monkeypatch):
+        posted = []
+
+        def post(self, data=None, **kwargs):
+            tree = json.loads(data)['tree-group']
+            if tree[0]['name'] == 'CLOUD':
+                raise SchedulerError('Scheduler is unavailable')
+            posted.append(tree)
+
+        monkeypatch.setattr(SchedulerApi, 'post', post)
+        monkeypatch.setitem(app.config, 'REDIS_HOST', None)
+        with app.app_context():
+            db.create_all()
+            cloud = Group.create(pid=0, name='CLOUD', business='CLOUD', type='business')
+            sync_updated_groups_with_scheduler({'updated': [cloud]})
+            sync_updated_groups_with_scheduler({'updated': [Group.query.filter_by(name='web').one()]})
+
+            later = datetime.datetime.now() + datetime.timedelta(seconds=60)
+            assert publish_inventory_deltas(later) == 1
+            assert [tree[0]['name'] for tree in posted] == ['LDDS']
+            assert [delta.business for delta in InventoryDelta.query] == ['CLOUD']
+
+    def test_locked_business_skipped(self, app, monkeypatch):
+        posted = []
+        monkeypatch.setattr(SchedulerApi, 'post', lambda self, data=None, **kwargs: posted.append(json.loads(data)))
+        monkeypatch.setitem(app.config, 'REDIS_HOST', None)
+        with app.app_context():
+            db.create_all()
+            later = datetime.datetime.now() + datetime.timedelta(seconds=60)
+            token = acquire_lock(INVENTORY_LOCK.format('CLOUD'), 60)
+            assert publish_inventory_deltas(later) == 0
+            assert not posted and InventoryDelta.count() == 1
+
+            release_lock(INVENTORY_LOCK.format('CLOUD'), token)
+            assert publish_inventory_deltas(later) == 1
+            assert [tree['tree-group'][0]['name'] for tree in posted] == ['CLOUD'] and InventoryDelta.count() == 0
+
+    def test_lock_leaves_session(self, app, monkeypatch):
+        monkeypatch.setitem(app.config, 'REDIS_HOST', None)
+        with app.app_context():
+            db.create_all()
+            delta = InventoryDelta(business='CLOUD', node_type='host', node_id=1, action='update')
+            db.session.add(delta)
+            token = acquire_lock('CLOUD', 60)
+            assert acquire_lock('CLOUD', 60) is None and delta in db.session.new
+            release_lock('CLOUD', token)
+            assert delta in db.session.new
+            db.session.rollback()
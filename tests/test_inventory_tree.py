@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import json
+
+from aops.applications.common.scheduler_request import SchedulerApi
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host import inventory
+from aops.applications.database.apis.resource.host.group import sync_all_groups_with_scheduler
+from aops.applications.database.apis.resource.host.inventory import hash_inventory_tree, diff_inventory_tree
+from aops.applications.database.models import Group, Host
+
+
+def _tree(ip='10.0.0.1', hosts=2):
+    children = [{'id': '2_{}'.format(i), 'pid': '2', 'name': 'host{}'.format(i), 'ip': ip if i == 0 else str(i),
+                 'params': {}} for i in range(hosts)]
+    group = {'id': '2', 'pid': '1', 'name': 'web', 'business': 'LDDS', 'params': {}, 'children': children}
+    return [{'id': '1', 'pid': '0', 'name': 'LDDS', 'business': 'LDDS', 'params': {}, 'children': [group]}]
+
+
+class TestInventoryTree(object):
+    def test_diff_changed_subtrees(self):
+        snapshot = hash_inventory_tree(_tree())
+        assert diff_inventory_tree(_tree(), hash_inventory_tree(_tree()), snapshot) == []
+
+        tree = _tree(ip='10.0.0.9')
+        changed = diff_inventory_tree(tree, hash_inventory_tree(tree), snapshot)
+        assert 'is_update' not in changed[0] and 'is_update' not in changed[0]['children'][0]
+        hosts = changed[0]['children'][0]['children']
+        assert [(host['ip'], host['is_update']) for host in hosts] == [('10.0.0.9', 1)]
+
+        tree = _tree(hosts=1)
+        hosts = diff_inventory_tree(tree, hash_inventory_tree(tree), snapshot)[0]['children'][0]['children']
+        assert hosts == [{'id': '2_1', 'pid': '2', 'name': 'host1', 'ip': '1', 'is_update': 0, 'is_delete': 1}]
+
+        changed = diff_inventory_tree([], {}, snapshot)
+        assert [(node['id'], node['is_delete']) for node in changed] == [('1', 1)]
+        assert changed[0]['children'][0]['children'][0]['id'] == '2_0'
+
+    def test_sync_posts_changed_subtrees(self, app, monkeypatch):
+        posted = []
+        monkeypatch.setattr(SchedulerApi, 'post', lambda self, data=None, **kwargs:
+                            posted.append((self.endpoint, json.loads(data))))
+        app.config['REDIS_HOST'] = None
+        with app.app_context():
+            db.create_all()
+            root = Group.create(pid=0, name='LDDS', business='LDDS', type='business')
+            group = Group.create(pid=root.id, name='web', business='LDDS', type='group')
+            hosts = [Host.create(name='host{}'.format(i), business='LDDS', identity_ip='10.0.0.{}'.format(i))
+                     for i in range(3)]
+            group.update(hosts=hosts)
+
+            sync_all_groups_with_scheduler('LDDS')
+            sync_all_groups_with_scheduler('LDDS')
+            assert [endpoint for endpoint, _ in posted] == ['/v1/inventories/generate-hosts/']
+
+            hosts[1].update(os=u'Linux')
+            sync_all_groups_with_scheduler('LDDS')
+            endpoint, data = posted[-1]
+            assert endpoint == '/v1/inventories/update-hosts/'
+            hosts = data['tree-group'][0]['children'][0]['children']
+            assert [(host['ip'], host['is_update']) for host in hosts] == [('10.0.0.1', 1)]
+
+            sync_all_groups_with_scheduler('LDDS', force=True)
+            assert posted[-1][0] == '/v1/inventories/generate-hosts/'
+            sync_all_groups_with_scheduler('LDDS')
+            assert len(posted) == 3
+
+            # saved by another worker, the hashes kept here may miss its changes
+            inventory._bump_db_version('LDDS')
+            sync_all_groups_with_scheduler('LDDS')
+            assert len(posted) == 4 and posted[-1][0] == '/v1/inventories/generate-hosts/'
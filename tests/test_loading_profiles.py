@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host import group_tree
+from aops.applications.database.models import Group, Host, HostAccount, HostParameter
+
+HEADERS = {'Cookie': 'BussinessGroup=LDDS'}
+
+
+class TestLoadingProfiles(object):
+    def _add_hosts(self, group, count):
+        start = Host.query.count()
+        hosts = [Host(name='host{}'.format(i), business='LDDS', identity_ip='10.0.{}.{}'.format(i // 256, i % 256),
+                      accounts=[HostAccount(username='root', password='secret')],
+                      params=[HostParameter(name='port', value='22')]) for i in range(start, start + count)]
+        group.hosts.extend(hosts)
+        db.session.commit()
+        return hosts
+
+    def _count_statements(self, count_statements, client, url):
+        group_tree._trees.clear()
+        with count_statements() as statements:
+            response = client.get(url, headers=HEADERS)
+        assert response.status_code == 200
+        return len(statements)
+
+    def test_statements_per_endpoint(self, app, client, count_statements):
+        app.config['REDIS_HOST'] = None
+        with app.app_context():
+            db.create_all()
+            root = Group.create(pid=0, name='LDDS', business='LDDS', type='business')
+            group = Group.create(pid=root.id, name='web', business='LDDS', type='group')
+            host_id = self._add_hosts(group, 5)[0].id
+
+            urls = ['/v1/hosts/', '/v1/hosts/{}'.format(host_id), '/v1/groups/{}'.format(group.id),
+                    '/v1/groups/tree-ips', '/v1/groups/tree-groups']
+            counts = [self._count_statements(count_statements, client, url) for url in urls]
+            assert counts == [4, 6, 3, 4, 6]    # the trees read their shared version without redis
+
+            self._add_hosts(group, 20)
+            assert [self._count_statements(count_statements, client, url) for url in urls] == counts
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from aops.applications.database import db
+from aops.applications.database.apis.user_permission import snapshot
+from aops.applications.database.apis.user_permission.snapshot import get_user_permission_snapshot, \
+    bump_permission_version
+from aops.applications.database.models import User, Role, Permission, PermissionVersion
+
+
+class TestPermissionSnapshot(object):
+    def test_snapshot_cached_by_db_version(self, app, monkeypatch, count_statements):
+        monkeypatch.setitem(app.config, 'REDIS_HOST', None)
+        with app.app_context():
+            db.create_all()
+            role = Role.create(name='viewer')
+            role.permissions.append(Permission.create(permission='host.list', resource='host', operation='list'))
+            user = User.create(username='alice', password='secret', realname='Alice', email='alice@example.com',
+                               telephone='10000', status=1, modified_by='admin')
+            user.roles.append(role)
+            db.session.commit()
+
+            cached = get_user_permission_snapshot('alice')
+            assert cached['roles'] == ['viewer'] and cached['permissions'] == ['host.list']
+
+            with count_statements() as statements:
+                assert get_user_permission_snapshot('alice') is cached
+            assert len(statements) == 1 and 'permission_version' in statements[0]
+
+            # granted by another worker, which bumps the version in db but not the snapshot kept here
+            role.permissions.append(Permission.create(permission='host.edit', resource='host', operation='edit'))
+            db.session.commit()
+            snapshot._bump_db_versions(['alice'])
+            assert sorted(get_user_permission_snapshot('alice')['permissions']) == ['host.edit', 'host.list']
+
+            bump_permission_version(['alice'])
+            assert PermissionVersion.query.get('alice').version == 2
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+import gevent
+import pytest
+import requests
+
+from aops.applications.common import scheduler_request
+from aops.applications.common.scheduler_request import CircuitBreaker, SchedulerApi, get_scheduler_stats
+from aops.applications.exceptions.exception import SchedulerError
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, text='{}'):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.reason = 'fake'
+        self.text = text
+
+
+class FakeSession(object):
+    def __init__(self, results):
+        self.results = list(results)
+        self.calls = []
+
+    def request(self, method, url, **kwargs):
+        self.calls.append((method, url))
+        gevent.sleep(0.01)
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class TestCircuitBreaker(object):
+    def test_open_and_reset(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0)
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.CLOSED
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        assert breaker.allow() and not breaker.allow()
+        breaker.success()
+        assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+
+    def test_fail_fast(self):
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        breaker.failure()
+        assert breaker.state == CircuitBreaker.OPEN
+        assert not breaker.allow()
+
+
+class TestSchedulerApi(object):
+    @pytest.fixture(autouse=True)
+    def transport(self, app, monkeypatch):
+        app.config.update(SCHEDULER_RETRIES=2, SCHEDULER_RETRY_BACKOFF=0, SCHEDULER_BREAKER_THRESHOLD=3)
+        monkeypatch.setattr(scheduler_request, '_breaker', None)
+        monkeypatch.setattr(scheduler_request, '_stats', {})
+        monkeypatch.setattr(scheduler_request, '_responses', scheduler_request.ReadThroughCache())
+        with app.app_context():
+            yield
+
+    def test_retry_get(self, monkeypatch):
+        session = FakeSession([requests.ConnectionError('refused'), FakeResponse(503), FakeResponse(200, '[1]')])
+        monkeypatch.setattr(scheduler_request, '_session', session)
+        assert SchedulerApi('/v1/jobs/12/records').get() == [1]
+        assert len(session.calls) == 3
+        stats = get_scheduler_stats()
+        assert stats['circuit'] == CircuitBreaker.CLOSED
+        assert [(item['endpoint'], item['count'], item['errors']) for item in stats['endpoints']] == \
+            [('GET /v1/jobs/{id}/records', 3, 2)]
+
+    def test_no_retry_post(self, monkeypatch):
+        session = FakeSession([FakeResponse(503)])
+        monkeypatch.setattr(scheduler_request, '_session', session)
+        with pytest.raises(SchedulerError):
+            SchedulerApi('/v1/jobs/').post(json={})
+        assert len(session.calls) == 1
+
+    def test_circuit_open(self, monkeypatch):
+        session = FakeSession([requests.Timeout('timeout')] * 3)
+        monkeypatch.setattr(scheduler_request, '_session', session)
+        with pytest.raises(SchedulerError):
+            SchedulerApi('/v1/workers/health').get()
+        with pytest.raises(SchedulerError):
+            SchedulerApi('/v1/workers/health').get()
+        assert len(session.calls) == 3
+        assert get_scheduler_stats()['circuit'] == CircuitBreaker.OPEN
+
+    def test_trial_failure(self, app, monkeypatch):
+        monkeypatch.setitem(app.config, 'SCHEDULER_BREAKER_RESET', 0)
+        session = FakeSession([requests.Timeout('timeout')] * 3 + [requests.exceptions.ChunkedEncodingError('eof'),
+                                                                    FakeResponse(200, '[1]')])
+        monkeypatch.setattr(scheduler_request, '_session', session)
+        with pytest.raises(SchedulerError):
+            SchedulerApi('/v1/workers/health').get()
+        with pytest.raises(SchedulerError):
+            SchedulerApi('/v1/workers/health').get()
+        assert len(session.calls) == 4 and not scheduler_request._breaker._trial
+        assert SchedulerApi('/v1/workers/health').get() == [1]
+        assert get_scheduler_stats()['circuit'] == CircuitBreaker.CLOSED
+
+    def test_cache_and_coalesce(self, app, monkeypatch):
+        app.config['SCHEDULER_CACHE_TTLS'] = {'/v1/workers/health': 10}
+        session = FakeSession([FakeResponse(200, '[{"cluster_name": "a"}]'), FakeResponse(200, '[]')])
+        monkeypatch.setattr(scheduler_request, '_session', session)
+
+        def get_health():
+            with app.app_context():
+                return SchedulerApi('/v1/workers/health').get()
+
+        greenlets = [gevent.spawn(get_health) for _ in range(5)]
+        gevent.joinall(greenlets)
+        assert [greenlet.value for greenlet in greenlets] == [[{'cluster_name': 'a'}]] * 5
+
+        result = SchedulerApi('/v1/workers/health').get()
+        result.append('changed')
+        assert SchedulerApi('/v1/workers/health').get() == [{'cluster_name': 'a'}]
+        assert len(session.calls) == 1
+        assert get_scheduler_stats()['cache'] == [
+            {'endpoint': '/v1/workers/health', 'hits': 2, 'misses': 1, 'coalesced': 4}]
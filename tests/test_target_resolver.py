@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+from aops.applications.database import db
+from aops.applications.database.apis.resource.host.host import get_host_ips_with_ids, resolve_host_ips
+from aops.applications.database.models import Group, Host
+
+
+def _create(name, parent=None, hosts=()):
+    return Group.create(pid=parent.id if parent else 0, name=name, business='LDDS',
+                        type='group' if parent else 'business', hosts=list(hosts))
+
+
+class TestTargetResolver(object):
+    def test_resolve_host_ips(self, app, count_statements):
+        app.config['REDIS_HOST'] = None
+        with app.app_context():
+            db.create_all()
+            hosts = [Host.create(name='host{}'.format(i), business='LDDS', identity_ip='10.0.0.{}'.format(i))
+                     for i in range(5)]
+            root = _create('LDDS')
+            web = _create('web', root)
+            nginx = _create('nginx', web, hosts[:2])
+            tomcat = _create('tomcat', web, hosts[1:3])
+            deleted = _create('deleted', root, hosts[4:])
+            hosts[2].update(is_deleted=True)
+            deleted.update(is_deleted=True)
+
+            id_lists = [
+                [str(root.id)],
+                [str(nginx.id), str(tomcat.id), '{}_{}'.format(web.id, hosts[3].id)],
+                [str(deleted.id), '{}_{}'.format(web.id, hosts[2].id)],
+                [],
+            ]
+            with count_statements() as statements:
+                results = resolve_host_ips(id_lists)
+            assert len(statements) == 4
+            assert sorted(results[0]) == ['10.0.0.0', '10.0.0.1']
+            assert sorted(results[1]) == ['10.0.0.0', '10.0.0.1', '10.0.0.3']
+            assert results[2:] == [[], []]
+            assert sorted(get_host_ips_with_ids([str(web.id)])) == ['10.0.0.0', '10.0.0.1']